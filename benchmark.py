@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Benchmark of the overhead of tool.py on large synthetic projects.
+
+The benchmark runs the tool on synthetic builds with a configurable number of
+task generators and outputs, using light-weight stand-ins for the waf
+objects, and measures the time spent in each part of the tool and the peak
+memory use, for both a full build and a no-op build. The results are written
+as json so regressions in the tool itself can be tracked, e.g.::
+
+    python benchmark.py --outputs 1000 10000 100000 --output results.json
+
+The benchmark can also generate a waf project of the same shape, which can be
+built with waf to measure the tool in a real build::
+
+    python benchmark.py --generate-project large-project --outputs 10000
+"""
+
+from __future__ import print_function
+
+import argparse
+import importlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def load_tool():
+    """Load the tool module with minimal stand-ins for waflib."""
+    waflib = types.ModuleType('waflib')
+
+    def decorator(*args):
+        return lambda function: function
+
+    task_gen = types.ModuleType('waflib.TaskGen')
+    task_gen.feature = decorator
+    task_gen.before_method = decorator
+    task_gen.after_method = decorator
+
+    # the summary is formatted but not printed.
+    logs = types.ModuleType('waflib.Logs')
+    logs.pprint = lambda color, message: None
+    logs.warn = lambda message: None
+
+    utils = types.ModuleType('waflib.Utils')
+    utils.subprocess = None
+
+    task = types.ModuleType('waflib.Task')
+    task.NOT_RUN, task.MISSING, task.CRASHED, task.EXCEPTION = 0, 1, 2, 3
+    task.SKIPPED, task.SUCCESS = 8, 9
+    task.ASK_LATER, task.SKIP_ME, task.RUN_ME = -1, -2, -3
+
+    context = types.ModuleType('waflib.Context')
+    context.Context = object
+    options = types.ModuleType('waflib.Options')
+
+    waflib.TaskGen = task_gen
+    waflib.Context = context
+    waflib.Options = options
+    waflib.Task = task
+    waflib.Logs = logs
+    waflib.Utils = utils
+    sys.modules['waflib'] = waflib
+
+    # a fresh module for every build, so no state is carried over.
+    sys.modules.pop('tool', None)
+    return importlib.import_module('tool')
+
+
+class Node(object):
+
+    """Stand-in for a waf node."""
+
+    def __init__(self, folder, path):
+        """Create node."""
+        self.folder = folder
+        self.path = path
+
+    def bldpath(self):
+        """Return the path relative to the build folder."""
+        return self.path
+
+    def abspath(self):
+        """Return the absolute path."""
+        return os.path.join(self.folder, self.path)
+
+    def srcpath(self):
+        """Return the path of a folder node."""
+        return self.folder
+
+    def path_from(self, node):
+        """Return the path relative to the top folder."""
+        return self.path
+
+
+class Environment(object):
+
+    """Stand-in for the environment of a task generator."""
+
+    def __init__(self):
+        """Create environment."""
+        self.DEST_BINFMT = 'elf'
+        self.LINKFLAGS = []
+
+    def append_value(self, name, values):
+        """Append values to a variable."""
+        getattr(self, name).extend(values)
+
+    def derive(self):
+        """Return a copy which can be changed on its own."""
+        env = Environment()
+        env.DEST_BINFMT = self.DEST_BINFMT
+        env.LINKFLAGS = list(self.LINKFLAGS)
+        return env
+
+
+class Task(object):
+
+    """Stand-in for a waf task."""
+
+    def __init__(self, generator, inputs, outputs):
+        """Create task."""
+        self.generator = generator
+        self.env = generator.env
+        self.inputs = inputs
+        self.outputs = outputs
+        self.run_after = set()
+        self.hasrun = 0
+        self.skip = False
+
+    def runnable_status(self):
+        """Return whether the task runs or is skipped as up to date."""
+        return -2 if self.skip else -3
+
+    def display(self):
+        """Return the progress line of the task."""
+        return '[1/1] Compiling {}\n'.format(self.inputs[0].path)
+
+    def uid(self):
+        """Return the id of the task."""
+        return self.outputs[0].path
+
+    def run(self):
+        """Run the task, which does nothing."""
+        return 0
+
+
+class TaskGenerator(object):
+
+    """Stand-in for a waf task generator with compiled and link tasks."""
+
+    def __init__(self, bld, name, sources):
+        """Create task generator."""
+        self.bld = bld
+        self.name = name
+        self.env = Environment()
+        folder = os.path.join('src', name)
+        self.compiled_tasks = [
+            Task(self,
+                 [Node(bld.folder, os.path.join(
+                     folder, 'source_{}.cpp'.format(i)))],
+                 [Node(bld.folder, os.path.join(
+                     folder, 'source_{}.cpp.1.o'.format(i)))])
+            for i in range(sources)]
+        self.link_task = Task(
+            self, [output for task in self.compiled_tasks
+                   for output in task.outputs],
+            [Node(bld.folder, os.path.join(folder, name))])
+        self.link_task.run_after.update(self.compiled_tasks)
+        self.tasks = self.compiled_tasks + [self.link_task]
+
+
+class Build(object):
+
+    """Stand-in for a waf build context."""
+
+    def __init__(self, folder, generators, sources, options):
+        """Create build."""
+        self.folder = folder
+        self.bldnode = Node(folder, '')
+        self.srcnode = Node(folder, '')
+        self.options = options
+        self.jobs = 8
+        self.post_funs = []
+        generators = [
+            TaskGenerator(self, 'generator_{}'.format(i), sources)
+            for i in range(generators)]
+        self.groups = [generators]
+
+        # every source includes the headers of its task generator and the
+        # headers shared by the whole project, as found by the scan of waf.
+        shared = [
+            Node(folder, os.path.join('include', 'shared_{}.h'.format(i)))
+            for i in range(10)]
+        self.node_deps = {}
+        for generator in generators:
+            headers = shared + [
+                Node(folder, os.path.join(
+                    'src', generator.name, 'header_{}.h'.format(i)))
+                for i in range(10)]
+            for task in generator.compiled_tasks:
+                self.node_deps[task.uid()] = headers
+
+    def add_post_fun(self, function):
+        """Add function to run after the build."""
+        self.post_funs.append(function)
+
+    def has_tool_option(self, option):
+        """Return whether a tool option is given."""
+        return option in self.options
+
+    def get_tool_option(self, option):
+        """Return the value of a tool option."""
+        return self.options[option]
+
+    def fatal(self, message):
+        """Stop the benchmark."""
+        raise RuntimeError(message)
+
+
+def create_outputs(bld):
+    """Create the output files of the build."""
+    for generator in bld.groups[0]:
+        for task in generator.tasks:
+            for output in task.outputs:
+                path = output.abspath()
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, 'wb') as f:
+                    f.write(b'\0' * 1024)
+
+
+def measure(timings, name, function, *args):
+    """Call a function and add its duration to the timings."""
+    start = time.time()
+    result = function(*args)
+    timings[name] = timings.get(name, 0.0) + time.time() - start
+    return result
+
+
+def run_build(folder, generators, sources, options, run_tasks,
+              trace_memory=False):
+    """
+    Run the tool on a build and return the timings and peak memory.
+
+    Tracing the memory slows down the tool, so the peak memory is only
+    measured when trace_memory is set.
+    """
+    tool = load_tool()
+    bld = Build(folder, generators, sources, options)
+    timings = {}
+
+    trace_memory = trace_memory and tracemalloc is not None
+    if trace_memory:
+        tracemalloc.start()
+
+    for generator in bld.groups[0]:
+        measure(timings, 'get_data', tool.get_data, generator)
+    for generator in bld.groups[0]:
+        measure(timings, 'collect_data_from_tasks',
+                tool.collect_data_from_tasks, generator)
+
+    for generator in bld.groups[0]:
+        for task in generator.tasks:
+            task.skip = not run_tasks
+            measure(timings, 'wrapped_runs', task.runnable_status)
+            if run_tasks:
+                measure(timings, 'wrapped_runs', task.display)
+                measure(timings, 'wrapped_runs', task.run)
+            # waf's task states, SUCCESS or SKIPPED.
+            task.hasrun = 9 if run_tasks else 8
+
+    measure(timings, 'get_sizes', tool.get_sizes, bld)
+
+    # summaries are printed by save_data, they are also measured on their
+    # own, both in full and as a report of the top changes.
+    new_build_statistics = dict(
+        (key, stats.copy())
+        for key, stats in tool.new_build_statistics.items())
+    summaries = measure(
+        timings, 'generate_summaries', tool.generate_summaries,
+        tool.old_build_statistics, new_build_statistics)
+    measure(timings, 'print_summaries', tool.print_summaries, summaries, -1)
+    report = measure(
+        timings, 'report_summaries', tool.report_summaries,
+        tool.iterate_summaries(
+            tool.old_build_statistics, new_build_statistics), 10, 'time', -1)
+    measure(timings, 'print_report', tool.print_report, report)
+
+    measure(timings, 'save_data', tool.save_data, bld)
+
+    peak_memory = None
+    if trace_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1] / 1024.0
+        tracemalloc.stop()
+
+    return {
+        'timings': timings,
+        'total': sum(v for k, v in timings.items() if k not in (
+            'generate_summaries', 'print_summaries', 'report_summaries',
+            'print_report')),
+        'peak_memory_kb': peak_memory,
+        'outputs': len(tool.new_build_statistics)}
+
+
+def benchmark(outputs, sources, options):
+    """Benchmark a full and a no-op build of a project."""
+    generators = max(1, outputs // (sources + 1))
+    folder = tempfile.mkdtemp()
+    try:
+        bld = Build(folder, generators, sources, options)
+        create_outputs(bld)
+        full = run_build(folder, generators, sources, options, True)
+        noop = run_build(folder, generators, sources, options, False)
+        for result, run_tasks in [(full, True), (noop, False)]:
+            result['peak_memory_kb'] = run_build(
+                folder, generators, sources, options, run_tasks,
+                trace_memory=True)['peak_memory_kb']
+    finally:
+        shutil.rmtree(folder)
+    return {
+        'generators': generators,
+        'sources': sources,
+        'outputs': full['outputs'],
+        'full': full,
+        'noop': noop}
+
+
+def generate_project(path, outputs, sources):
+    """Generate a waf project with the given shape, like test-project."""
+    generators = max(1, outputs // (sources + 1))
+    source_folder = os.path.join(path, 'src')
+    with open(os.path.join(path, 'wscript'), 'w') as f:
+        f.write('#! /usr/bin/env python\n# encoding: utf-8\n\n\n'
+                'def build(bld):\n'
+                '    bld.recurse([\n')
+        for i in range(generators):
+            f.write("        'src/generator_{}',\n".format(i))
+        f.write('    ])\n')
+
+    for i in range(generators):
+        name = 'generator_{}'.format(i)
+        folder = os.path.join(source_folder, name)
+        os.makedirs(folder)
+        with open(os.path.join(folder, 'wscript_build'), 'w') as f:
+            f.write("# encoding: utf-8\n\nbld.program(\n"
+                    "    features='cxx',\n"
+                    "    source=bld.path.ant_glob('**/*.cpp'),\n"
+                    "    target='{}'\n)\n".format(name))
+        for j in range(sources):
+            with open(os.path.join(folder, 'source_{}.cpp'.format(j)),
+                      'w') as f:
+                if j == 0:
+                    f.write('int main() { return 0; }\n')
+                else:
+                    f.write('int function_{}() {{ return {}; }}\n'.format(
+                        j, j))
+
+
+def parse_tool_options(values):
+    """Parse tool options given as KEY=VALUE or KEY."""
+    options = {}
+    for value in values:
+        key, _, option = value.partition('=')
+        options[key] = option if option else True
+    return options
+
+
+def main():
+    """Main function."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        '--outputs', type=int, nargs='+', default=[100, 1000, 10000],
+        help='number of outputs of the benchmarked projects')
+    parser.add_argument(
+        '--sources', type=int, default=9,
+        help='number of sources per task generator')
+    parser.add_argument(
+        '--options', nargs='*', default=[],
+        help='tool options given as KEY=VALUE, e.g. format=compact')
+    parser.add_argument(
+        '--output', help='file to write the results to as json')
+    parser.add_argument(
+        '--generate-project',
+        help='generate a waf project in this folder instead of benchmarking')
+    arguments = parser.parse_args()
+
+    if arguments.generate_project:
+        generate_project(
+            arguments.generate_project, arguments.outputs[0],
+            arguments.sources)
+        return
+
+    options = parse_tool_options(arguments.options)
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': options,
+        'benchmarks': []}
+    for outputs in arguments.outputs:
+        result = benchmark(outputs, arguments.sources, options)
+        results['benchmarks'].append(result)
+        print('{:>8} outputs: full build {:8.3f} s, no-op build {:8.3f} s, '
+              'peak memory {} kb'.format(
+                  result['outputs'], result['full']['total'],
+                  result['noop']['total'], result['full']['peak_memory_kb']))
+
+    if arguments.output:
+        with open(arguments.output, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
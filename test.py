@@ -6,13 +6,19 @@
 from __future__ import print_function
 
 import sys
+import hashlib
+import io
 import imp
 import importlib
 import unittest
 import mock
 import subprocess
 import os
+import shutil
+import tempfile
+import threading
 import json
+import datetime
 
 
 def load_tool():
@@ -37,9 +43,21 @@ def load_tool():
     # module
     setattr(waflib, 'TaskGen', MockTaskGen)
 
-    # do the same for the Logs attribute
+    # do the same for the Logs and Utils attributes
     MockLogs = mock.Mock()
     setattr(waflib, 'Logs', MockLogs)
+    MockUtils = mock.Mock()
+    setattr(waflib, 'Utils', MockUtils)
+
+    # the Task attribute only needs the states of the tasks.
+    MockTask = mock.Mock(
+        NOT_RUN=0, MISSING=1, CRASHED=2, EXCEPTION=3, SKIPPED=8, SUCCESS=9)
+    setattr(waflib, 'Task', MockTask)
+
+    # the commands subclass waf's Context, which must be a real class.
+    MockContext = mock.Mock(Context=type('Context', (object,), {}))
+    setattr(waflib, 'Context', MockContext)
+    setattr(waflib, 'Options', mock.Mock())
 
     # add the fake waflib to sys.modules - when doing so any later imports of
     # the waflib will not happen.
@@ -61,6 +79,7 @@ class TestTool(unittest.TestCase):
 
         mock_self = mock.Mock()
         mock_self.bld.bldnode.srcpath = lambda: '.'
+        mock_self.bld.has_tool_option = lambda option: False
 
         old_build_statistics = {
             'output_old_1': {
@@ -83,7 +102,9 @@ class TestTool(unittest.TestCase):
         builtins = '__builtin__' if sys.version[0] == '2' else 'builtins'
         open_module = '{}.open'.format(builtins)
         with \
-                mock.patch('os.path.exists', lambda path: True), \
+                mock.patch(
+                    'os.path.exists',
+                    lambda path: path.endswith(tool.filename)), \
                 mock.patch(open_module, mock.mock_open()), \
                 mock.patch('json.load', lambda datafile: old_build_statistics):
             tool.get_data(mock_self)
@@ -97,18 +118,31 @@ class TestTool(unittest.TestCase):
         mock_link_task = mock.Mock()
         mock_self.link_task = mock_link_task
 
+        # every task of the task generator is measured, e.g. a task
+        # without outputs, except for install tasks.
+        mock_rule_task = mock.Mock()
+        mock_rule_task.__class__ = type('rule', (mock.Mock,), {})
+        mock_rule_task.generator.name = 'program'
+        mock_rule_task.outputs = []
+        mock_rule_task.run = lambda: False
+        mock_install_task = mock.Mock()
+        mock_install_task.__class__ = type('inst', (mock.Mock,), {})
+        mock_install_task.outputs = []
+        mock_install_task.run = lambda: False
+
         mock_tasks = mock_compiled_tasks + [mock_link_task]
+        mock_self.tasks = mock_tasks + [mock_rule_task, mock_install_task]
 
         i = 1
         for task in mock_tasks:
-            task.run = lambda: True
+            task.run = lambda: False
             task.outputs = []
             for j in range(1, i + 1):
                 mock_output = mock.Mock()
                 mock_output.bldpath = mock.Mock(
                     return_value='output_{}_{}'.format(i, j))
-                mock_output.srcpath = mock.Mock(
-                    return_value='build/' + mock_output.bldpath())
+                mock_output.abspath = mock.Mock(
+                    return_value='/build/' + mock_output.bldpath())
                 task.outputs.append(mock_output)
             i += 1
 
@@ -121,25 +155,29 @@ class TestTool(unittest.TestCase):
 
         # check that all tasks has been created
         self.assertEqual(
-            set([o.bldpath() for t in mock_tasks for o in t.outputs]),
+            set([o.bldpath() for t in mock_tasks for o in t.outputs] +
+                ['rule (program)']),
             set(tool.new_build_statistics.keys()))
+        self.assertEqual('object', tool.output_owners['output_1_1'][1])
+        self.assertEqual('binary', tool.output_owners['output_3_1'][1])
+        self.assertEqual('rule', tool.output_owners['rule (program)'][1])
+
+        # implicitly call collect_data_from_run by calling task.run, the
+        # outputs are measured as soon as the tasks finish.
+        mock_time = mock.Mock(
+            side_effect=range(0, len(mock_self.tasks * 2) * 5, 5))
+        with \
+                mock.patch('tool.clock', mock_time), \
+                mock.patch('os.path.getsize', lambda path: 1024 * 10):
+            for task in mock_self.tasks:
+                self.assertEqual(False, task.run())
 
-        mock_group = mock.Mock()
-        mock_group.tasks = mock_tasks
-        mock_self.groups = [[mock_group]]
-
-        with mock.patch('os.path.getsize', lambda path: 1024 * 10):
-            tool.get_sizes(mock_self)
+        # get_sizes merges the records of the worker threads
+        tool.get_sizes(mock_self.bld)
 
         # check that a size is now present for all outputs
         for key, value in tool.new_build_statistics.items():
-            self.assertTrue('size' in value)
-
-        # implicitly call collect_data_from_run by calling task.run
-        mock_time = mock.Mock(side_effect=range(0, len(mock_tasks * 2) * 5, 5))
-        with mock.patch('time.time', mock_time):
-            for task in mock_tasks:
-                self.assertEqual(True, task.run())
+            self.assertEqual(key != 'rule (program)', 'size' in value)
 
         # check results
         expected_new_build_statistics = {
@@ -160,15 +198,15 @@ class TestTool(unittest.TestCase):
                 'size': {'value': 10, 'unit': 'kb'}},
             'output_3_3': {
                 'time': {'value': 5, 'unit': 's'},
-                'size': {'value': 10, 'unit': 'kb'}}
+                'size': {'value': 10, 'unit': 'kb'}},
+            'rule (program)': {
+                'time': {'value': 5, 'unit': 's'}}
         }
 
         self.assertEqual(
             expected_new_build_statistics,
             tool.new_build_statistics)
 
-        # setup mocks for save_data
-        mock_self.bld.has_tool_option = lambda option: False
         # call save_data
         mock_json_dump = mock.Mock()
         mock_Logs = mock.Mock()
@@ -178,6 +216,14 @@ class TestTool(unittest.TestCase):
                 mock.patch('json.dump', mock_json_dump):
             tool.save_data(mock_self.bld)
 
+        # the tasks are summarized by class, each task counted once.
+        build = mock_json_dump.call_args[0][0][tool.build_key]
+        self.assertEqual(
+            {'tasks': 3, 'time': 15}, build['classes']['Mock'])
+        self.assertEqual(
+            {'tasks': 1, 'time': 5}, build['classes']['rule'])
+        self.assertNotIn('inst', build['classes'])
+
         # collect what's been written to stdout
         stdout = ''
         # check state of the various outputs.
@@ -215,6 +261,1330 @@ class TestTool(unittest.TestCase):
                 else:
                     self.assertIn(key, stdout)
 
+    @unittest.skipUnless(hasattr(os, 'wait4'), 'requires os.wait4')
+    def test_accounting(self):
+        """Test accounting the resources used by child processes."""
+        tool = load_tool()
+        tool.install_accounting()
+        self.assertIs(tool.AccountingPopen, tool.Utils.subprocess.Popen)
+
+        def run():
+            process = tool.Utils.subprocess.Popen(
+                [sys.executable, '-c', 'sum(range(10 ** 6))'])
+            process.communicate()
+            return process.returncode
+
+        output = mock.Mock()
+        output.bldpath.return_value = 'output'
+        output.abspath.return_value = sys.executable
+        task = mock.Mock(outputs=[output])
+        with mock.patch.dict(tool.new_build_statistics, {'output': {}}):
+            self.assertEqual(0, tool.collect_data_from_run(run, task)())
+            tool.merge_records()
+            stats = tool.new_build_statistics['output']
+
+        self.assertEqual(
+            set(['time', 'cpu_user', 'cpu_system', 'peak_rss', 'size']),
+            set(stats))
+        self.assertGreater(stats['cpu_user']['value'], 0)
+        self.assertGreater(stats['peak_rss']['value'], 0)
+        self.assertEqual('kb', stats['peak_rss']['unit'])
+
+        # processes which are polled are accounted as well
+        process = tool.AccountingPopen(
+            [sys.executable, '-c', 'import sys; sys.exit(3)'])
+        tool.accounting.usage = usage = []
+        while process.poll() is None:
+            pass
+        tool.accounting.usage = None
+        self.assertEqual(3, process.returncode)
+        self.assertEqual(1, len(usage))
+
+        # the accounting is stopped even if the run fails
+        def fail():
+            raise RuntimeError()
+        with mock.patch.dict(tool.new_build_statistics, {'output': {}}):
+            self.assertRaises(
+                RuntimeError, tool.collect_data_from_run(fail, task))
+        self.assertIsNone(tool.accounting.usage)
+
+        # the lack of accounting is logged once
+        with mock.patch.object(tool, 'os', mock.Mock(spec=['path'])), \
+                mock.patch.object(tool, 'accounting_logged', False), \
+                mock.patch.object(tool, 'Logs') as logs:
+            tool.install_accounting()
+            tool.install_accounting()
+        self.assertEqual(1, logs.info.call_count)
+
+    def test_critical_path(self):
+        """Test the critical path analysis of a task graph."""
+        tool = load_tool()
+
+        # a diamond: a -> (b, c) -> d, followed by e in the next group
+        tasks = {}
+        generators = [mock.Mock(), mock.Mock()]
+        for name, group in [('a', 0), ('b', 0), ('c', 0), ('d', 0), ('e', 1)]:
+            output = mock.Mock()
+            output.bldpath.return_value = name
+            tasks[name] = mock.Mock(
+                outputs=[output], generator=generators[group],
+                run_after=set())
+        tasks['b'].run_after = set([tasks['a']])
+        tasks['c'].run_after = set([tasks['a']])
+        tasks['d'].run_after = set([tasks['b'], tasks['c']])
+        bld = mock.Mock(groups=[[generators[0]], [generators[1]]])
+
+        statistics = dict(
+            (name, {'time': {'value': value, 'unit': 's'}})
+            for name, value in [('a', 2), ('b', 3), ('c', 1), ('d', 4),
+                                ('e', 1)])
+        names, durations, dependencies = tool.build_task_graph(
+            bld, [tasks[name] for name in 'abcde'], statistics)
+
+        analysis = tool.analyse_critical_path(durations, dependencies, 2)
+        self.assertEqual(10, analysis['length'])
+        self.assertEqual(
+            ['a', 'b', 'd', 'e'],
+            [names[node] for node in analysis['path']
+             if names[node] is not None])
+        self.assertEqual(2, analysis['slack'][names.index('c')])
+        self.assertEqual(0, analysis['slack'][names.index('b')])
+        self.assertEqual(11, analysis['work'])
+        self.assertEqual(10, analysis['lower_bound'])
+        self.assertEqual(10, analysis['makespan'])
+
+        analysis = tool.analyse_critical_path(durations, dependencies, 1)
+        self.assertEqual(11, analysis['makespan'])
+
+    def test_schedule_tasks(self):
+        """Test prioritising tasks by their historical durations."""
+        tool = load_tool()
+
+        generator = mock.Mock()
+        tasks = []
+        for name in ['short', 'unknown', 'long', 'medium']:
+            output = mock.Mock()
+            output.bldpath.return_value = name
+            tasks.append(mock.Mock(
+                outputs=[output], generator=generator, run_after=set()))
+        old = dict(
+            (name, {'time': {'value': value, 'unit': 's'}})
+            for name, value in [('short', 1), ('medium', 5), ('long', 10)])
+
+        class Producer(object):
+            outstanding = []
+
+            def refill_task_list(self):
+                pass
+
+        bld = mock.Mock(groups=[[generator]], producer=Producer())
+        bld.has_tool_option = lambda option: option == 'prioritise'
+        bld.get_tool_option = lambda option: True
+
+        with \
+                mock.patch('tool.schedule_mode', None), \
+                mock.patch.dict(tool.task_priorities, clear=True), \
+                mock.patch.dict(tool.old_build_statistics, old, clear=True):
+            scheduled = next(tool.schedule_tasks(bld, iter([list(tasks)])))
+            self.assertEqual('longest', tool.schedule_mode)
+
+            # the unknown task is assumed to take the median duration, the
+            # order of tasks with the same priority is kept.
+            self.assertEqual(
+                ['long', 'unknown', 'medium', 'short'],
+                [tool.task_name(task) for task in scheduled])
+
+            # tasks added to the outstanding tasks are sorted again
+            bld.producer.outstanding = [tasks[0], tasks[2]]
+            bld.producer.refill_task_list()
+            self.assertEqual(
+                [tasks[2], tasks[0]], bld.producer.outstanding)
+
+        # without any history the makespan is not predicted
+        tasks[0].statistics_serial = 0
+        records = [(0.0, 0, 'Thread-1', 2.0, ['short'], {}, None)]
+        with \
+                mock.patch('tool.schedule_mode', 'longest'), \
+                mock.patch('tool.wrapped_tasks', tasks[:1]), \
+                mock.patch('tool.Logs') as logs, \
+                mock.patch.dict(tool.old_build_statistics, clear=True):
+            report = tool.report_schedule(bld, records)
+        self.assertEqual(
+            {'mode': 'longest', 'predicted': None, 'actual': 2.0}, report)
+        self.assertIn('no history', logs.pprint.call_args[0][1])
+
+    def test_export_trace(self):
+        """Test exporting the build as a trace event timeline."""
+        tool = load_tool()
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+
+        cpu = {'time': {'value': 1.0, 'unit': 's'},
+               'cpu_user': {'value': 0.5, 'unit': 's'},
+               'cpu_system': {'value': 0.25, 'unit': 's'},
+               'peak_rss': {'value': 100, 'unit': 'kb'}}
+        records = [
+            (10.0, 0, 'Thread-1', 11.0, ['a.o'], cpu, [2.0]),
+            (10.5, 1, 'Thread-2', 12.0, ['b.o', 'b.h'], {}, [1.0, None]),
+            (11.0, 2, 'Thread-1', 13.0, ['app'], {}, [4.0]),
+        ]
+        path = os.path.join(folder, 'trace.json')
+        tool.export_trace(path, records, [])
+
+        with open(path) as f:
+            trace = json.load(f)
+        events = trace['traceEvents']
+        threads = [e for e in events if e['ph'] == 'M']
+        spans = [e for e in events if e['ph'] == 'X']
+        self.assertEqual(
+            ['Thread-1', 'Thread-2'], [e['args']['name'] for e in threads])
+        self.assertEqual(['a.o', 'b.o', 'app'], [e['name'] for e in spans])
+        self.assertEqual([0, 500000, 1000000], [e['ts'] for e in spans])
+        self.assertEqual(2000000, spans[2]['dur'])
+        self.assertEqual(spans[0]['tid'], spans[2]['tid'])
+        self.assertEqual(0.75, spans[0]['args']['cpu_s'])
+        self.assertEqual(2.0, spans[0]['args']['size_kb'])
+        self.assertNotIn('size_kb', spans[1]['args'])
+
+    def test_get_sizes(self):
+        """Test reusing cached sizes and measuring the remaining outputs."""
+        tool = load_tool()
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+
+        paths = {}
+        for i in range(100):
+            key = 'size_output_{}'.format(i)
+            paths[key] = os.path.join(folder, key)
+            with open(paths[key], 'wb') as f:
+                f.write(b'x' * 1024 * i)
+
+        old = {'size_output_0': {'size': {'value': 42, 'unit': 'kb'}},
+               'size_output_1': {'size': {'value': 42, 'unit': 'kb'}}}
+        new = dict((key, {}) for key in paths)
+        # size_output_1 ran in this build hence it must be measured again.
+        new['size_output_1']['time'] = {'value': 1, 'unit': 's'}
+
+        with \
+                mock.patch.dict(tool.old_build_statistics, old, clear=True), \
+                mock.patch.dict(tool.new_build_statistics, new, clear=True), \
+                mock.patch.dict(tool.output_paths, paths):
+            tool.get_sizes(
+                mock.Mock(**{'has_tool_option.return_value': False}))
+            sizes = dict((key, stats['size']['value'])
+                         for key, stats in tool.new_build_statistics.items())
+
+        self.assertEqual(42, sizes.pop('size_output_0'))
+        for key, size in sizes.items():
+            self.assertEqual(int(key.split('_')[-1]), size)
+
+    def test_worker_records(self):
+        """Test recording and merging tasks run on several threads."""
+        tool = load_tool()
+
+        tasks = []
+        for i in range(20):
+            output = mock.Mock()
+            output.bldpath.return_value = 'worker_output_{}'.format(i)
+            output.abspath.return_value = '/missing/output'
+            task = mock.Mock(outputs=[output])
+            task.run = tool.collect_data_from_run(lambda: 0, task)
+            tasks.append(task)
+
+        threads = [
+            threading.Thread(target=lambda i=i: [t.run() for t in tasks[i::4]])
+            for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        with mock.patch.dict(tool.new_build_statistics, {}):
+            records = tool.merge_records()
+            self.assertEqual(
+                set('worker_output_{}'.format(i) for i in range(20)),
+                set(k for k in tool.new_build_statistics
+                    if k.startswith('worker_output_')))
+
+        records = [r for r in records if r[4][0].startswith('worker_output_')]
+        self.assertEqual(20, len(records))
+        self.assertEqual(sorted(records, key=lambda r: r[:2]), records)
+        self.assertEqual(
+            set(thread.name for thread in threads),
+            set(record[2] for record in records))
+
+        summary = tool.summarize_workers(records)
+        self.assertEqual(
+            20, sum(w['tasks'] for w in summary['workers'].values()))
+        self.assertLessEqual(summary['utilisation'], 1.0)
+
+    def test_compact(self):
+        """Test saving and loading statistics in the compact format."""
+        tool = load_tool()
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+
+        statistics = {
+            os.path.join('src', 'a.o'): {
+                'time': {'value': 1.5, 'unit': 's'},
+                'size': {'value': 10.0, 'unit': 'kb'},
+                'status': {'value': 'ran', 'unit': ''}},
+            os.path.join('src', 'b.o'): {
+                'size': {'value': 20.0, 'unit': 'kb'}},
+            'app': {
+                'time': {'value': 3.0, 'unit': 's'},
+                'size': {'value': 30.0, 'unit': 'kb'}},
+            tool.build_key: {'span': 4.0},
+        }
+        tool.save_statistics(folder, statistics, 'compact')
+        self.assertFalse(os.path.exists(os.path.join(folder, tool.filename)))
+
+        path = tool.find_statistics(folder, 'compact')
+        self.assertEqual(os.path.join(folder, tool.compact_filename), path)
+        loaded = tool.load_statistics(path)
+        self.assertIsInstance(loaded, tool.CompactStatistics)
+        self.assertEqual(statistics, dict(loaded.items()))
+        self.assertEqual(3, loaded.count)
+        # the directories are stored once
+        self.assertEqual(
+            ['', 'src' + os.sep],
+            sorted(loaded.section('directories').decode().split('\n')))
+        self.assertEqual(
+            [30.0, 10.0, 20.0], list(loaded.column('size')))
+
+        # only the stats carried over to a new build are read.
+        self.assertEqual(
+            {'size': {'value': 10.0, 'unit': 'kb'},
+             'status': {'value': 'ran', 'unit': ''}},
+            tool.carried_stats(
+                loaded, os.path.join('src', 'a.o'),
+                {'time': {'value': 2.0, 'unit': 's'}}))
+        self.assertEqual({}, tool.carried_stats(loaded, 'missing', {}))
+        self.assertIn('app', loaded)
+        self.assertNotIn('missing', loaded)
+
+        # the file is unmapped before it is replaced.
+        tool.close_statistics(loaded)
+        self.assertTrue(loaded.data.closed)
+
+        # an empty set of statistics
+        tool.save_statistics(folder, {}, 'compact')
+        self.assertEqual({}, dict(tool.load_statistics(path).items()))
+
+        # the statistics of the other format are not left behind
+        tool.save_statistics(folder, {'app': {}}, 'both')
+        tool.save_statistics(folder, {}, 'json')
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(
+            os.path.join(folder, tool.filename),
+            tool.find_statistics(folder, 'compact'))
+        tool.save_statistics(folder, {}, 'compact')
+        self.assertFalse(
+            os.path.exists(os.path.join(folder, tool.filename)))
+        self.assertEqual(path, tool.find_statistics(folder, 'json'))
+
+    def test_journal(self):
+        """Test recovering the journal of an interrupted build."""
+        tool = load_tool()
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+
+        with open(os.path.join(folder, tool.filename), 'w') as f:
+            json.dump({'a': {'time': {'value': 1, 'unit': 's'},
+                             'size': {'value': 2, 'unit': 'kb'}}}, f)
+
+        journal = tool.Journal(
+            os.path.join(folder, tool.journal_filename), batch_size=2)
+        journal.append(['a'], {'time': {'value': 3, 'unit': 's'}})
+        journal.append(['b', 'c'], {'time': {'value': 4, 'unit': 's'}})
+        journal.append(['d'], {'time': {'value': 5, 'unit': 's'}})
+        # the batch has been written, the last line is still pending. Kill
+        # the journal as if the build was killed.
+        journal.file.close()
+        journal.file = None
+        with open(journal.path, 'a') as f:
+            f.write('[["e"], {"ti')
+
+        with mock.patch('tool.Logs'):
+            tool.recover_journal(folder)
+
+        self.assertFalse(os.path.exists(journal.path))
+        with open(os.path.join(folder, tool.filename)) as f:
+            build_statistics = json.load(f)
+        self.assertEqual(
+            {'a': {'time': {'value': 3, 'unit': 's'},
+                   'size': {'value': 2, 'unit': 'kb'}},
+             'b': {'time': {'value': 4, 'unit': 's'}},
+             'c': {'time': {'value': 4, 'unit': 's'}}},
+            build_statistics)
+
+        header, _ = tool.read_history_build(
+            folder, tool.read_history_index(folder)[-1])
+        self.assertTrue(header['partial'])
+
+        # failed tasks are not journaled, and the pending lines are written
+        # when waf exits.
+        journal = tool.Journal(os.path.join(folder, tool.journal_filename))
+        output = mock.Mock()
+        output.bldpath.return_value = 'f'
+        output.abspath.return_value = os.path.join(folder, 'f')
+        with mock.patch.object(tool, 'journal', journal), \
+                mock.patch.dict(tool.new_build_statistics, clear=True):
+            tool.collect_data_from_run(
+                lambda: 1, mock.Mock(outputs=[output]))()
+            output.bldpath.return_value = 'g'
+            tool.collect_data_from_run(
+                lambda: 0, mock.Mock(outputs=[output]))()
+            tool.flush_journal()
+            tool.merge_records()
+        self.assertEqual(['g'], list(tool.read_journal(journal.path)))
+
+    def test_journal_first_build(self):
+        """Test the journal of a first build is kept until it is saved."""
+        tool = load_tool()
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+
+        bld = mock.Mock()
+        bld.bldnode.srcpath.return_value = folder
+        bld.has_tool_option = lambda option: option == 'journal'
+        generators = [mock.Mock(bld=bld), mock.Mock(bld=bld)]
+
+        with mock.patch.object(tool, 'statistics_read', False), \
+                mock.patch.dict(tool.old_build_statistics, clear=True):
+            tool.get_data(generators[0])
+            tool.open_journal(bld)
+            tool.journal.append(['a'], {'time': {'value': 1, 'unit': 's'}})
+            tool.journal.close()
+            # there are no previous statistics, which must not make the
+            # next task generator recover the journal of this build.
+            tool.get_data(generators[1])
+            self.assertTrue(os.path.exists(tool.journal.path))
+            tool.close_journal()
+
+        self.assertFalse(
+            os.path.exists(os.path.join(folder, tool.journal_filename)))
+        self.assertEqual([], tool.read_history_index(folder))
+
+    def test_history(self):
+        """Test the append-only build history store."""
+        tool = load_tool()
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+
+        builds = [
+            {'a': {'time': {'value': 1, 'unit': 's'}},
+             'b': {'time': {'value': 2, 'unit': 's'}}},
+            {'a': {'time': {'value': 3, 'unit': 's'}},
+             'b': {'time': {'value': 2, 'unit': 's'}}},
+            {'a': {'time': {'value': 4, 'unit': 's'}}},
+        ]
+        previous = {}
+        for build in builds:
+            tool.append_history(folder, build, previous)
+            previous = build
+
+        index = tool.read_history_index(folder)
+        self.assertEqual([1, 2, 3], [entry[0] for entry in index])
+
+        # only changed outputs are stored for builds which are not
+        # checkpoints.
+        header, records = tool.read_history_build(folder, index[1])
+        self.assertEqual(2, header['build'])
+        self.assertEqual({'a': builds[1]['a']}, records)
+
+        self.assertEqual(
+            index[1], tool.find_history_build(index, timestamp=index[1][1]))
+        self.assertEqual(index[2], tool.find_history_build(index))
+
+        for build_id, build in enumerate(builds, 1):
+            self.assertEqual(
+                build, tool.read_history_snapshot(folder, build_id))
+
+        series = tool.read_history_series(folder, 'a')
+        self.assertEqual(
+            [1, 3, 4], [stats['time']['value'] for _, _, stats in series])
+        series = tool.read_history_series(folder, 'b')
+        self.assertEqual([1, 3], [build for build, _, _ in series])
+        self.assertIsNone(series[-1][2])
+
+        # a build interrupted before its build index line is written leaves
+        # records behind, which the next build with the same id ignores.
+        index_path = os.path.join(folder, tool.history_index_filename)
+        with open(index_path) as f:
+            index_lines = f.read()
+        tool.append_history(
+            folder, {'a': {'time': {'value': 5, 'unit': 's'}}}, builds[-1])
+        with open(index_path, 'w') as f:
+            f.write(index_lines)
+        tool.append_history(
+            folder, {'a': {'time': {'value': 6, 'unit': 's'}}}, builds[-1])
+        series = tool.read_history_series(folder, 'a')
+        self.assertEqual(
+            [(1, 1), (2, 3), (3, 4), (4, 6)],
+            [(build, stats['time']['value']) for build, _, stats in series])
+
+    def test_regressions(self):
+        """Test detecting regressions against the rolling baselines."""
+        tool = load_tool()
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+
+        options = {'regressions': 12}
+        bld = mock.Mock()
+        bld.bldnode.srcpath.return_value = folder
+        bld.has_tool_option = lambda option: option in options
+        bld.get_tool_option = lambda option: options[option]
+
+        def build(time, size):
+            return {
+                'a.o': {'time': {'value': time, 'unit': 's'},
+                        'size': {'value': size, 'unit': 'kb'}},
+                # an output whose task did not run.
+                'b.o': {'size': {'value': 1.0, 'unit': 'kb'}}}
+
+        # noisy times and a stable size are not flagged.
+        for time in [1.0, 1.2, 0.9, 1.1, 1.0, 1.15, 0.95, 1.05, 1.0, 0.9]:
+            self.assertEqual(
+                [], tool.detect_regressions(bld, build(time, 100.0)))
+
+        baselines = tool.Baselines(folder, 12)
+        self.assertEqual(10, len(baselines.get('a.o', 'time')))
+        self.assertEqual([], baselines.get('b.o', 'size'))
+
+        summaries = tool.detect_regressions(bld, build(3.0, 100.0))
+        self.assertEqual(1, len(summaries))
+        self.assertEqual('regressed', summaries[0]['state'])
+        result = summaries[0]['results']['time']
+        self.assertEqual(1.0, result['value_old'])
+        self.assertGreater(result['score'], tool.time_sensitivity)
+
+        # a small size change is flagged with the default threshold on the
+        # score, but not with a higher one.
+        summaries = tool.detect_regressions(bld, build(1.0, 99.0))
+        self.assertEqual('improved', summaries[0]['state'])
+        self.assertEqual(['size'], list(summaries[0]['results']))
+        options['size_sensitivity'] = 20
+        self.assertEqual([], tool.detect_regressions(bld, build(1.0, 99.0)))
+
+        # the window is a ring buffer of the latest measurements.
+        baselines = tool.Baselines(folder, 12)
+        self.assertEqual(
+            [99.0, 99.0] + [100.0] * 10,
+            sorted(baselines.get('a.o', 'size')))
+
+        # changing the window starts over.
+        options['regressions'] = 4
+        self.assertEqual([], tool.detect_regressions(bld, build(5.0, 1.0)))
+        self.assertEqual(
+            [5.0], list(tool.Baselines(folder, 4).get('a.o', 'time')))
+
+    def test_report(self):
+        """Test the top changes and rolled up totals of the summary."""
+        tool = load_tool()
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+
+        def stats(time, size):
+            return {'time': {'value': time, 'unit': 's'},
+                    'size': {'value': size, 'unit': 'kb'}}
+
+        a_o = os.path.join('src', 'a', 'a.o')
+        b_o = os.path.join('src', 'b', 'b.o')
+        c_o = os.path.join('src', 'b', 'c.o')
+        old = {a_o: stats(1, 10), b_o: stats(2, 10), c_o: stats(3, 10),
+               'app': stats(4, 100), 'removed.o': stats(1, 1)}
+        # a task without outputs which did not run only has a status.
+        new = {a_o: stats(4, 10), b_o: stats(1, 10), c_o: stats(5, 10),
+               'app': stats(2, 100),
+               'rule (app) #0': {'status': {'value': 'skipped', 'unit': ''}}}
+        owners = {a_o: ('a', 'object'), b_o: ('b', 'object'),
+                  c_o: ('b', 'object'), 'app': ('app', 'binary')}
+
+        path = os.path.join(folder, 'diff.json')
+        summaries = tool.write_diff(path, tool.iterate_summaries(old, new))
+        with mock.patch.dict('tool.output_owners', owners):
+            report = tool.report_summaries(summaries, top=1)
+
+        # the full diff is written while the summaries are consumed.
+        with open(path) as f:
+            self.assertEqual(5, len(f.readlines()))
+
+        self.assertEqual(
+            {'changed': 4, 'added': 0, 'removed': 1}, report['states'])
+        self.assertEqual([a_o], [s['file'] for s in report['regressions']])
+        self.assertEqual(
+            ['app'], [s['file'] for s in report['improvements']])
+        self.assertEqual(11, report['total']['time']['value_old'])
+        self.assertEqual(1, report['total']['time']['difference'])
+        self.assertEqual(
+            3, report['kinds']['object']['time']['difference'])
+        self.assertEqual(
+            -2, report['kinds']['binary']['time']['difference'])
+        self.assertEqual(
+            -1, report['generators']['(unknown)']['time']['difference'])
+        self.assertEqual(
+            1, report['generators']['b']['time']['difference'])
+        directories = report['directories']
+        self.assertEqual(
+            1, directories[os.path.join('src', 'b')]['time']['difference'])
+        self.assertEqual(4, directories['src']['time']['difference'])
+        self.assertEqual(1, directories['']['time']['difference'])
+
+        mock_Logs = mock.Mock()
+        with mock.patch('tool.Logs', mock_Logs):
+            tool.print_report(report, top=2)
+        messages = [call[1][1] for call in mock_Logs.pprint.mock_calls]
+        self.assertIn('changed: 4, added: 0, removed: 1', messages[0])
+        directory_lines = [m for m in messages if m.startswith('[ DIR')]
+        self.assertEqual(2, len(directory_lines))
+        self.assertIn('  src  time 6.000 -> 10.000 s', directory_lines[0])
+        # the top regression and the top improvement.
+        self.assertEqual(
+            2, len([m for m in messages if m.startswith('[ FILE')]))
+
+    def test_classify_tasks(self):
+        """Test the status of the tasks and the time saved."""
+        tool = load_tool()
+
+        def task(name, hasrun, serial, cached=False):
+            task = mock.Mock()
+            task.outputs = [mock.Mock()]
+            task.outputs[0].bldpath.return_value = name
+            task.hasrun = hasrun
+            task.statistics_serial = serial
+            task.cached = cached
+            return task
+
+        tasks = [task('ran.o', 9, 0), task('skipped.o', 8, 1),
+                 task('cached.o', 9, 2, cached=True),
+                 task('failed.o', 2, 3), task('not_run.o', 0, 4)]
+        records = [(0.0, 0, 'worker', 2.0, ['ran.o'], {}, None),
+                   (0.0, 2, 'worker', 0.5, ['cached.o'], {}, None)]
+        old = dict((name, {'time': {'value': 3.0, 'unit': 's'}})
+                   for name in ('ran.o', 'skipped.o', 'cached.o'))
+        new = {'cached.o': {'time': {'value': 0.5, 'unit': 's'}}}
+
+        with \
+                mock.patch.dict('tool.old_build_statistics', old), \
+                mock.patch.dict('tool.new_build_statistics', new):
+            summary = tool.classify_tasks(tasks, records)
+            statuses = dict(
+                (key, stats['status']['value'])
+                for key, stats in tool.new_build_statistics.items())
+
+        self.assertEqual(
+            {'ran.o': 'ran', 'skipped.o': 'skipped', 'cached.o': 'cached',
+             'failed.o': 'failed', 'not_run.o': 'not_run'}, statuses)
+        self.assertEqual(1, summary['skipped'])
+        self.assertEqual(3.0, summary['time_saved'])
+        self.assertEqual(2.5, summary['cache_time_saved'])
+        self.assertAlmostEqual(1 / 3.0, summary['rebuild_ratio'])
+
+        # the status is not a number, so it is left out of the summaries.
+        summary = tool.generate_changed_summary(
+            'a', {'a': {'status': {'value': 'ran', 'unit': ''}}},
+            {'a': {'status': {'value': 'skipped', 'unit': ''}}})
+        self.assertEqual({}, summary['results'])
+
+    def test_tasks_without_outputs(self):
+        """Test telling apart the tasks without outputs of a generator."""
+        tool = load_tool()
+
+        generator = mock.Mock(tasks=[])
+        generator.name = 'program'
+        rule = type('rule', (object,), {})
+        for inputs in [[], [], ['src/a.txt'], ['src/b.txt']]:
+            task = rule()
+            task.generator = generator
+            task.outputs = []
+            task.inputs = [mock.Mock(**{'bldpath.return_value': path})
+                           for path in inputs]
+            task.run = lambda: 0
+            generator.tasks.append(task)
+
+        with \
+                mock.patch.dict(tool.new_build_statistics, clear=True), \
+                mock.patch.dict(tool.output_owners, clear=True), \
+                mock.patch.object(tool, 'wrapped_tasks', []), \
+                mock.patch.object(tool, 'wrapped_ids', set()):
+            for task in generator.tasks:
+                tool.wrap_task(task)
+                task.run()
+            keys = sorted(tool.new_build_statistics)
+            records = tool.merge_records()
+            classes = tool.summarize_classes(records, generator.tasks)
+
+        self.assertEqual(
+            ['rule (program) #0', 'rule (program) #1',
+             'rule (program) src/a.txt', 'rule (program) src/b.txt'], keys)
+        self.assertEqual(4, classes['rule']['tasks'])
+
+        # install tasks are their own task generator without a name
+        install = type('inst', (object,), {})()
+        install.generator = install
+        install.name = None
+        install.dest = '${BINDIR}'
+        with mock.patch.object(tool, 'wrapped_ids', set()):
+            tool.wrap_task(install)
+            self.assertEqual(set(), tool.wrapped_ids)
+        self.assertEqual('install ${BINDIR}', tool.generator_name(install))
+        self.assertEqual('program', tool.generator_name(generator))
+
+    def test_fingerprint(self):
+        """Test hashing the outputs and finding identical rebuilds."""
+        tool = load_tool()
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+
+        paths = []
+        for i in range(10):
+            paths.append(os.path.join(folder, '{}.o'.format(i)))
+            with open(paths[-1], 'wb') as f:
+                f.write(b'object' * i)
+        expected = [hashlib.sha1(b'object' * i).hexdigest() for i in range(10)]
+
+        # large files are memory mapped.
+        self.assertEqual(expected[9], tool.hash_file(paths[9], mmap_size=4))
+        self.assertEqual(
+            expected + [None],
+            tool.hash_files(paths + [os.path.join(folder, 'missing')]))
+
+        def stats(time, value, status='ran'):
+            return {'time': {'value': time, 'unit': 's'},
+                    'hash': {'value': value, 'unit': ''},
+                    'status': {'value': status, 'unit': ''}}
+
+        old = {'a.o': stats(1, 'a'), 'b.o': stats(2, 'b'),
+               'c.o': stats(3, 'c'), 'd.o': stats(4, 'd')}
+        new = {'a.o': stats(1, 'a'), 'b.o': stats(2, 'x'),
+               'c.o': stats(3, 'c'), 'd.o': stats(4, 'd', 'cached'),
+               'e.o': stats(5, 'e')}
+        self.assertEqual(
+            {'outputs': 2, 'time': 4, 'top': [['c.o', 3]]},
+            tool.find_identical(old, new, top=1))
+
+    @unittest.skipUnless(
+        getattr(shutil, 'which', lambda name: None)('gcc'), 'requires gcc')
+    def test_sections(self):
+        """Test reading the section sizes and symbols of ELF files."""
+        tool = load_tool()
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+
+        source = os.path.join(folder, 'main.c')
+        with open(source, 'w') as f:
+            f.write('int table[1024] = {1};\n'
+                    'char buffer[8192];\n'
+                    'const char message[] = "message";\n'
+                    'int main(void) { return table[0] + buffer[0]; }\n')
+        obj = os.path.join(folder, 'main.o')
+        binary = os.path.join(folder, 'main')
+        subprocess.check_call(['gcc', '-g', '-c', source, '-o', obj])
+        subprocess.check_call(['gcc', obj, '-o', binary])
+
+        sizes, top = tool.read_elf(obj)
+        self.assertEqual(4, sizes['size_data'])
+        self.assertEqual(8, sizes['size_bss'])
+        self.assertEqual(8 / 1024.0, sizes['size_rodata'])
+        self.assertGreater(sizes['size_text'], 0)
+        self.assertGreater(sizes['size_debug'], 0)
+        self.assertEqual([], top)
+        self.assertIsNone(tool.read_elf(source))
+
+        # the symbols are only read for the binaries.
+        paths = {'main.o': obj, 'main': binary}
+        owners = {'main.o': ('main', 'object'), 'main': ('main', 'binary')}
+        new = {'main.o': {'time': {'value': 1, 'unit': 's'}},
+               'main': {'time': {'value': 1, 'unit': 's'}}}
+        with \
+                mock.patch.dict(tool.output_paths, paths, clear=True), \
+                mock.patch.dict(tool.output_owners, owners), \
+                mock.patch.dict(tool.new_build_statistics, new, clear=True), \
+                mock.patch.dict(tool.output_symbols, {}):
+            tool.measure_sections(['main.o', 'main'], symbols=2)
+            self.assertEqual(
+                [['buffer', 8.0], ['table', 4.0]], tool.output_symbols['main'])
+            self.assertNotIn('main.o', tool.output_symbols)
+            self.assertEqual(
+                8.0, tool.new_build_statistics['main.o']['size_bss']['value'])
+            self.assertGreaterEqual(
+                tool.new_build_statistics['main']['size_bss']['value'], 8.0)
+
+    def test_time_trace(self):
+        """Test combining the -ftime-trace output of the build."""
+        tool = load_tool()
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+
+        def event(name, duration, detail=None):
+            event = {'ph': 'X', 'pid': 1, 'tid': 1, 'ts': 0,
+                     'dur': duration * 1000000, 'name': name}
+            if detail:
+                event['args'] = {'detail': detail}
+            return event
+
+        events = [
+            {'ph': 'M', 'name': 'process_name', 'args': {'name': 'clang'}},
+            event('Source', 2, 'a.h'),
+            event('Source', 1, 'b.h'),
+            event('InstantiateClass', 0.5, 'std::vector<int>'),
+            event('Frontend', 4),
+            event('Backend', 3)]
+        paths = {}
+        for name in ('a', 'b'):
+            key = name + '.cpp.1.o'
+            paths[key] = os.path.join(folder, key)
+            with open(tool.time_trace_path(paths[key]), 'w') as f:
+                json.dump({'traceEvents': events, 'beginningOfTime': 1}, f,
+                          indent=1)
+
+        trace = tool.time_trace_path(paths['a.cpp.1.o'])
+        self.assertEqual(
+            events, list(tool.iterate_trace_events(trace, chunk_size=7)))
+        with open(trace) as f:
+            data = f.read()
+        with open(trace, 'w') as f:
+            f.write(data[:data.index('InstantiateClass')])
+        self.assertEqual(
+            events[:3], list(tool.iterate_trace_events(trace, chunk_size=7)))
+
+        statistics = dict(
+            (key, {'time': {'value': 1, 'unit': 's'}}) for key in paths)
+        with mock.patch.dict(tool.output_paths, paths, clear=True):
+            index = tool.collect_time_traces(folder, statistics, top=1)
+            # the trace of a.cpp.1.o is truncated before its templates.
+            self.assertEqual(2, index['units'])
+            self.assertEqual([['a.h', 4.0, 2]], index['headers'])
+            self.assertEqual(
+                [['std::vector<int>', 0.5, 1]], index['templates'])
+            self.assertEqual(3.0, index['backend'])
+
+            # the traces of outputs which were not rebuilt are cached.
+            os.remove(tool.time_trace_path(paths['b.cpp.1.o']))
+            statistics['b.cpp.1.o'] = {}
+            self.assertEqual(
+                index, tool.collect_time_traces(folder, statistics, top=1))
+
+    def test_progress(self):
+        """Test the live estimate of the remaining time."""
+        tool = load_tool()
+
+        class Task(object):
+            def __init__(self, name):
+                self.outputs = [mock.Mock(**{'bldpath.return_value': name})]
+                self.hasrun = 0
+                self.display = lambda: '[1/3] cxx {}\n'.format(name)
+                self.runnable_status = lambda: self.status
+                self.status = tool.Task.RUN_ME
+
+        old = {'a.o': {'time': {'value': 4.0, 'unit': 's'}},
+               'b.o': {'time': {'value': 2.0, 'unit': 's'}}}
+        with \
+                mock.patch.dict(tool.old_build_statistics, old, clear=True), \
+                mock.patch('tool.build_start', 0.0):
+            progress = tool.Progress(jobs=2, interval=0.5)
+            tasks = [Task('a.o'), Task('b.o'), Task('c.o')]
+            for task in tasks:
+                progress.add(task)
+
+            # the new task c.o is expected to take the median time.
+            with mock.patch('tool.clock', lambda: 0.0):
+                self.assertEqual(
+                    '[1/3] cxx a.o (eta 5s)\n', tasks[0].display())
+            progress.start(tasks[0], 0.0)
+
+            # the estimate is refreshed at most every interval.
+            with mock.patch('tool.clock', lambda: 0.25):
+                # b.o is up to date, which waf finds before running it.
+                tasks[1].status = tool.Task.SKIP_ME
+                self.assertEqual(tool.Task.SKIP_ME, tasks[1].runnable_status())
+                self.assertEqual(
+                    '[1/3] cxx c.o (eta 5s)\n', tasks[2].display())
+            with mock.patch('tool.clock', lambda: 1.0):
+                self.assertEqual(
+                    '[1/3] cxx c.o (eta 4s)\n', tasks[2].display())
+            with mock.patch('tool.clock', lambda: 1.25):
+                progress.stop(tasks[0])
+
+            # the estimate is refreshed when a task finishes too.
+            progress.start(tasks[2], 1.25)
+            with mock.patch('tool.clock', lambda: 2.0):
+                progress.stop(tasks[2])
+
+            # tasks without a progress line are estimated too.
+            task = Task('d.o')
+            del task.display, task.runnable_status
+            progress.add(task)
+
+            report = progress.report(5.0)
+        self.assertEqual(
+            [[0.0, 5.0], [1.0, 3.5], [2.0, 0.0]], report['samples'])
+        self.assertEqual(5.0, report['predicted'])
+        self.assertAlmostEqual(3.5 / 3, report['mean_error'])
+        self.assertEqual('1h01m05s', tool.format_duration(3665))
+
+        # without a previous build there is no estimate to show.
+        with \
+                mock.patch.dict(tool.old_build_statistics, clear=True), \
+                mock.patch('tool.build_start', 0.0):
+            progress = tool.Progress(jobs=2, interval=0.5)
+            task = Task('a.o')
+            progress.add(task)
+            self.assertEqual('[1/3] cxx a.o\n', task.display())
+            progress.stop(task)
+            self.assertIsNone(progress.report(1.0)['predicted'])
+
+    def test_reset_build(self):
+        """Test a build does not inherit the state of the previous one."""
+        tool = load_tool()
+        sampler = mock.Mock()
+        buffer = [(0.0, 0, 'worker', 1.0, ['a.o'], {}, None)]
+        with \
+                mock.patch.object(tool, 'sampler', sampler), \
+                mock.patch.object(tool, 'progress', mock.Mock()), \
+                mock.patch.object(tool, 'build_start', 1.0), \
+                mock.patch.object(tool, 'schedule_mode', 'longest'), \
+                mock.patch.object(tool, 'statistics_read', True), \
+                mock.patch.object(tool, 'record_buffers', [buffer]), \
+                mock.patch.object(tool, 'wrapped_ids', set([1])), \
+                mock.patch.dict(tool.new_build_statistics, {'a.o': {}}):
+            tool.reset_build()
+            self.assertEqual(
+                [None, None, None, None, False],
+                [tool.sampler, tool.progress, tool.build_start,
+                 tool.schedule_mode, tool.statistics_read])
+            self.assertEqual({}, tool.new_build_statistics)
+            self.assertEqual(set(), tool.wrapped_ids)
+            # the worker threads keep their buffers, which are emptied.
+            self.assertEqual([[]], tool.record_buffers)
+        sampler.stop.assert_called_once_with()
+
+        with \
+                mock.patch.object(tool, 'reset_build') as reset_build, \
+                mock.patch.object(tool, 'install_phases'):
+            tool.setup(mock.Mock())
+        reset_build.assert_called_once_with()
+
+    def test_system_sample(self):
+        """Test the samples of the system resources."""
+        tool = load_tool()
+        previous = {
+            'cpu_total': 1000, 'cpu_idle': 600, 'cpu_iowait': 100,
+            'pswpin': 10, 'pswpout': 10, 'disk:vda': (0, 0, 0)}
+        current = {
+            'cpu_total': 1400, 'cpu_idle': 700, 'cpu_iowait': 200,
+            'load': 3.5, 'MemTotal': 1000, 'MemAvailable': 250,
+            'SwapTotal': 100, 'SwapFree': 40, 'pswpin': 10, 'pswpout': 30,
+            'disk:vda': (2048, 4096, 1000), 'pressure:io': 12.5}
+        sample = dict(zip(tool.sample_fields, tool.system_sample(
+            3.0, 2.0, previous, current, 4096)))
+        self.assertEqual(
+            {'time': 3.0, 'cpu': 0.5, 'iowait': 0.25, 'load': 3.5,
+             'memory': 0.75, 'swap': 60, 'swap_in': 0.0, 'swap_out': 40.0,
+             'disk_read': 512.0, 'disk_write': 1024.0, 'disk_busy': 0.5,
+             'cpu_pressure': None, 'memory_pressure': None,
+             'io_pressure': 12.5}, sample)
+
+        sampler = tool.Sampler(interval=1.0, size=2)
+        for time in range(3):
+            sampler.add([time, 0.5 * time] + [None] * 12)
+        report = sampler.report()
+        self.assertEqual(3, report['samples'])
+        self.assertEqual({'cpu': 0.5}, report['mean'])
+        self.assertEqual({'cpu': 1.0}, report['max'])
+        self.assertEqual(
+            [1, 2], [sample[0] for sample in report['series']['values']])
+
+    @unittest.skipUnless(os.path.exists('/proc/stat'), 'requires /proc')
+    def test_read_proc_counters(self):
+        """Test reading the counters of the system resources."""
+        tool = load_tool()
+        counters = tool.read_proc_counters(set())
+        self.assertGreater(counters['cpu_total'], counters['cpu_idle'])
+        self.assertIn('MemTotal', counters)
+
+    def test_merge(self):
+        """Test merging the statistics of several builds."""
+        tool = load_tool()
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+
+        paths = []
+        for i, (time, status) in enumerate([(3.0, 'ran'), (1.0, 'cached'),
+                                            (2.0, 'ran')]):
+            statistics = {
+                'a.o': {'time': {'value': time, 'unit': 's'},
+                        'status': {'value': status, 'unit': ''}},
+                'shard_{}.o'.format(i): {'time': {'value': 1.0, 'unit': 's'}},
+                tool.build_key: {'timestamp': 100.0 + i}}
+            # the compact format is merged too.
+            path = os.path.join(folder, 'shard_{}.{}'.format(
+                i, 'bin' if i == 2 else 'json'))
+            tool.write_statistics(path, statistics)
+            paths.append(path)
+        self.assertEqual(
+            paths[:2], tool.expand_paths(os.path.join(folder, '*.json')))
+
+        merged = tool.merge_statistics(paths)
+        self.assertEqual(2.0, merged['a.o']['time']['value'])
+        self.assertEqual('ran', merged['a.o']['status']['value'])
+        self.assertEqual(5, len(merged))
+        self.assertEqual(102.0, merged[tool.build_key]['timestamp'])
+
+        merged = tool.merge_statistics(paths, 'min')
+        self.assertEqual(1.0, merged['a.o']['time']['value'])
+        self.assertEqual('ran', merged['a.o']['status']['value'])
+
+        # the result is the same when merged in several passes.
+        for shards in (1, 3):
+            merged = tool.merge_statistics(
+                paths, 'median', distributions=True, threads=2,
+                shards=shards)
+            self.assertEqual(
+                {'time': 2.0, 'time_min': 1.0, 'time_max': 3.0,
+                 'time_mean': 2.0, 'time_p50': 2.0, 'time_p90': 3.0,
+                 'status': 'ran', 'builds': 3},
+                dict((stat, value['value'])
+                     for stat, value in merged['a.o'].items()))
+            self.assertEqual(1, merged['shard_1.o']['builds']['value'])
+            self.assertEqual(
+                shards, merged[tool.build_key]['merge']['shards'])
+
+    def test_query(self):
+        """Test querying and diffing saved statistics."""
+        tool = load_tool()
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+
+        old = {
+            'src/a.o': {'time': {'value': 2.0, 'unit': 's'}},
+            'src/b.o': {'time': {'value': 1.0, 'unit': 's'}},
+            'test/c.o': {'time': {'value': 5.0, 'unit': 's'}}}
+        new = {
+            'src/a.o': {'time': {'value': 1.0, 'unit': 's'},
+                        'size': {'value': 9.0, 'unit': 'kb'}},
+            'src/b.o': {'time': {'value': 4.0, 'unit': 's'},
+                        'size': {'value': 1.0, 'unit': 'kb'}},
+            'src/d.o': {'time': {'value': 0.5, 'unit': 's'}}}
+        path = os.path.join(folder, tool.filename)
+        tool.write_statistics(path, new)
+
+        # a compact file left behind by an older build is not queried
+        compact_path = os.path.join(folder, tool.compact_filename)
+        tool.write_compact(compact_path, old)
+        os.utime(compact_path, (0, 0))
+        self.assertEqual(path, tool.find_statistics(folder, 'both'))
+        os.utime(path, (0, 0))
+        self.assertEqual(compact_path, tool.find_statistics(folder, 'both'))
+        os.remove(compact_path)
+
+        # the json statistics are indexed in the compact format.
+        statistics = tool.open_statistics(path)
+        self.assertIsInstance(statistics, tool.CompactStatistics)
+        self.assertTrue(os.path.exists(path + tool.index_suffix))
+
+        def files(summaries):
+            return [summary['file'] for summary in summaries]
+
+        self.assertEqual(
+            ['src/b.o', 'src/a.o', 'src/d.o'],
+            files(tool.query_statistics(statistics, pattern='src/*')))
+        self.assertEqual(
+            ['src/b.o', 'src/a.o'],
+            files(tool.query_statistics(statistics, threshold=1.0)))
+        self.assertEqual(
+            ['src/a.o'],
+            files(tool.query_statistics(statistics, sort='size', top=1)))
+
+        # the changes since the build in the history before the latest.
+        tool.append_history(folder, old, {})
+        tool.append_history(folder, new, old)
+        compare = tool.resolve_statistics('-2', folder)
+        summaries = tool.query_statistics(
+            statistics, compare, threshold=1.0, sort='difference')
+        self.assertEqual(['test/c.o', 'src/b.o', 'src/a.o'], files(summaries))
+        self.assertEqual(
+            ['removed', 'changed', 'changed'],
+            [summary['state'] for summary in summaries])
+        self.assertEqual(
+            ['src/b.o', 'src/a.o'],
+            files(tool.query_statistics(
+                statistics, compare, 'src/*', sort='percent', top=2)))
+        self.assertIsNone(tool.resolve_statistics('-3', folder))
+
+        stream = io.StringIO() if sys.version_info[0] > 2 else io.BytesIO()
+        tool.write_query(summaries[1:2], 'csv', stream)
+        self.assertEqual(
+            'file,state,stat,unit,value,value_old,difference,percent\n'
+            'src/b.o,changed,time,s,4.0,1.0,3.0,300.0\n', stream.getvalue())
+
+    def test_html_report(self):
+        """Test the tree and the html report of time and size."""
+        tool = load_tool()
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+
+        def stats(time, size):
+            return {'time': {'value': time, 'unit': 's'},
+                    'size': {'value': size, 'unit': 'kb'},
+                    'status': {'value': 'ran', 'unit': ''}}
+
+        new = {
+            os.path.join('src', 'a.o'): stats(3.0, 10.0),
+            os.path.join('src', 'b.o'): stats(0.001, 0.01),
+            os.path.join('src', 'c.o'): stats(0.001, 0.01),
+            'program': stats(1.0, 90.0)}
+        old = {os.path.join('src', 'a.o'): stats(2.0, 10.0)}
+        owners = {os.path.join('src', 'a.o'): ('foo', 'object')}
+        with mock.patch.dict(tool.output_owners, owners, clear=True):
+            tree = tool.report_tree(new, old, min_fraction=0.01)
+
+        def path(i):
+            parent = tree['parents'][i]
+            name = tree['names'][i]
+            return name if parent < 0 else path(parent) + '/' + name
+
+        # the small outputs are merged into one node of their directory.
+        self.assertEqual(
+            {'.': (4.002, 2.0), './src': (3.002, 2.0),
+             './src/[foo]': (3.0, 2.0), './src/[foo]/a.o': (3.0, 2.0),
+             './src/(2 more)': (0.002, 0.0), './program': (1.0, 0.0)},
+            dict((path(i), (tree['time'][i], tree['time_old'][i]))
+                 for i in range(len(tree['names']))))
+        self.assertEqual({'time': 's', 'size': 'kb'}, tree['units'])
+
+        path = os.path.join(folder, tool.html_filename)
+        tree['names'][-1] = '</script>'
+        tool.write_html_report(path, tree, 'previous build')
+        with open(path) as f:
+            html = f.read()
+        data = html.split('var data = ', 1)[1].split(';\n', 1)[0]
+        self.assertNotIn('</script>', data)
+        self.assertEqual(
+            dict(tree, compared='previous build'), json.loads(data))
+
+    def test_phases(self):
+        """Test timing the wscripts and the phases of the task generators."""
+        tool = load_tool()
+
+        class Node(object):
+            def __init__(self, path):
+                self.path = path
+
+            def path_from(self, node):
+                return self.path
+
+        ctx = mock.Mock()
+        top, sub = Node('wscript'), Node('src/wscript')
+        ticks = iter(range(100))
+        with mock.patch('tool.clock', lambda: float(next(ticks))):
+            phases = tool.Phases()
+            phases.hook(ctx)
+            ctx.pre_recurse(top)
+            ctx.pre_recurse(sub)
+            ctx.post_recurse(sub)
+            ctx.post_recurse(top)
+            ctx.pre_build()
+
+            # a task generator posting the one it uses.
+            generators = [mock.Mock(posted=False), mock.Mock(posted=False)]
+            generators[0].name, generators[1].name = 'app', 'lib'
+
+            def post(generator):
+                if generator is generators[0]:
+                    phases.time_post(generators[1], post)
+                generator.posted = True
+            phases.time_post(generators[0], post)
+            phases.time_post(generators[0], post)
+
+            task = mock.Mock(generator=generators[1], cache_sig=None)
+            phases.time_signature(task, lambda task: b'sig')
+            task.cache_sig = b'sig'
+            phases.time_signature(task, lambda task: b'sig')
+            report = phases.report()
+
+        self.assertEqual(
+            {'wscript': {'time': 3.0, 'self': 2.0},
+             'src/wscript': {'time': 1.0, 'self': 1.0}}, report['wscripts'])
+        self.assertEqual(
+            {'app': {'post': 2.0, 'signature': 0.0},
+             'lib': {'post': 1.0, 'signature': 1.0}},
+            report['task_generators'])
+        self.assertEqual(
+            [1.0, 5.0, 7.0, 3.0, 1.0],
+            [report[phase] for phase in
+             ('load', 'recurse', 'build', 'post', 'signature')])
+
+        # the configure before the tool was loaded is timed by waf's timer.
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        conf = mock.Mock(spec=[
+            'pre_recurse', 'post_recurse', 'store', 'bldnode', 'log_timer'])
+        conf.bldnode.abspath.return_value = folder
+        conf.log_timer.start_time = \
+            datetime.datetime.utcnow() - datetime.timedelta(seconds=2)
+        del conf.log_timer.now
+        tool.configure(conf)
+        conf.store()
+        configure = tool.read_configure_phases(folder)
+        self.assertGreaterEqual(configure['pre_tool'], 2.0)
+        self.assertGreaterEqual(configure['time'], configure['pre_tool'])
+
+    def test_link_map(self):
+        """Test reading the map files of GNU ld, gold and lld."""
+        tool = load_tool()
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+
+        gnu = (
+            'Discarded input sections\n\n'
+            ' .text          0x0000000000000000       0x10 unused.o\n\n'
+            '{}\n\n'
+            '.text           0x0000000000401000      0x100\n'
+            ' *(.text.unlikely .text.*_unlikely)\n'
+            ' .text          0x0000000000401000       0x20 main.o\n'
+            '                0x0000000000401000                main\n'
+            ' .text._ZN3foo3barEv\n'
+            '                0x0000000000401020      0x400 libfoo.a(bar.o)\n'
+            '                0x0000000000401020                foo::bar()\n'
+            ' *fill*         0x0000000000401420        0x4 \n'
+            ' COMMON         0x0000000000402000      0x800 libfoo.a(baz.o)\n'
+            ' .debug_info    0x0000000000000000     0x1000 main.o\n')
+        lld = (
+            '             VMA              LMA     Size Align Out     In      '
+            'Symbol\n'
+            '          201000           201000      420    16 .text\n'
+            '          201000           201000       20     1         '
+            'main.o:(.text)\n'
+            '          201000           201000        0     1                 '
+            'main\n'
+            '          201020           201020      400     1         '
+            'libfoo.a(bar.o):(.text._ZN3foo3barEv)\n'
+            '          202000           202000      800     1         '
+            'libfoo.a(baz.o):(COMMON)\n'
+            '               0                0     1000     1         '
+            'main.o:(.debug_info)\n')
+        expected = {
+            'objects': {'main.o': 0.03125, 'libfoo.a(bar.o)': 1.0,
+                        'libfoo.a(baz.o)': 2.0},
+            'inputs': {'main.o': 0.03125, 'libfoo.a': 3.0}}
+        for name, content in [
+                ('ld', gnu.format('Linker script and memory map')),
+                ('gold', gnu.format('Memory map')), ('lld', lld)]:
+            path = os.path.join(folder, name + '.map')
+            with open(path, 'w') as f:
+                f.write(content)
+            self.assertEqual(expected, tool.read_link_map(path), name)
+        self.assertIsNone(
+            tool.read_link_map(os.path.join(folder, 'missing.map')))
+
+        new = {'app': {
+            'objects': {'main.o': 0.5, 'libfoo.a(bar.o)': 3.5},
+            'inputs': {'main.o': 0.5, 'libfoo.a': 3.5}}}
+        self.assertEqual(
+            {'app': {
+                'inputs': [['libfoo.a', 3.0, 3.5], ['main.o', 0.03125, 0.5]],
+                'objects': [['libfoo.a(bar.o)', 1.0, 3.5],
+                            ['libfoo.a(baz.o)', 2.0, 0]]}},
+            tool.diff_link_maps({'app': expected}, new, top=2))
+
+        # static libraries are not linked.
+        task = mock.Mock()
+        task.env.DEST_BINFMT = 'elf'
+        task.outputs = [mock.Mock(
+            **{'abspath.return_value': os.path.join(folder, 'app')})]
+        env = task.env
+        run_envs = []
+        task.run = lambda: run_envs.append(task.env)
+        with mock.patch.dict(tool.link_maps, clear=True):
+            tool.add_link_map(task, 'app')
+            task.__class__ = type('cxxstlib', (mock.Mock,), {})
+            tool.add_link_map(task, 'libfoo.a')
+            self.assertEqual(
+                {'app': os.path.join(folder, 'app.map')}, tool.link_maps)
+
+        # the flag is only added while the task runs, so it is not part of
+        # the signature.
+        self.assertFalse(env.append_value.called)
+        task.run()
+        self.assertIs(env, task.env)
+        self.assertEqual([env.derive.return_value], run_envs)
+        env.derive.return_value.append_value.assert_called_once_with(
+            'LINKFLAGS', ['-Wl,-Map,' + os.path.join(folder, 'app.map')])
+
+    def test_impact(self):
+        """Test predicting the rebuild of a change from the index."""
+        tool = load_tool()
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+
+        nodes = {}
+
+        def node(path):
+            if path not in nodes:
+                nodes[path] = mock.Mock(**{
+                    'path_from.return_value': path,
+                    'bldpath.return_value': path})
+            return nodes[path]
+
+        def task(output, inputs, dep_nodes=()):
+            return mock.Mock(
+                outputs=[node(output)], inputs=[node(i) for i in inputs],
+                dep_nodes=[node(d) for d in dep_nodes],
+                **{'uid.return_value': output})
+
+        tasks = [
+            task('src/a.o', ['src/a.cpp']),
+            task('src/b.o', ['src/b.cpp']),
+            task('src/liblib.a', ['src/b.o']),
+            task('src/app', ['src/a.o'], ['src/liblib.a'])]
+        bld = mock.Mock(node_deps={
+            'src/a.o': [node('src/common.h'), node('src/a.h')],
+            'src/b.o': [node('src/common.h')]})
+        bld.bldnode.srcpath.return_value = folder
+        statistics = {
+            'src/a.o': {'time': {'value': 3.0, 'unit': 's'},
+                        'cpu_user': {'value': 2.0, 'unit': 's'},
+                        'cpu_system': {'value': 0.5, 'unit': 's'}},
+            'src/b.o': {'time': {'value': 1.0, 'unit': 's'}},
+            'src/liblib.a': {'time': {'value': 0.25, 'unit': 's'}},
+            'src/app': {'time': {'value': 0.5, 'unit': 's'}}}
+        path = os.path.join(folder, tool.dependencies_filename)
+        tool.update_dependency_index(bld, tasks, statistics)
+
+        index = tool.read_dependency_index(path)
+        self.assertEqual(
+            {'outputs': 4, 'cost': 4.25, 'unknown': [],
+             'top': [['src/a.o', 2.5], ['src/b.o', 1.0]]},
+            index.impact(['src/common.h'], top=2))
+        self.assertEqual(
+            {'outputs': 2, 'cost': 3.0, 'unknown': ['src/missing.h'],
+             'top': [['src/a.o', 2.5], ['src/app', 0.5]]},
+            index.impact(['src/a.h', 'src/missing.h']))
+        self.assertEqual(
+            [['src/common.h', 4.25, 4], ['src/a.cpp', 3.0, 2],
+             ['src/a.h', 3.0, 2], ['src/b.cpp', 1.75, 3]],
+            index.rank(top=0))
+
+        # the index is not written again when no task ran.
+        with mock.patch.object(tool, 'write_sections') as write_sections:
+            tool.update_dependency_index(bld, tasks, statistics)
+            self.assertFalse(write_sections.called)
+
+        # only the inputs of the tasks which ran are taken from waf.
+        bld.node_deps = {'src/a.o': [node('src/common.h')], 'src/b.o': []}
+        with mock.patch.dict(tool.new_build_statistics, {
+                'src/a.o': {'time': {'value': 1.0, 'unit': 's'}}}):
+            tool.update_dependency_index(bld, tasks, statistics)
+        index = tool.read_dependency_index(path)
+        self.assertEqual(
+            ['src/a.cpp', 'src/common.h'], index.inputs()['src/a.o'])
+        self.assertEqual(
+            ['src/b.cpp', 'src/common.h'], index.inputs()['src/b.o'])
+        self.assertEqual(['src/a.h'], index.impact(['src/a.h'])['unknown'])
+        node('src/a.cpp').path_from.assert_called_with(bld.srcnode)
+
 
 class TestToolLive(unittest.TestCase):
 
@@ -265,6 +1635,10 @@ class TestToolLive(unittest.TestCase):
         else:
             pass
 
+    def outputs(self, build_stats):
+        """Return the outputs in the statistics without the build entry."""
+        return set(build_stats.keys()) - set(['__build__'])
+
     def test_on_live_project(self):
         """Test tool on a live test project."""
         output = subprocess.check_output([sys.executable, 'waf', 'build'])
@@ -292,12 +1666,17 @@ class TestToolLive(unittest.TestCase):
             'src/test_project/main.cpp.1.o',
             'src/test_project/test-project']
 
-        self.assertSetEqual(set(expect_outputs), set(build_stats.keys()))
-
-        expected_results = ['time', 'size']
-        for output, results in build_stats.items():
-            self.assertSetEqual(set(expected_results), set(results.keys()))
-            for result in results:
+        self.assertSetEqual(set(expect_outputs), self.outputs(build_stats))
+
+        expected_results = ['time', 'size', 'status']
+        # the resource usage of the processes is only known on some platforms
+        optional_results = ['cpu_user', 'cpu_system', 'peak_rss']
+        for output in self.outputs(build_stats):
+            results = build_stats[output]
+            self.assertTrue(set(expected_results) <= set(results.keys()))
+            self.assertTrue(set(results.keys()) <=
+                            set(expected_results + optional_results))
+            for result in expected_results:
                 self.assertNotEqual(0, results[result]['value'])
 
         # add a file and rebuild to check that we register the event
@@ -316,7 +1695,7 @@ class TestToolLive(unittest.TestCase):
 
         self.assertIsNotNone(build_stats)
         expect_outputs.append('src/test_project/test.cpp.1.o')
-        self.assertSetEqual(set(expect_outputs), set(build_stats.keys()))
+        self.assertSetEqual(set(expect_outputs), self.outputs(build_stats))
 
         expected_output = (
             "(.|\n)*\[ FILE   \] src/test_project/test\.cpp\.1\.o \(added\)"
@@ -334,7 +1713,7 @@ class TestToolLive(unittest.TestCase):
 
         self.assertIsNotNone(build_stats)
         expect_outputs.remove('src/test_project/test.cpp.1.o')
-        self.assertSetEqual(set(expect_outputs), set(build_stats.keys()))
+        self.assertSetEqual(set(expect_outputs), self.outputs(build_stats))
 
         expected_output = (
             "(.|\n)*\[ FILE   \] src/test_project/test\.cpp\.1\.o \(removed\)"
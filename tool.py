@@ -7,152 +7,3678 @@ File containing functionality related to build statistics.
 This file injects itself into the waf build process and extract various data.
 This data is located in the root of the build folder as a json file named
 build_statistics.json.
+Every build is also appended to an append-only history store next to it, so
+trends can be followed over many builds.
 Finally a summary is printed if any non-trivial changes occured.
 """
 
 from waflib import TaskGen
+from waflib import Context
+from waflib import Options
+from waflib import Task
 from waflib import Logs
+from waflib import Utils
+import array
+import atexit
+import bisect
+import collections
+import csv
+import datetime
+import fnmatch
+import gc
+import glob
+import hashlib
+import heapq
+import io
+import itertools
+import subprocess
+import sys
+import threading
 import time
+import types
 import json
+import mmap
 import os
+import re
+import struct
+from multiprocessing.pool import ThreadPool
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
 filename = 'build_statistics.json'
+compact_filename = 'build_statistics.bin'
+compact_magic = b'WBS\x01'
+dependencies_magic = b'WBD\x01'
+elf_magic = b'\x7fELF'
+trace_filename = 'build_trace.json'
+time_trace_filename = 'build_statistics.timetrace.json'
+html_filename = 'build_statistics.html'
+configure_phases_filename = 'build_statistics.configure.json'
+dependencies_filename = 'build_statistics.deps'
+history_filename = 'build_statistics.history'
+history_index_filename = history_filename + '.index'
+history_outputs_filename = history_filename + '.outputs'
+journal_filename = 'build_statistics.journal'
+baseline_filename = 'build_statistics.baseline'
+baseline_index_filename = baseline_filename + '.index'
+
+# key holding the information about the build as a whole, as opposed to the
+# per output statistics.
+build_key = '__build__'
+
+# every n'th build is stored in full so that a build can be reconstructed
+# without replaying the complete history.
+history_checkpoint_interval = 50
+
+# default number of builds in the regression baselines, and the number of
+# measurements a baseline needs before it is used.
+regression_window = 20
+regression_min_samples = 10
+
+# default number of robust standard deviations a measurement must differ from
+# its baseline to be flagged as a regression, for time stats and for all
+# other stats.
+time_sensitivity = 4.0
+size_sensitivity = 3.0
+
+# smallest standard deviation, relative to the median, used for a baseline.
+# Stops very stable outputs from being flagged for negligible changes.
+time_relative_floor = 0.05
+size_relative_floor = 0.001
+
+
+# the policies for resolving the conflicting records of merged statistics.
+merge_policies = ('latest', 'min', 'median')
+
+# the percentiles of the distributions of merged statistics.
+merge_percentiles = (50, 90)
+
+# the number of values of the inputs kept in memory by merge_statistics,
+# above which the outputs are merged in several passes.
+merge_value_budget = 1 << 24
+
+# the fraction of the total below which the nodes of the html report are
+# merged, see report_tree.
+html_min_fraction = 0.0005
+
+# the suffix of the compact index of json statistics, see open_statistics.
+index_suffix = '.index'
+
+old_build_statistics = {}
+new_build_statistics = {}
+
+# whether the past statistics were read for this build.
+statistics_read = False
+
+# absolute paths of the outputs of the wrapped tasks.
+output_paths = {}
+
+# the largest symbols of the linked binaries, when reading ELF files.
+output_symbols = {}
+
+# the map files of the linked binaries, and the contribution of each input
+# to the binaries, when reading the maps.
+link_maps = {}
+output_link_maps = {}
+
+# the task generator and the kind of each output, used to roll up the
+# summary. The kind is object or binary for compiled and link tasks,
+# otherwise the class of the task.
+output_owners = {}
+
+# the wrapped tasks, in the order they were wrapped, and their ids.
+wrapped_tasks = []
+wrapped_ids = set()
+
+# the journal of the running build, only used in journal mode.
+journal = None
+
+# monotonic high resolution clock used for measuring wall time.
+clock = getattr(time, 'perf_counter', time.time)
+
+# resource usage of the child processes started by the task running on the
+# current thread.
+accounting = threading.local()
+
+# whether the lack of accounting on this platform has been logged.
+accounting_logged = False
+
+# clock value at the start of the build, timestamps are relative to it.
+build_start = None
+
+# each worker thread records the tasks it runs in its own buffer, the
+# buffers are merged when the build has finished.
+recorder = threading.local()
+record_buffers = []
+
+# the merged records of the tasks run, ordered by start time.
+task_records = []
+
+# serial numbers of the wrapped tasks.
+task_serials = itertools.count()
+
+# the scheduling mode and the priority of each task, when prioritising.
+schedule_mode = None
+task_priorities = {}
+
+# the live estimate of the remaining time of the build, if enabled.
+progress = None
+
+# the background sampler of the system resources, if enabled. False if
+# sampling is not supported.
+sampler = None
+
+# the timings of the phases of waf, see Phases.
+phases = None
+
+
+def setup(bld):
+    """
+    Hook into the build context.
+
+    This function is called by waf when the tool is loaded for a build,
+    before the build has started. The build iterator is wrapped so the
+    tasks can be scheduled by their historical durations, and so tasks
+    created outside of the task generators are measured too. The phases of
+    waf before and around the tasks are timed from here.
+    """
+    reset_build()
+    install_phases(bld)
+
+    get_build_iterator = bld.get_build_iterator
+
+    def build_iterator():
+        return schedule_tasks(bld, get_build_iterator())
+    bld.get_build_iterator = build_iterator
+
+
+def reset_build():
+    """
+    Forget the state of the previous build.
+
+    waf runs several build commands in one process, e.g. waf build install,
+    with the tool loaded once, so each build starts from scratch. The record
+    buffers belong to the worker threads, which waf keeps for the next
+    build, so they are emptied rather than replaced. The journal of a build
+    which failed is kept, to be recovered by the next build.
+    """
+    global old_build_statistics, statistics_read, journal, build_start
+    global schedule_mode, progress, sampler, phases
+    close_statistics(old_build_statistics)
+    old_build_statistics = {}
+    statistics_read = False
+    for state in (new_build_statistics, output_paths, output_symbols,
+                  link_maps, output_link_maps, output_owners, wrapped_ids,
+                  task_priorities):
+        state.clear()
+    del wrapped_tasks[:]
+    del task_records[:]
+    for buffer in record_buffers:
+        del buffer[:]
+
+    if journal is not None:
+        journal.close()
+        journal = None
+    if sampler:
+        sampler.stop()
+    build_start = None
+    schedule_mode = None
+    progress = None
+    sampler = None
+    phases = None
+
+
+def configure(conf):
+    """
+    Time the configure.
+
+    This function is called by waf when the tool is loaded for a configure.
+    The wscripts recursed into from then on are timed, and the time of the
+    configure before the tool was loaded is taken from the timer waf starts
+    with each command, as pre_tool. The timings are saved in the build
+    folder when the configuration is stored, to be stored with the
+    statistics of the next build.
+    """
+    timings = Phases()
+    timings.hook(conf)
+    pre_tool = command_time(conf)
+    store = conf.store
+
+    def store_timings():
+        store()
+        report = timings.report()
+        report = {
+            'time': report['load'] + report['recurse'] + report['build'],
+            'wscripts': report['wscripts']}
+        if pre_tool is not None:
+            report['pre_tool'] = pre_tool
+            report['time'] += pre_tool
+        path = os.path.join(conf.bldnode.abspath(), configure_phases_filename)
+        with open(path, 'w') as f:
+            json.dump(report, f)
+    conf.store = store_timings
+
+
+def command_time(ctx):
+    """Return the seconds since waf started the command, or None."""
+    timer = getattr(ctx, 'log_timer', None)
+    start = getattr(timer, 'start_time', None)
+    if start is None:
+        return None
+    # waf times its commands with either datetimes or a performance counter.
+    now = timer.now() if hasattr(timer, 'now') else \
+        datetime.datetime.utcnow()
+    elapsed = now - start
+    if isinstance(elapsed, datetime.timedelta):
+        return elapsed.total_seconds()
+    return elapsed
+
+
+def options(opt):
+    """
+    Add the options of the statistics commands.
+
+    waf registers the commands when the tool is loaded, so the tool must be
+    loaded in options for the commands to be available.
+    """
+    group = opt.add_option_group('Build statistics')
+    group.add_option(
+        '--statistics-inputs', default='',
+        help='comma separated statistics files or glob patterns to merge')
+    group.add_option(
+        '--statistics-output', default='build_statistics.merged.json',
+        help='file to write the merged statistics to, in the compact format '
+             'if it ends with .bin [default: %default]')
+    group.add_option(
+        '--merge-policy', default='latest', choices=merge_policies,
+        help='how conflicting records of an output are resolved: latest, '
+             'min or median [default: %default]')
+    group.add_option(
+        '--merge-distributions', action='store_true', default=False,
+        help='add the distribution of every stat across the inputs')
+    group.add_option(
+        '--merge-shards', type='int', default=0,
+        help='number of passes over the inputs, 0 to choose from the size '
+             'of the inputs [default: %default]')
+    group.add_option(
+        '--merge-jobs', type='int', default=8,
+        help='number of inputs read in parallel [default: %default]')
+    group.add_option(
+        '--stats-file', default='',
+        help='statistics file, or build id of the history, to query '
+             '[default: the statistics of the build folder]')
+    group.add_option(
+        '--stats-compare', default='',
+        help='statistics file, or build id of the history, to diff with, '
+             'e.g. -2 for the build before the latest')
+    group.add_option(
+        '--stats-glob', default=None,
+        help='glob pattern of the outputs to query, e.g. src/foo/*.o')
+    group.add_option(
+        '--stats-stat', default='time',
+        help='stat to filter and sort by [default: %default]')
+    group.add_option(
+        '--stats-threshold', type='float', default=None,
+        help='minimum value of the stat, or of its difference when diffing')
+    group.add_option(
+        '--stats-sort', default=None,
+        help='sort by a stat, difference, percent or file '
+             '[default: the stat]')
+    group.add_option(
+        '--stats-top', type='int', default=0,
+        help='number of outputs to show, 0 for all [default: %default]')
+    group.add_option(
+        '--stats-format', default='text', choices=('text', 'json', 'csv'),
+        help='output format: text, json or csv [default: %default]')
+    group.add_option(
+        '--impact-files', default='',
+        help='comma separated files to predict the rebuild of, - to read '
+             'them from stdin, or none to rank the files by their rebuild')
+    group.add_option(
+        '--impact-top', type='int', default=10,
+        help='number of outputs or files to show, 0 for all '
+             '[default: %default]')
+    group.add_option(
+        '--impact-budget', type='float', default=None,
+        help='fail if the rebuild costs more seconds than this')
+    group.add_option(
+        '--impact-format', default='text', choices=('text', 'json'),
+        help='output format: text or json [default: %default]')
+
+
+@TaskGen.feature('*')
+@TaskGen.before_method('process_source')
+def get_data(self):
+    """
+    Read past build statistics.
+
+    Before processing any sources read the past build statistics. If a
+    previous build was interrupted in journal mode, the measurements in its
+    journal are recovered first. The sampling of the system resources is
+    started here, if enabled.
+    """
+    global old_build_statistics, statistics_read
+    if sampler is None and self.bld.has_tool_option('sample'):
+        start_sampler(self.bld)
+
+    # the journal is recovered before this build opens its own.
+    if not statistics_read:
+        statistics_read = True
+        folder = self.bld.bldnode.srcpath()
+        statistics_format = get_statistics_format(self.bld)
+        recover_journal(folder, statistics_format)
+        f = find_statistics(folder, statistics_format)
+        if f is not None:
+            old_build_statistics = load_statistics(f)
+
+
+@TaskGen.feature('*')
+@TaskGen.after_method('process_source')
+def collect_data_from_tasks(self):
+    """
+    Wrap tasks to collect information from them.
+
+    This function wraps every task of the task generator, whatever its
+    class, with the collect_data_from_run function so that the needed data
+    is collected.
+    """
+    global build_start
+    if build_start is None:
+        build_start = clock()
+
+    if journal is None and self.bld.has_tool_option('journal'):
+        open_journal(self.bld)
+
+    global progress
+    if progress is None and self.bld.has_tool_option('eta'):
+        interval = self.bld.get_tool_option('eta')
+        interval = 2.0 if interval is True else float(interval)
+        progress = Progress(self.bld.jobs, interval)
+
+    install_accounting()
+
+    kinds = {}
+    for task in getattr(self, 'compiled_tasks', []):
+        kinds[id(task)] = 'object'
+    if getattr(self, 'link_task', None) is not None:
+        kinds[id(self.link_task)] = 'binary'
+
+    for task in self.tasks:
+        wrap_task(task, kinds.get(id(task)))
+
+    link_task = getattr(self, 'link_task', None)
+    if link_task is not None and link_task.outputs and \
+            self.bld.has_tool_option('link_map'):
+        add_link_map(link_task, link_task.outputs[0].bldpath())
+
+    if 'post_funs' not in dir(self.bld) or get_sizes not in self.bld.post_funs:
+        self.bld.add_post_fun(get_sizes)
+
+    if 'post_funs' not in dir(self.bld) or save_data not in self.bld.post_funs:
+        self.bld.add_post_fun(save_data)
+
+
+def wrap_task(task, kind=None):
+    """
+    Wrap a task with collect_data_from_run, unless it is already wrapped.
+
+    The statistics of a task are stored under each of its outputs, or under
+    its name if it has none, e.g. a rule without a target. Install tasks
+    are not wrapped, as they copy the outputs of the build.
+    """
+    if id(task) in wrapped_ids or is_install_task(task):
+        return
+    wrapped_ids.add(id(task))
+    task.run = collect_data_from_run(task.run, task)
+    wrapped_tasks.append(task)
+    if progress is not None:
+        progress.add(task)
+
+    generator = generator_name(task.generator)
+    if kind is None:
+        kind = task.__class__.__name__
+    for key in task_keys(task):
+        new_build_statistics[key] = {}
+        output_owners[key] = (generator, kind)
+
+
+def is_install_task(task):
+    """Return True if the task installs files, as the install tasks of waf."""
+    return task.__class__.__name__ == 'inst'
+
+
+def generator_name(generator):
+    """
+    Return the name of a task generator.
+
+    The name defaults to the target. The install tasks of waf are their own
+    task generator without a name, they are named by their destination, and
+    any other task generator without a name by its folder.
+    """
+    name = getattr(generator, 'name', None) or \
+        getattr(generator, 'target', None)
+    if name:
+        return str(name)
+    if getattr(generator, 'dest', None):
+        return 'install {}'.format(generator.dest)
+    path = getattr(generator, 'path', None)
+    return path.relpath() if path is not None else ''
+
+
+def task_keys(task):
+    """Return the keys the statistics of a task are stored under."""
+    if task.outputs:
+        return [output.bldpath() for output in task.outputs]
+    return [task_name(task)]
+
+
+def get_sizes(self):
+    """
+    Collect sizes of all output generated by tasks.
+
+    The outputs of tasks which ran are measured by the worker thread as soon
+    as the task finishes. The outputs of tasks which did not run have not
+    changed, so their sizes are taken from the previous build. Only the
+    remaining outputs are measured here, using a pool of threads. The
+    section sizes and hashes of the outputs are also collected, if enabled.
+    """
+    merge_records()
+
+    missing = []
+    for key, stats in new_build_statistics.items():
+        if 'size' in stats or key not in output_paths:
+            # tasks without outputs have no size.
+            continue
+        old_stats = old_build_statistics.get(key, {})
+        if 'time' not in stats and 'size' in old_stats:
+            stats['size'] = old_stats['size']
+        else:
+            missing.append(key)
+
+    sizes = measure_sizes([output_paths[key] for key in missing])
+    for key, value in zip(missing, sizes):
+        if value is not None:
+            new_build_statistics[key]['size'] = {'value': value, 'unit': 'kb'}
+
+    # only the outputs which were rebuilt can have changed.
+    rebuilt = [key for key, stats in new_build_statistics.items()
+               if 'time' in stats and key in output_paths]
+
+    if self.has_tool_option('sections'):
+        symbols = 0
+        if self.has_tool_option('symbols'):
+            symbols = self.get_tool_option('symbols')
+            symbols = 10 if symbols is True else int(symbols)
+        measure_sections(rebuilt, symbols)
+
+    if link_maps:
+        measure_link_maps(rebuilt)
+
+    if self.has_tool_option('fingerprint'):
+        hashes = hash_files([output_paths[key] for key in rebuilt])
+        for key, value in zip(rebuilt, hashes):
+            if value is not None:
+                new_build_statistics[key]['hash'] = {
+                    'value': value, 'unit': ''}
+
+
+def measure_size(path):
+    """Return the size of a file in kb, or None if it does not exist."""
+    try:
+        return os.path.getsize(path) / 1024.0
+    except OSError:
+        return None
+
+
+def measure_sizes(paths, threads=16, chunk_size=64):
+    """
+    Return the sizes of the files in kb.
+
+    The files are measured in chunks by a pool of threads, which hides the
+    latency of stat calls on networked file systems.
+    """
+    return map_paths(measure_size, paths, threads, chunk_size)
+
+
+def map_paths(function, paths, threads=16, chunk_size=64):
+    """Call a function on each path, in chunks by a pool of threads."""
+    if len(paths) <= chunk_size:
+        return [function(path) for path in paths]
+    pool = ThreadPool(min(threads, len(paths) // chunk_size + 1))
+    try:
+        return pool.map(function, paths, chunk_size)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def hash_file(path, mmap_size=1 << 20):
+    """
+    Return the sha1 hash of a file, or None if it does not exist.
+
+    Files larger than mmap_size are memory mapped and hashed in place, so
+    large binaries are not copied into memory.
+    """
+    h = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size > mmap_size:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    h.update(data)
+                finally:
+                    data.close()
+            else:
+                h.update(f.read())
+    except (IOError, OSError):
+        return None
+    return h.hexdigest()
+
+
+def measure_sections(keys, symbols=0):
+    """
+    Measure the section sizes of the outputs which are ELF files.
+
+    The outputs which were rebuilt, given as keys, are read, as are outputs
+    without section sizes in the previous build. For linked binaries the
+    largest symbols are kept too, if symbols is given.
+    """
+    keys = set(keys)
+    for key, stats in new_build_statistics.items():
+        if key in output_paths and 'time' not in stats and \
+                'size_text' not in old_build_statistics.get(key, {}):
+            keys.add(key)
+    keys = sorted(keys)
+
+    items = []
+    for key in keys:
+        binary = output_owners.get(key, ('', None))[1] == 'binary'
+        items.append((output_paths[key], symbols if binary else 0))
+    results = map_paths(lambda item: read_elf(*item), items, chunk_size=16)
+
+    for key, result in zip(keys, results):
+        if result is None:
+            continue
+        sizes, top = result
+        stats = new_build_statistics[key]
+        for stat, value in sizes.items():
+            stats[stat] = {'value': value, 'unit': 'kb'}
+        if top:
+            output_symbols[key] = top
+
+
+# the stat each kind of ELF section is counted in.
+elf_section_stats = [
+    ('.text', 'size_text'),
+    ('.data', 'size_data'),
+    ('.rodata', 'size_rodata'),
+    ('.bss', 'size_bss')]
+
+
+def elf_section_stat(name):
+    """Return the stat an ELF section is counted in, or None."""
+    if name.startswith(('.debug', '.zdebug')):
+        return 'size_debug'
+    for prefix, stat in elf_section_stats:
+        # e.g. .text.main with -ffunction-sections, or .rodata.str1.1
+        if name == prefix or name.startswith(prefix + '.'):
+            return stat
+    return None
+
+
+def read_elf(path, symbols=0):
+    """
+    Read the section sizes of an ELF file, and optionally its largest symbols.
+
+    The file is memory mapped and only the section headers, and the symbol
+    table if symbols are wanted, are read. Returns a dict with the size in kb
+    of the code, data, read-only data, bss and debug sections, and a list of
+    the largest symbols as [name, size in kb]. Returns None if the file is not
+    an ELF file.
+    """
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(elf_magic)) != elf_magic:
+                return None
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        return None
+    try:
+        return _read_elf(data, symbols)
+    except (struct.error, IndexError):
+        # a truncated or corrupt file.
+        return None
+    finally:
+        data.close()
+
+
+def _read_elf(data, symbols):
+    """Read the sections, and symbols, of a mapped ELF file."""
+    elf_class, encoding = struct.unpack_from('BB', data, 4)
+    order = '<' if encoding == 1 else '>'
+    if elf_class == 2:
+        offset, = struct.unpack_from(order + 'Q', data, 0x28)
+        entry_size, count, names_index = \
+            struct.unpack_from(order + 'HHH', data, 0x3a)
+        section = struct.Struct(order + 'IIQQQQIIQQ')
+    else:
+        offset, = struct.unpack_from(order + 'I', data, 0x20)
+        entry_size, count, names_index = \
+            struct.unpack_from(order + 'HHH', data, 0x2e)
+        section = struct.Struct(order + 'IIIIIIIIII')
+
+    sizes = dict((stat, 0) for _, stat in elf_section_stats)
+    sizes['size_debug'] = 0
+    if not offset:
+        return sizes, []
+
+    # files with many sections store the count and the index of the names in
+    # the first section header.
+    first = section.unpack_from(data, offset)
+    if count == 0:
+        count = first[5]
+    if names_index == 0xffff:
+        names_index = first[6]
+
+    headers = [section.unpack_from(data, offset + i * entry_size)
+               for i in range(count)]
+    names = headers[names_index][4]
+    for header in headers:
+        stat = elf_section_stat(_elf_string(data, names + header[0]))
+        if stat is not None:
+            sizes[stat] += header[5]
+    sizes = dict((stat, size / 1024.0) for stat, size in sizes.items())
+
+    top = []
+    if symbols:
+        for header in headers:
+            # SHT_SYMTAB, the symbol table of an unstripped file.
+            if header[1] == 2:
+                top = _elf_symbols(
+                    data, header, headers[header[6]][4], elf_class, order,
+                    symbols)
+    return sizes, top
+
+
+def _elf_symbols(data, header, strings, elf_class, order, count):
+    """Return the largest function and object symbols of a symbol table."""
+    if elf_class == 2:
+        symbol = struct.Struct(order + 'IBBHQQ')
+    else:
+        symbol = struct.Struct(order + 'IIIBBH')
+    entry_size = header[9] or symbol.size
+    start = header[4]
+    stop = start + header[5] - symbol.size
+
+    candidates = []
+    for position in range(start, stop + 1, entry_size):
+        fields = symbol.unpack_from(data, position)
+        if elf_class == 2:
+            name, info, size = fields[0], fields[1], fields[5]
+        else:
+            name, size, info = fields[0], fields[2], fields[3]
+        # STT_OBJECT and STT_FUNC
+        if size and info & 0xf in (1, 2):
+            candidates.append((size, name))
+    return [[_elf_string(data, strings + name), size / 1024.0]
+            for size, name in heapq.nlargest(count, candidates)]
+
+
+def _elf_string(data, offset):
+    """Return the null terminated string at an offset."""
+    return data[offset:data.find(b'\0', offset)].decode('utf-8', 'replace')
+
+
+def add_link_map(task, key):
+    """
+    Make a link task write a map file next to its output.
+
+    GNU ld, gold and lld write the map with -Map. The flag is only added to
+    the environment of the task while it runs, so it is not part of the
+    signature of the task and enabling the option does not relink anything.
+    Static libraries are not linked and have no map, and only ELF linkers
+    are supported.
+    """
+    if task.__class__.__name__.endswith('stlib') or \
+            task.env.DEST_BINFMT != 'elf':
+        return
+    path = task.outputs[0].abspath() + '.map'
+    run = task.run
+
+    def run_with_link_map():
+        env = task.env
+        task.env = env.derive()
+        task.env.append_value('LINKFLAGS', ['-Wl,-Map,' + path])
+        try:
+            return run()
+        finally:
+            task.env = env
+
+    task.run = run_with_link_map
+    link_maps[key] = path
+
+
+def read_link_map(path):
+    """
+    Read how much each input of a linked binary contributes to it.
+
+    The map files of GNU ld and gold, and of lld, are read a line at a time.
+    Only the lines of input sections are split, and the sections which are
+    not loaded, e.g. the debug information, are not counted. Returns the
+    sizes in kb of each object, e.g. libfoo.a(foo.o), and of each input,
+    i.e. each archive and object given to the linker, or None if there is
+    no map.
+    """
+    try:
+        f = io.open(path, encoding='utf-8', errors='replace')
+    except (IOError, OSError):
+        return None
+    with f:
+        header = f.readline()
+        if header.split()[:1] in (['VMA'], ['Address']):
+            sizes = _read_lld_map(f, header.split().index('Size'))
+        else:
+            sizes = _read_gnu_map(f)
+
+    objects = {}
+    inputs = {}
+    for name, size in sizes.items():
+        if name.endswith(')') and '(' in name:
+            # an object of an archive, e.g. libfoo.a(foo.o).
+            archive = os.path.normpath(name[:name.rindex('(')])
+            name = archive + name[name.rindex('('):]
+        else:
+            archive = name = os.path.normpath(name)
+        objects[name] = objects.get(name, 0) + size / 1024.0
+        inputs[archive] = inputs.get(archive, 0) + size / 1024.0
+    return {'objects': objects, 'inputs': inputs}
+
+
+# input sections which are not loaded, and do not count as contributions.
+unloaded_sections = ('.debug', '.zdebug', '.comment', '.stab', '.note.GNU')
+
+
+def _read_gnu_map(f):
+    """
+    Read the sizes of the input sections in a GNU ld or gold map file.
+
+    An input section is listed as its name, address, size and file, where
+    a long name is on a line of its own. The lines of the symbols, which are
+    the majority, start with an address and are skipped without splitting.
+    """
+    sizes = {}
+    for line in f:
+        if line.startswith(('Linker script and memory map', 'Memory map')):
+            break
+    section = None
+    for line in f:
+        if section is None and not line.startswith((' .', ' COMMON')):
+            continue
+        fields = line.split()
+        if section is None:
+            if len(fields) == 1:
+                section = fields[0]
+                continue
+            if len(fields) < 4 or not fields[2].startswith('0x'):
+                continue
+            section, size, name = fields[0], fields[2], fields[3:]
+        elif len(fields) >= 3 and fields[1].startswith('0x'):
+            size, name = fields[1], fields[2:]
+        else:
+            section = None
+            continue
+        if not section.startswith(unloaded_sections):
+            name = ' '.join(name)
+            sizes[name] = sizes.get(name, 0) + int(size, 16)
+        section = None
+    return sizes
+
+
+def _read_lld_map(f, size_column):
+    """
+    Read the sizes of the input sections in an lld map file.
+
+    Every line starts with the addresses, size and alignment in hex, and is
+    followed by an output section, an input section as file:(section), or
+    a symbol.
+    """
+    sizes = {}
+    for line in f:
+        if ':(' not in line:
+            continue
+        fields = line.split(None, size_column + 2)
+        name, _, section = fields[-1].rstrip().rpartition(':(')
+        if not section.startswith(unloaded_sections):
+            sizes[name] = sizes.get(name, 0) + int(fields[size_column], 16)
+    return sizes
+
+
+def measure_link_maps(keys):
+    """
+    Read the map files of the linked binaries.
+
+    The maps of the binaries which were relinked, given as keys, are read.
+    The contributions of the other binaries have not changed and are taken
+    from the previous build, if it has them.
+    """
+    old_maps = (old_build_statistics.get(build_key) or {}).get(
+        'link_maps', {})
+    keys = set(keys)
+    for key in link_maps:
+        if key in old_maps and key not in keys:
+            output_link_maps[key] = old_maps[key]
+    keys = sorted(key for key in link_maps if key not in output_link_maps)
+    results = map_paths(
+        read_link_map, [link_maps[key] for key in keys], chunk_size=1)
+    for key, result in zip(keys, results):
+        if result is not None:
+            output_link_maps[key] = result
+
+
+def diff_link_maps(old, new, top=10):
+    """
+    Return the inputs whose contribution to each binary changed most.
+
+    Returns, for each binary whose contributions changed, the top changed
+    inputs and objects as [name, old, new], with 0 for a name which is not
+    in one of the builds.
+    """
+    changes = {}
+    for key, contributions in new.items():
+        if key not in old:
+            continue
+        changed = {}
+        for kind in ('inputs', 'objects'):
+            a = old[key][kind]
+            b = contributions[kind]
+            differences = [
+                [name, a.get(name, 0), b.get(name, 0)]
+                for name in set(a) | set(b)
+                if abs(b.get(name, 0) - a.get(name, 0)) > 1e-6]
+            if differences:
+                changed[kind] = heapq.nlargest(
+                    top, differences, key=lambda d: abs(d[2] - d[1]))
+        if changed:
+            changes[key] = changed
+    return changes
+
+
+def print_link_maps(changes):
+    """Print the changes of the contributions to the linked binaries."""
+    for key, changed in sorted(changes.items()):
+        Logs.pprint('BOLD', '[ LINK   ] {}'.format(key))
+        for kind in ('inputs', 'objects'):
+            for name, old, new in changed.get(kind, []):
+                color = 'PINK' if new > old else 'CYAN'
+                Logs.pprint(color, '[        ]  {} {:0.3f} -> {:0.3f} kb '
+                            '({:+0.3f} kb)'.format(name, old, new, new - old))
+
+
+def hash_files(paths, threads=16, chunk_size=4):
+    """
+    Return the hashes of the files.
+
+    hashlib releases the GIL while hashing, so the files are hashed in
+    parallel by a pool of threads.
+    """
+    return map_paths(hash_file, paths, threads, chunk_size)
+
+
+def collect_data_from_run(f, task):
+    """
+    Collect compile time from task.
+
+    Besides the wall time, the user and system cpu time and the peak
+    resident memory of the child processes started by the task are
+    collected, if available.
+
+    Everything which does not depend on the run is prepared up front, and
+    the measurements are appended to a buffer owned by the worker thread, so
+    the overhead of a run is small and constant and no locks are taken.
+    """
+    serial = task.statistics_serial = next(task_serials)
+    keys = task_keys(task)
+    paths = [output.abspath() for output in task.outputs]
+    output_paths.update(zip(keys, paths))
+
+    def wrap_run():
+        accounting.usage = usage = []
+        start = clock()
+        if progress is not None:
+            progress.start(task, start)
+        try:
+            return_value = f()
+        finally:
+            accounting.usage = None
+        stop = clock()
+        if progress is not None:
+            progress.stop(task)
+
+        stats = {'time': {'value': stop - start, 'unit': 's'}}
+        if usage:
+            stats['cpu_user'] = {
+                'value': sum(u.ru_utime for u in usage), 'unit': 's'}
+            stats['cpu_system'] = {
+                'value': sum(u.ru_stime for u in usage), 'unit': 's'}
+            stats['peak_rss'] = {
+                'value': max(u.ru_maxrss for u in usage) / maxrss_per_kb,
+                'unit': 'kb'}
+
+        # measure the outputs while they are likely to be in the cache.
+        sizes = None
+        if not return_value:
+            sizes = [measure_size(path) for path in paths]
+
+        try:
+            records = recorder.records
+        except AttributeError:
+            records = get_record_buffer()
+        records.append(
+            (start, serial, recorder.worker, stop, keys, stats, sizes))
+
+        # failed tasks are run again, so they are not recovered.
+        if journal is not None and not return_value:
+            journal.append(keys, stats, recorder.worker, start, stop, sizes)
+
+        return return_value
+    return wrap_run
+
+
+def get_record_buffer():
+    """Create the record buffer of the current worker thread."""
+    recorder.worker = threading.current_thread().name
+    recorder.records = []
+    # appending to a list is atomic, hence no lock is needed.
+    record_buffers.append(recorder.records)
+    return recorder.records
+
+
+def merge_records():
+    """
+    Merge the records of the worker threads into the statistics.
+
+    The records are merged ordered by start time and task, so the result
+    does not depend on which worker ran which task. Must only be called
+    when no tasks are running.
+    """
+    records = []
+    for buffer in record_buffers:
+        records.extend(buffer)
+        del buffer[:]
+    records.sort(key=lambda record: record[:2])
+
+    for start, serial, worker, stop, keys, stats, sizes in records:
+        for i, key in enumerate(keys):
+            output_stats = new_build_statistics.setdefault(key, {})
+            output_stats.update(stats)
+            if sizes and sizes[i] is not None:
+                output_stats['size'] = {'value': sizes[i], 'unit': 'kb'}
+
+    task_records.extend(records)
+    task_records.sort(key=lambda record: record[:2])
+    return task_records
+
+
+def summarize_workers(records):
+    """Summarize the utilisation of the worker threads."""
+    if not records:
+        return {}
+    start = min(record[0] for record in records)
+    stop = max(record[3] for record in records)
+    span = stop - start
+
+    workers = {}
+    for record in records:
+        worker = workers.setdefault(record[2], {'tasks': 0, 'busy': 0.0})
+        worker['tasks'] += 1
+        worker['busy'] += record[3] - record[0]
+
+    busy = sum(worker['busy'] for worker in workers.values())
+    return {
+        'span': span,
+        'workers': workers,
+        'utilisation': busy / (span * len(workers)) if span else 0.0}
+
+
+def task_status(task, ran):
+    """
+    Return the status of a task after the build.
+
+    A task either ran, was served from a waf cache, was skipped as it was up
+    to date, failed, or was not run at all, e.g. as the build stopped
+    before it. ran is whether the task has been recorded running.
+    """
+    # waf caches mark the tasks whose outputs they retrieve.
+    if getattr(task, 'cached', False) is True:
+        return 'cached'
+    if task.hasrun == Task.SKIPPED:
+        return 'skipped'
+    if task.hasrun in (Task.MISSING, Task.CRASHED, Task.EXCEPTION):
+        return 'failed'
+    return 'ran' if ran else 'not_run'
+
+
+def classify_tasks(tasks, records):
+    """
+    Store the status of each task and summarize the build's incrementality.
+
+    The status is stored as a stat of the outputs of each task. The time
+    saved by a skipped task is its time in the previous build, and by a
+    cached task the difference between that time and the time it took to
+    retrieve the outputs. The rebuild ratio is the share of the tasks which
+    ran, out of those which ran, were skipped or were cached.
+    """
+    ran = set(record[1] for record in records)
+    summary = {'ran': 0, 'cached': 0, 'skipped': 0, 'failed': 0,
+               'not_run': 0, 'time_saved': 0.0, 'cache_time_saved': 0.0}
+    for task in tasks:
+        status = task_status(task, task.statistics_serial in ran)
+        summary[status] += 1
+        keys = task_keys(task)
+        for key in keys:
+            new_build_statistics.setdefault(key, {})['status'] = {
+                'value': status, 'unit': ''}
+
+        if status not in ('skipped', 'cached'):
+            continue
+        old_times = [old_build_statistics[key]['time']['value']
+                     for key in keys
+                     if 'time' in old_build_statistics.get(key, {})]
+        if not old_times:
+            continue
+        if status == 'skipped':
+            summary['time_saved'] += max(old_times)
+        else:
+            saved = max(old_times) - new_build_statistics[keys[0]].get(
+                'time', {'value': 0.0})['value']
+            summary['cache_time_saved'] += max(saved, 0.0)
+
+    done = summary['ran'] + summary['skipped'] + summary['cached']
+    summary['rebuild_ratio'] = summary['ran'] / float(done) if done else 0.0
+    return summary
+
+
+def find_identical(old_statistics, new_statistics, top=10):
+    """
+    Find the outputs which were rebuilt but did not change.
+
+    An output is identical if its hash is the same as in the previous build,
+    though its task ran. Outputs retrieved from a cache are not counted.
+    Returns the number of identical outputs, the time spent rebuilding them
+    and the top outputs by time.
+    """
+    identical = []
+    for key, stats in new_statistics.items():
+        if 'hash' not in stats or 'time' not in stats:
+            continue
+        if stats.get('status', {}).get('value') == 'cached':
+            continue
+        old_hash = old_statistics.get(key, {}).get('hash')
+        if old_hash is None:
+            continue
+        if old_hash['value'] == stats['hash']['value']:
+            identical.append((stats['time']['value'], key))
+    return {
+        'outputs': len(identical),
+        'time': sum(duration for duration, _ in identical),
+        'top': [[key, duration]
+                for duration, key in heapq.nlargest(top, identical)]}
+
+
+def print_identical(identical):
+    """Print the outputs which were rebuilt identical, longest first."""
+    if not identical['outputs']:
+        return
+    Logs.pprint('BOLD', '[ SAME   ] {outputs} outputs were rebuilt identical '
+                'to the previous build, taking {time:0.3f} s'.format(
+                    **identical))
+    for key, duration in identical['top']:
+        Logs.pprint('PINK', '[        ]  {} {:0.3f} s'.format(key, duration))
+
+
+def print_tasks(tasks):
+    """Print the number of tasks by status and the time saved."""
+    message = ('[ TASKS  ] ran: {ran}, cached: {cached}, skipped: {skipped}, '
+               'failed: {failed}, not run: {not_run}\n'
+               '[        ]  rebuild ratio {percent:0.1f} %, time saved '
+               '{time_saved:0.3f} s, by the cache {cache_time_saved:0.3f} s')
+    Logs.pprint('BOLD', message.format(
+        percent=tasks['rebuild_ratio'] * 100, **tasks))
+
+
+def summarize_classes(records, tasks):
+    """
+    Summarize the tasks run by task class.
+
+    For each class the number of tasks run and the totals of their time and
+    cpu stats are returned, each task is counted once regardless of its
+    number of outputs.
+    """
+    classes = dict(
+        (task.statistics_serial, task.__class__.__name__) for task in tasks)
+    summary = {}
+    for record in records:
+        stats = record[5]
+        name = classes.get(record[1], '')
+        totals = summary.get(name)
+        if totals is None:
+            totals = summary[name] = {'tasks': 0}
+        totals['tasks'] += 1
+        for stat in ('time', 'cpu_user', 'cpu_system'):
+            if stat in stats:
+                totals[stat] = totals.get(stat, 0.0) + stats[stat]['value']
+    return summary
+
+
+def print_classes(classes, old_classes):
+    """Print the time spent in each task class, longest first."""
+    for name in sorted(classes, key=lambda c: -classes[c].get('time', 0.0)):
+        totals = classes[name]
+        message = '[ CLASS  ] {}: {} tasks, time {:0.3f} s'.format(
+            name, totals['tasks'], totals.get('time', 0.0))
+        old = old_classes.get(name, {})
+        color = 'CYAN'
+        if 'time' in old:
+            difference = totals.get('time', 0.0) - old['time']
+            message += ' ({:+0.3f} s)'.format(difference)
+            if difference > 0:
+                color = 'PINK'
+        Logs.pprint(color, message)
+
+
+# ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere.
+maxrss_per_kb = 1024.0 if sys.platform == 'darwin' else 1.0
+
+
+class AccountingPopen(subprocess.Popen):
+
+    """
+    Popen which accounts the resources used by the process.
+
+    The process is reaped with os.wait4, which returns the resource usage of
+    that single process. The usage is added to the accounting of the thread
+    which waits for the process, which is the worker thread running the
+    task. Only the public wait and poll are overridden, so this works the
+    same on Python 2 and 3.
+    """
+
+    def wait(self, *args, **kwargs):
+        """Wait for the process and account its resource usage."""
+        # a wait with a timeout is left to Popen, as os.wait4 blocks.
+        if self.returncode is None and \
+                all(arg is None for arg in args + tuple(kwargs.values())):
+            self.reap(0)
+        return super(AccountingPopen, self).wait(*args, **kwargs)
+
+    def poll(self):
+        """Check if the process has terminated and account its usage."""
+        if self.returncode is None and not self.reap(os.WNOHANG):
+            return super(AccountingPopen, self).poll()
+        return self.returncode
+
+    def reap(self, wait_flags):
+        """
+        Reap the process with os.wait4 if it has terminated.
+
+        Returns False if os.wait4 failed, the process is then left to Popen.
+        """
+        try:
+            (pid, sts, usage) = os.wait4(self.pid, wait_flags)
+        except OSError:
+            # the process has already been reaped
+            return False
+        if pid != self.pid:
+            return True
+        if os.WIFSIGNALED(sts):
+            self.returncode = -os.WTERMSIG(sts)
+        else:
+            self.returncode = os.WEXITSTATUS(sts)
+        task_usage = getattr(accounting, 'usage', None)
+        if task_usage is not None:
+            task_usage.append(usage)
+        return True
+
+
+def install_accounting():
+    """
+    Make waf start processes with AccountingPopen.
+
+    waf starts the processes through Utils.subprocess, which is replaced
+    with a copy of the subprocess module using AccountingPopen. Nothing is
+    done on platforms without os.wait4, which is logged once.
+    """
+    global accounting_logged
+    if not hasattr(os, 'wait4'):
+        if not accounting_logged:
+            Logs.info('The cpu time and peak memory of tasks are not '
+                      'measured, as os.wait4 is not available.')
+            accounting_logged = True
+        return
+    if getattr(Utils.subprocess, 'Popen', None) is AccountingPopen:
+        return
+    module = types.ModuleType(subprocess.__name__)
+    module.__dict__.update(subprocess.__dict__)
+    module.Popen = AccountingPopen
+    Utils.subprocess = module
+
+
+class Journal(object):
+
+    """
+    Line-oriented journal of task measurements.
+
+    Each line holds the outputs of a single task and the stats measured for
+    them. Lines are buffered and written in batches, either when
+    batch_size lines are pending or when interval seconds have passed since
+    the last write. Written lines survive the build process being killed.
+    """
+
+    def __init__(self, path, batch_size=64, interval=1.0):
+        """Open the journal for appending."""
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lock = threading.Lock()
+        # each thread collects its pending lines in its own list.
+        self.local = threading.local()
+        self.pending = []
+        self.last_write = clock()
+        self.file = open(path, 'a')
+
+    def append(self, keys, stats, worker=None, start=None, stop=None,
+               sizes=None):
+        """Add the stats of a task to the journal."""
+        line = json.dumps([keys, stats, worker, start, stop, sizes]) + '\n'
+        try:
+            lines = self.local.lines
+        except AttributeError:
+            lines = self.local.lines = []
+            self.pending.append(lines)
+        lines.append(line)
+        if len(lines) >= self.batch_size or \
+                clock() - self.last_write >= self.interval:
+            with self.lock:
+                self.write(lines)
+
+    def write(self, lines):
+        """Write the pending lines of a thread, the lock must be held."""
+        if self.file is None or not lines:
+            return
+        self.file.write(''.join(lines))
+        self.file.flush()
+        del lines[:]
+        self.last_write = clock()
+
+    def close(self):
+        """Write the pending lines and close the journal."""
+        with self.lock:
+            for lines in self.pending:
+                self.write(lines)
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def open_journal(bld):
+    """Start journaling the task measurements of this build."""
+    global journal
+    path = os.path.join(bld.bldnode.srcpath(), journal_filename)
+    journal = Journal(path)
+
+
+def close_journal():
+    """Close the journal of this build and remove it."""
+    global journal
+    if journal is None:
+        return
+    journal.close()
+    os.remove(journal.path)
+    journal = None
+
+
+def flush_journal():
+    """Write the pending lines if the build is cancelled."""
+    if journal is not None:
+        journal.close()
+
+
+atexit.register(flush_journal)
+
+
+def read_journal(path):
+    """
+    Read the measurements stored in a journal.
+
+    Returns a dict with the stats of each output. A line which was only
+    partially written when the build was killed is ignored.
+    """
+    statistics = {}
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            keys, stats = record[:2]
+            sizes = record[5] if len(record) > 5 else None
+            for i, key in enumerate(keys):
+                output_stats = statistics.setdefault(key, {})
+                output_stats.update(stats)
+                if sizes and sizes[i] is not None:
+                    output_stats['size'] = {'value': sizes[i], 'unit': 'kb'}
+    return statistics
+
+
+def recover_journal(folder, statistics_format='json'):
+    """
+    Combine the journal of an interrupted build into the statistics.
+
+    The recovered measurements are saved as a partial build, both in the
+    statistics file and in the history store.
+    """
+    path = os.path.join(folder, journal_filename)
+    if not os.path.exists(path):
+        return
+
+    recovered = read_journal(path)
+    if recovered:
+        previous = {}
+        f = find_statistics(folder, statistics_format)
+        if f is not None:
+            previous = load_statistics(f)
+
+        build_statistics = dict(
+            (k, v.copy()) for k, v in previous.items() if k != build_key)
+        for key, stats in recovered.items():
+            build_statistics.setdefault(key, {}).update(stats)
+
+        append_history(folder, build_statistics, previous, partial=True)
+        close_statistics(previous)
+        save_statistics(folder, build_statistics, statistics_format)
+
+        Logs.warn('Recovered measurements of {} outputs from an interrupted '
+                  'build.'.format(len(recovered)))
+
+    os.remove(path)
+
+
+def save_data(self):
+    """
+    Save the collected data to a json file.
+
+    This function writes all the collected data to a file, and, if any changes
+    happened, writes a summary.
+    """
+    records = merge_records()
+    tasks = classify_tasks(wrapped_tasks, records)
+
+    build_statistics = {}
+
+    for k, stats in new_build_statistics.items():
+        carried = carried_stats(old_build_statistics, k, stats)
+        if carried:
+            carried.update(stats)
+            stats = carried
+        build_statistics[k] = stats
+
+    compare_stats = old_build_statistics
+    compare_with = 'previous build'
+
+    if self.has_tool_option('compare_with'):
+        compare_with = self.get_tool_option('compare_with')
+        if os.path.exists(compare_with):
+            compare_stats = load_statistics(compare_with)
+        else:
+            compare_stats = {}
+            Logs.warn('{} does not exists.'.format(compare_with))
+
+    stats_limit = 0
+    if self.has_tool_option('stats_limit'):
+        stats_limit = int(self.get_tool_option('stats_limit'))
+
+    regressions = None
+    if self.has_tool_option('regressions'):
+        regressions = detect_regressions(self, new_build_statistics)
+        print_regressions(regressions)
+    elif compare_stats or stats_limit < 0:
+        summaries = iterate_summaries(compare_stats, build_statistics)
+        if self.has_tool_option('diff'):
+            summaries = write_diff(self.get_tool_option('diff'), summaries)
+        if self.has_tool_option('top'):
+            top = self.get_tool_option('top')
+            top = 10 if top is True else int(top)
+            stat = 'time'
+            if self.has_tool_option('top_stat'):
+                stat = self.get_tool_option('top_stat')
+            print_report(
+                report_summaries(summaries, top, stat, stats_limit), top)
+        else:
+            print_summaries(summaries, stats_limit)
+
+    build = summarize_workers(records)
+    build['classes'] = summarize_classes(records, wrapped_tasks)
+    build['tasks'] = tasks
+    build['timestamp'] = time.time()
+    if records or tasks['skipped']:
+        print_tasks(tasks)
+
+    if self.has_tool_option('fingerprint'):
+        build['identical'] = find_identical(
+            old_build_statistics, new_build_statistics)
+        print_identical(build['identical'])
+    if records:
+        old_build = compare_stats.get(build_key) or {}
+        print_classes(build['classes'], old_build.get('classes', {}))
+
+    if regressions is not None:
+        build['regressions'] = dict(
+            (state, [s['file'] for s in regressions if s['state'] == state])
+            for state in ('regressed', 'improved'))
+
+    if self.has_tool_option('critical_path'):
+        jobs = self.get_tool_option('critical_path')
+        jobs = self.jobs if jobs is True else int(jobs)
+        build['critical_path'] = report_critical_path(
+            self, wrapped_tasks, build_statistics, jobs)
+
+    if schedule_mode is not None:
+        build['schedule'] = report_schedule(self, records)
+
+    if output_symbols:
+        build['symbols'] = output_symbols
+
+    if output_link_maps:
+        build['link_maps'] = output_link_maps
+        old_build = compare_stats.get(build_key) or {}
+        changes = diff_link_maps(
+            old_build.get('link_maps', {}), output_link_maps)
+        print_link_maps(changes)
+        if changes:
+            build['link_map_changes'] = changes
+
+    if phases is not None:
+        build['phases'] = phases.report()
+        configure_phases = read_configure_phases(self.bldnode.srcpath())
+        if configure_phases is not None:
+            build['phases']['configure'] = configure_phases
+        print_phases(build['phases'])
+
+    if sampler:
+        build['system'] = stop_sampler()
+        print_system(build['system'])
+
+    if progress is not None:
+        end = max(record[3] for record in records) - build_start \
+            if records else 0.0
+        build['eta'] = progress.report(end)
+        print_progress_report(build['eta'])
+
+    if self.has_tool_option('time_trace'):
+        top = self.get_tool_option('time_trace')
+        top = 20 if top is True else int(top)
+        build['time_trace'] = collect_time_traces(
+            self.bldnode.srcpath(), new_build_statistics, top)
+        print_time_trace(build['time_trace'])
+
+    if self.has_tool_option('trace'):
+        trace = self.get_tool_option('trace')
+        if trace is True:
+            trace = os.path.join(self.bldnode.srcpath(), trace_filename)
+        export_trace(trace, records, wrapped_tasks)
+
+    if self.has_tool_option('html'):
+        html = self.get_tool_option('html')
+        if html is True:
+            html = os.path.join(self.bldnode.srcpath(), html_filename)
+        write_html_report(
+            html, report_tree(build_statistics, compare_stats),
+            compare_with if compare_stats else None)
+
+    if self.has_tool_option('impact'):
+        update_dependency_index(self, wrapped_tasks, build_statistics)
+
+    build_statistics[build_key] = build
+
+    # the previous statistics may be mapped from the file which is replaced,
+    # which fails on win32 while it is mapped, so they are used for the
+    # history first and then closed.
+    folder = self.bldnode.srcpath()
+    append_history(folder, build_statistics, old_build_statistics)
+    close_statistics(old_build_statistics)
+
+    save_statistics(folder, build_statistics, get_statistics_format(self))
+
+    # the measurements are safely stored, the journal is no longer needed.
+    close_journal()
+
+
+def carried_stats(statistics, key, stats):
+    """
+    Return the stats of an output in statistics which are not in stats.
+
+    Only the stats which are carried over are read, so compact statistics
+    are not turned into a dict for every output.
+    """
+    if isinstance(statistics, CompactStatistics):
+        return statistics.carried_stats(key, stats)
+    old_stats = statistics.get(key)
+    if not old_stats:
+        return {}
+    return dict((stat, value) for stat, value in old_stats.items()
+                if stat not in stats)
+
+
+def close_statistics(statistics):
+    """Unmap statistics loaded from a file in the compact format."""
+    if isinstance(statistics, MappedSections):
+        statistics.close()
+
+
+def get_statistics_format(bld):
+    """
+    Return the format the statistics are saved in.
+
+    The format is given with the format tool option: json, the default,
+    compact, or both.
+    """
+    if not bld.has_tool_option('format'):
+        return 'json'
+    statistics_format = bld.get_tool_option('format')
+    if statistics_format not in ('json', 'compact', 'both'):
+        bld.fatal('Unknown statistics format {!r}, use json, compact or '
+                  'both.'.format(statistics_format))
+    return statistics_format
+
+
+def find_statistics(folder, statistics_format='json'):
+    """
+    Return the path of the saved statistics, or None if there are none.
+
+    Either format is found, so no statistics are lost when the format is
+    changed. If both are found, the most recent is returned, as the other
+    may be left behind by an older build, and the given format is preferred
+    if they are as recent.
+    """
+    filenames = [filename, compact_filename]
+    if statistics_format != 'json':
+        filenames.reverse()
+    paths = [os.path.join(folder, name) for name in filenames]
+    paths = [path for path in paths if os.path.exists(path)]
+    if len(paths) < 2:
+        return paths[0] if paths else None
+    # max returns the first of the most recent paths.
+    return max(paths, key=os.path.getmtime)
+
+
+def load_statistics(path):
+    """Load statistics saved in either the json or the compact format."""
+    with open(path, 'rb') as data_file:
+        magic = data_file.read(len(compact_magic))
+    if magic == compact_magic:
+        return CompactStatistics(path)
+    with open(path) as data_file:
+        return json.load(data_file)
+
+
+def save_statistics(folder, statistics, statistics_format='json'):
+    """
+    Save the statistics in the given format.
+
+    The file of the other format is removed, if only one format is saved,
+    so statistics of an older build are never found instead.
+    """
+    json_path = os.path.join(folder, filename)
+    compact_path = os.path.join(folder, compact_filename)
+    if statistics_format in ('json', 'both'):
+        with open(json_path, 'w') as outfile:
+            json.dump(statistics, outfile)
+    elif os.path.exists(json_path):
+        os.remove(json_path)
+    if statistics_format in ('compact', 'both'):
+        write_compact(compact_path, statistics)
+    elif os.path.exists(compact_path):
+        os.remove(compact_path)
+
+
+def write_compact(path, statistics):
+    """
+    Write statistics in the compact format.
+
+    The file starts with a magic number and a small json header followed by
+    the sections listed in the header. The directories of the outputs are
+    interned in a table, and each output refers to its directory by index.
+    Each stat is stored as a column of doubles, with NaN for outputs
+    without that stat, and its unit is stored once in the header. Stats
+    which are not numbers are stored as lines of text, empty for outputs
+    without that stat. The __build__ information is stored in the header.
+    """
+    keys = sorted(key for key in statistics if key != build_key)
+    count = len(keys)
+
+    directories = {}
+    directory_indices = array.array('I')
+    names = []
+    units = {}
+    columns = {}
+    for i, key in enumerate(keys):
+        split = key.rfind(os.sep) + 1
+        directory = key[:split]
+        names.append(key[split:])
+        directory_indices.append(
+            directories.setdefault(directory, len(directories)))
+        for stat, value in statistics[key].items():
+            if stat not in columns:
+                units[stat] = value['unit']
+                if is_number(value['value']):
+                    columns[stat] = array.array('d', [float('nan')]) * count
+                else:
+                    columns[stat] = [''] * count
+            columns[stat][i] = value['value']
+
+    directory_table = sorted(directories, key=directories.get)
+    sections = [
+        ('directories', '\n'.join(directory_table).encode('utf-8')),
+        ('names', '\n'.join(names).encode('utf-8')),
+        ('directory_indices', _array_bytes(directory_indices))]
+    for stat in sorted(columns):
+        if isinstance(columns[stat], list):
+            sections.append(
+                ('strings:' + stat, '\n'.join(columns[stat]).encode('utf-8')))
+        else:
+            sections.append(('column:' + stat, _array_bytes(columns[stat])))
+
+    write_sections(path, compact_magic, {
+        'count': count,
+        'units': units,
+        'build': statistics.get(build_key)}, sections)
+
+
+def write_sections(path, magic, header, sections):
+    """
+    Write a file of binary sections.
+
+    The file starts with a magic number and a json header, which lists the
+    offset and size of each section, followed by the sections.
+    """
+    offset = 0
+    layout = {}
+    for name, data in sections:
+        # columns of doubles are aligned so they can be used in place.
+        offset += -offset % 8
+        layout[name] = [offset, len(data)]
+        offset += len(data)
+
+    header = dict(header, byteorder=sys.byteorder, sections=layout)
+    header = json.dumps(header).encode('utf-8')
+    start = len(magic) + 4 + len(header)
+    start += -start % 8
+
+    # write to a temporary file so a reader never sees a partial file.
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(magic)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        for name, data in sections:
+            f.write(b'\0' * (start + layout[name][0] - f.tell()))
+            f.write(data)
+    if os.path.exists(path) and sys.platform == 'win32':
+        os.remove(path)
+    os.rename(temporary, path)
+
+
+def _array_bytes(values):
+    """Return the raw bytes of an array."""
+    return values.tobytes() if hasattr(values, 'tobytes') \
+        else values.tostring()
+
+
+class MappedSections(object):
+
+    """A memory mapped file of binary sections, see write_sections."""
+
+    def __init__(self, path, magic):
+        """Map the file and read its header."""
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(magic)] != magic:
+            raise ValueError('{} is not a {} file.'.format(
+                path, self.description))
+        position = len(magic)
+        size, = struct.unpack_from('<I', self.data, position)
+        position += 4
+        self.header = json.loads(
+            self.data[position:position + size].decode('utf-8'))
+        position += size
+        self.start = position + -position % 8
+        self.swap = self.header['byteorder'] != sys.byteorder
+        self.sections = self.header['sections']
+
+    def section(self, name):
+        """Return the bytes of a section."""
+        offset, size = self.sections[name]
+        return self.data[self.start + offset:self.start + offset + size]
+
+    def array(self, name, typecode):
+        """Return a section as an array."""
+        values = array.array(typecode)
+        if hasattr(values, 'frombytes'):
+            values.frombytes(self.section(name))
+        else:
+            values.fromstring(self.section(name))
+        if self.swap:
+            values.byteswap()
+        return values
+
+    def lines(self, name):
+        """Return a section of text as a list of lines."""
+        text = self.section(name).decode('utf-8')
+        return text.split('\n') if text else []
+
+    def close(self):
+        """Unmap the file, e.g. before it is replaced."""
+        self.data.close()
+
+
+class CompactStatistics(MappedSections, Mapping):
+
+    """
+    Read-only mapping of statistics saved in the compact format.
+
+    The file is memory mapped and only the parts which are used are read:
+    the output paths are decoded when the outputs are first iterated or
+    looked up, and each column when its stat is first used.
+    """
+
+    description = 'compact statistics'
+
+    def __init__(self, path):
+        """Map the file and read its header."""
+        MappedSections.__init__(self, path, compact_magic)
+        self.count = self.header['count']
+        self.units = self.header['units']
+        self.build = self.header['build']
+        self.paths = None
+        self.indices = None
+        self.columns = {}
+
+    def keys_list(self):
+        """Return the output paths, in the order of the columns."""
+        if self.paths is None:
+            if not self.count:
+                self.paths = []
+                return self.paths
+            directories = self.section('directories').decode('utf-8')
+            directories = directories.split('\n')
+            names = self.section('names').decode('utf-8').split('\n')
+            indices = self.array('directory_indices', 'I')
+            self.paths = [
+                directories[index] + name
+                for index, name in zip(indices, names)]
+        return self.paths
+
+    def index(self, key):
+        """Return the position of an output in the columns."""
+        return self.positions()[key]
+
+    def positions(self):
+        """Return the position of every output in the columns."""
+        if self.indices is None:
+            keys = self.keys_list()
+            self.indices = dict(zip(keys, range(len(keys))))
+        return self.indices
+
+    def column(self, stat):
+        """
+        Return the values of a stat, NaN for outputs without it.
+
+        The values of stats which are not numbers are returned as a list of
+        strings, empty for outputs without the stat.
+        """
+        if stat not in self.columns:
+            name = 'column:' + stat
+            if name not in self.sections:
+                self.columns[stat] = \
+                    self.section('strings:' + stat).decode('utf-8').split('\n')
+            elif self.swap or not hasattr(memoryview, 'cast'):
+                self.columns[stat] = self.array(name, 'd')
+            else:
+                # use the mapped column in place, without copying it.
+                offset, size = self.sections[name]
+                offset += self.start
+                self.columns[stat] = \
+                    memoryview(self.data)[offset:offset + size].cast('d')
+        return self.columns[stat]
+
+    def carried_stats(self, key, stats):
+        """Return the stats of an output which are not in stats."""
+        i = self.positions().get(key)
+        if i is None:
+            return {}
+        carried = {}
+        for stat, unit in self.units.items():
+            if stat in stats:
+                continue
+            value = self.column(stat)[i]
+            if value == value and value != '':
+                carried[stat] = {'value': value, 'unit': unit}
+        return carried
+
+    def close(self):
+        """Release the columns used in place and unmap the file."""
+        for column in self.columns.values():
+            if isinstance(column, memoryview):
+                column.release()
+        self.columns = {}
+        MappedSections.close(self)
+
+    def __contains__(self, key):
+        """Return whether there are stats of an output."""
+        if key == build_key:
+            return self.build is not None
+        return key in self.positions()
+
+    def __getitem__(self, key):
+        """Return the stats of an output."""
+        if key == build_key:
+            if self.build is None:
+                raise KeyError(key)
+            return self.build
+        i = self.index(key)
+        stats = {}
+        for stat, unit in self.units.items():
+            value = self.column(stat)[i]
+            if value == value and value != '':
+                stats[stat] = {'value': value, 'unit': unit}
+        return stats
+
+    def __iter__(self):
+        """Iterate over the outputs."""
+        for key in self.keys_list():
+            yield key
+        if self.build is not None:
+            yield build_key
+
+    def __len__(self):
+        """Return the number of outputs."""
+        return self.count + (self.build is not None)
+
+
+def append_history(folder, build_statistics, previous_statistics,
+                   partial=False):
+    """
+    Append a build to the history store.
+
+    The history store consists of three append-only files:
+    the data file with one block per build, a build index with the id,
+    timestamp and location of each block, and an output index with the
+    location of every output record. Only outputs which differ from the
+    previous build are written, except for every
+    history_checkpoint_interval'th build which is stored in full.
+    Hence the cost of appending a build does not depend on the length of the
+    history. Builds recovered from a journal are marked as partial.
+    """
+    index_path = os.path.join(folder, history_index_filename)
+    last = _read_last_line(index_path)
+    build_id = int(last.split()[0]) + 1 if last else 1
+    full = build_id % history_checkpoint_interval == 1
+
+    records = []
+    for key in sorted(build_statistics):
+        stats = build_statistics[key]
+        if full or previous_statistics.get(key) != stats:
+            records.append((key, stats))
+    if not full:
+        for key in sorted(set(previous_statistics) - set(build_statistics)):
+            records.append((key, None))
+
+    timestamp = time.time()
+    header = {
+        'build': build_id,
+        'timestamp': timestamp,
+        'full': full,
+        'partial': partial,
+        'outputs': len(records)}
+
+    outputs_index = []
+    with open(os.path.join(folder, history_filename), 'ab') as data_file:
+        data_file.seek(0, os.SEEK_END)
+        start = data_file.tell()
+        line = (json.dumps(header) + '\n').encode()
+        data_file.write(line)
+        offset = start + len(line)
+        for key, stats in records:
+            line = (json.dumps([key, stats]) + '\n').encode()
+            data_file.write(line)
+            outputs_index.append('{}\t{}\t{}\t{}\n'.format(
+                build_id, offset, len(line), key))
+            offset += len(line)
+
+    with open(os.path.join(folder, history_outputs_filename), 'a') as f:
+        f.writelines(outputs_index)
+
+    # the build index is written last; a build is only part of the history
+    # once it is present in the build index.
+    with open(index_path, 'a') as f:
+        f.write('{} {!r} {} {}\n'.format(
+            build_id, timestamp, start, offset - start))
+
+    return build_id
+
+
+def _read_last_line(path):
+    """Read the last line of a file without reading the whole file."""
+    if not os.path.exists(path):
+        return ''
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        size = 256
+        while True:
+            f.seek(max(0, end - size))
+            lines = f.read().splitlines()
+            if len(lines) > 1 or size >= end:
+                break
+            size *= 2
+    return lines[-1].decode() if lines else ''
+
+
+def read_history_index(folder):
+    """Read the build index as a list of (build, timestamp, offset, size)."""
+    index = []
+    path = os.path.join(folder, history_index_filename)
+    if not os.path.exists(path):
+        return index
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) != 4:
+                # an incomplete line left behind by an interrupted build.
+                continue
+            index.append((int(fields[0]), float(fields[1]),
+                          int(fields[2]), int(fields[3])))
+    return index
+
+
+def find_history_build(index, build=None, timestamp=None):
+    """
+    Find a build in the build index.
+
+    A build is found either by its id or as the latest build made at, or
+    before, the given timestamp. If neither is given the latest build is
+    returned.
+    """
+    if not index:
+        return None
+    if build is not None:
+        position = bisect.bisect_left([e[0] for e in index], build)
+        if position < len(index) and index[position][0] == build:
+            return index[position]
+        return None
+    if timestamp is not None:
+        position = bisect.bisect_right([e[1] for e in index], timestamp)
+        return index[position - 1] if position else None
+    return index[-1]
+
+
+def read_history_build(folder, entry):
+    """
+    Read the records stored for a single build.
+
+    Returns the block header and a dict with the stored records. Removed
+    outputs have None as value.
+    """
+    build, timestamp, offset, size = entry
+    with open(os.path.join(folder, history_filename), 'rb') as f:
+        f.seek(offset)
+        lines = f.read(size).decode().splitlines()
+    header = json.loads(lines[0])
+    records = {}
+    for line in lines[1:]:
+        key, stats = json.loads(line)
+        records[key] = stats
+    return header, records
+
+
+def read_history_snapshot(folder, build=None, index=None):
+    """
+    Reconstruct the complete statistics of a build from the history.
+
+    The closest full checkpoint before the build is read and the following
+    changes are applied on top of it.
+    """
+    if index is None:
+        index = read_history_index(folder)
+    entry = find_history_build(index, build=build)
+    if entry is None:
+        return None
+    position = index.index(entry)
+    blocks = []
+    for entry in reversed(index[:position + 1]):
+        header, records = read_history_build(folder, entry)
+        blocks.append(records)
+        if header['full']:
+            break
+    snapshot = {}
+    for records in reversed(blocks):
+        for key, stats in records.items():
+            if stats is None:
+                snapshot.pop(key, None)
+            else:
+                snapshot[key] = stats
+    return snapshot
+
+
+def read_history_series(folder, key):
+    """
+    Read the series of a single output.
+
+    Only the records of the given output are read from the data file, the
+    remaining builds are never loaded. Returns a list of
+    (build, timestamp, stats) tuples, stats is None if the output was removed
+    in that build. A build interrupted before its build index line was
+    written leaves records which the next build, with the same id, does not
+    cover, so only records within the block of their build are used.
+    """
+    blocks = dict((e[0], e[1:]) for e in read_history_index(folder))
+    path = os.path.join(folder, history_outputs_filename)
+    if not blocks or not os.path.exists(path):
+        return []
+
+    suffix = '\t' + key + '\n'
+    locations = []
+    with open(path) as f:
+        for line in f:
+            if line.endswith(suffix):
+                build, offset, size, _ = line.split('\t', 3)
+                build, offset = int(build), int(offset)
+                block = blocks.get(build)
+                if block is not None and \
+                        block[1] <= offset < block[1] + block[2]:
+                    locations.append((build, offset, int(size)))
+
+    series = []
+    with open(os.path.join(folder, history_filename), 'rb') as f:
+        for build, offset, size in locations:
+            f.seek(offset)
+            _, stats = json.loads(f.read(size).decode())
+            series.append((build, blocks[build][0], stats))
+    return series
+
+
+class Baselines(object):
+
+    """
+    Rolling windows of the latest measurements of each output's stats.
+
+    Each output and stat has a slot in the baseline file holding the number
+    of measurements added followed by a ring buffer of window doubles. The
+    index file is only appended to, each line allocates the next slots to
+    the comma separated stats of an output. Only the slots which changed are
+    written back, so the cost of a build depends on the number of outputs
+    measured, not on the size of the project or the length of the history.
+    """
+
+    def __init__(self, folder, window):
+        """Load the baselines, starting over if the window has changed."""
+        self.path = os.path.join(folder, baseline_filename)
+        self.index_path = os.path.join(folder, baseline_index_filename)
+        self.window = window
+        self.slot_size = window + 1
+        self.slots = {}
+        self.count = 0
+        self.values = array.array('d')
+        self.changed = set()
+        self.added = []
+        if not self.load():
+            self.slots = {}
+            self.count = 0
+            self.values = array.array('d')
+            with open(self.index_path, 'w') as f:
+                f.write('{}\n'.format(window))
+            open(self.path, 'wb').close()
+
+    def load(self):
+        """Load the baseline files, return False if they cannot be used."""
+        if not os.path.exists(self.index_path) or \
+                not os.path.exists(self.path):
+            return False
+        with open(self.index_path) as f:
+            if f.readline().strip() != str(self.window):
+                return False
+            for line in f:
+                if not line.endswith('\n'):
+                    # an incomplete line left behind by an interrupted build.
+                    break
+                stats, key = line[:-1].split('\t', 1)
+                slots = self.slots.setdefault(key, {})
+                for stat in stats.split(','):
+                    slots[stat] = self.count
+                    self.count += 1
+
+        # slots missing from the data file are empty.
+        size = self.count * self.slot_size
+        with open(self.path, 'rb') as f:
+            try:
+                self.values.fromfile(f, size)
+            except EOFError:
+                pass
+        self.values.extend([0.0] * (size - len(self.values)))
+        return True
+
+    def get(self, key, stat):
+        """Return the measurements in the baseline of an output's stat."""
+        slot = self.slots.get(key, {}).get(stat)
+        if slot is None:
+            return []
+        start = slot * self.slot_size
+        count = min(int(self.values[start]), self.window)
+        return self.values[start + 1:start + 1 + count]
+
+    def add(self, key, stat, value):
+        """
+        Add a measurement, replacing the oldest one if the window is full.
+
+        Returns the measurements in the baseline before the new one was
+        added.
+        """
+        slots = self.slots.get(key)
+        if slots is None:
+            slots = self.slots[key] = {}
+        slot = slots.get(stat)
+        if slot is None:
+            slot = slots[stat] = self.count
+            self.count += 1
+            self.added.append((key, stat))
+            self.values.extend([0.0] * self.slot_size)
+        start = slot * self.slot_size
+        values = self.values
+        count = int(values[start])
+        window = values[start + 1:start + 1 + min(count, self.window)]
+        values[start + 1 + count % self.window] = value
+        values[start] = count + 1
+        self.changed.add(slot)
+        return window
+
+    def save(self):
+        """Write the changed slots and the new index entries."""
+        if len(self.changed) * 2 > self.count:
+            with open(self.path, 'wb') as f:
+                self.values.tofile(f)
+        else:
+            with open(self.path, 'r+b') as f:
+                for slot in sorted(self.changed):
+                    start = slot * self.slot_size
+                    f.seek(start * self.values.itemsize)
+                    f.write(_array_bytes(
+                        self.values[start:start + self.slot_size]))
+
+        # the index is written last, slots not yet in the index are simply
+        # allocated again. Slots added in a row for an output are
+        # consecutive.
+        with open(self.index_path, 'a') as f:
+            for key, added in itertools.groupby(self.added, lambda a: a[0]):
+                f.write('{}\t{}\n'.format(
+                    ','.join(stat for _, stat in added), key))
+        self.changed = set()
+        self.added = []
+
+
+def _median_of_sorted(values):
+    """Return the median of sorted values."""
+    middle = len(values) // 2
+    return (values[middle] + values[~middle]) / 2.0
+
+
+def score_regression(values, value, sensitivity, relative_floor):
+    """
+    Score a measurement against its baseline.
+
+    The score is the number of standard deviations the measurement differs
+    from the median of the baseline. The standard deviation is estimated as
+    1.4826 times the median absolute deviation, which an occasional outlier
+    from a noisy build does not throw off, but is never less than
+    relative_floor times the median.
+
+    Returns the score and the median if the score is above the sensitivity,
+    otherwise None.
+    """
+    ordered = sorted(values)
+    median = _median_of_sorted(ordered)
+    difference = value - median
+    floor = relative_floor * abs(median)
+    if abs(difference) <= sensitivity * floor:
+        # the common case, no need for the deviation.
+        return None
+
+    deviation = _median_of_sorted(sorted([abs(v - median) for v in ordered]))
+    spread = max(1.4826 * deviation, floor)
+    if not spread:
+        score = float('inf') if difference > 0 else float('-inf')
+    else:
+        score = difference / spread
+    if abs(score) <= sensitivity:
+        return None
+    return score, median
+
+
+def detect_regressions(bld, statistics):
+    """
+    Detect the statistically significant changes of the outputs measured.
+
+    Every stat of the outputs whose task ran is compared with the baseline
+    of the last builds and then added to it. The number of builds in a
+    baseline is given with the regressions tool option. A measurement is
+    flagged if its score is above the time_sensitivity tool option for time
+    stats, or the size_sensitivity tool option for the other stats.
+
+    Returns summaries as generate_summaries, with the state regressed or
+    improved, the median of the baseline as old value and the score of each
+    flagged stat.
+    """
+    window = bld.get_tool_option('regressions')
+    window = regression_window if window is True else int(window)
+    sensitivities = {}
+    for option, default in [('time_sensitivity', time_sensitivity),
+                            ('size_sensitivity', size_sensitivity)]:
+        sensitivities[option] = default
+        if bld.has_tool_option(option):
+            sensitivities[option] = float(bld.get_tool_option(option))
+
+    # outputs of tasks which did not run have no new measurements.
+    measured = sorted(
+        key for key, stats in statistics.items()
+        if key != build_key and 'time' in stats)
+    if not measured:
+        return []
+
+    baselines = Baselines(bld.bldnode.srcpath(), window)
+    summaries = []
+    for key in measured:
+        stats = statistics[key]
+        results = {}
+        for stat, measurement in stats.items():
+            value = measurement['value']
+            if not is_number(value):
+                continue
+            if measurement['unit'] == 's':
+                sensitivity = sensitivities['time_sensitivity']
+                relative_floor = time_relative_floor
+            else:
+                sensitivity = sensitivities['size_sensitivity']
+                relative_floor = size_relative_floor
+
+            values = baselines.add(key, stat, value)
+            flagged = None
+            if len(values) >= regression_min_samples:
+                flagged = score_regression(
+                    values, value, sensitivity, relative_floor)
+            if flagged is not None:
+                score, median = flagged
+                results[stat] = {
+                    'unit': measurement['unit'],
+                    'value': value,
+                    'value_old': median,
+                    'difference': value - median,
+                    'score': score}
+                if median:
+                    results[stat]['percent'] = \
+                        (value - median) / median * 100
+
+        if results:
+            regressed = any(r['difference'] > 0 for r in results.values())
+            summaries.append({
+                'file': key,
+                'state': 'regressed' if regressed else 'improved',
+                'results': results})
+
+    baselines.save()
+    return summaries
+
+
+def print_regressions(summaries):
+    """Print the changes flagged by detect_regressions."""
+    if not summaries:
+        return
+    total_state = {'regressed': 0, 'improved': 0}
+    for summary in summaries:
+        Logs.pprint('BOLD', '[ FILE   ] {file} ({state})'.format(**summary))
+        print_results(summary['results'])
+        total_state[summary['state']] += 1
+    Logs.pprint('BOLD', '[ TOTAL  ] regressed: {regressed}, '
+                'improved: {improved}'.format(**total_state))
+
+
+def task_name(task):
+    """
+    Return the name of a task, which is its first output if it has any.
+
+    A task without outputs is named by its class and task generator, and by
+    its first input, or else by its position in its task generator, so the
+    tasks without outputs of a task generator are told apart.
+    """
+    if task.outputs:
+        return task.outputs[0].bldpath()
+    name = '{} ({})'.format(
+        task.__class__.__name__, generator_name(task.generator))
+    inputs = getattr(task, 'inputs', None)
+    if isinstance(inputs, list) and inputs:
+        return '{} {}'.format(name, inputs[0].bldpath())
+    tasks = getattr(task.generator, 'tasks', None)
+    if isinstance(tasks, list):
+        for i, other in enumerate(tasks):
+            if other is task:
+                return '{} #{}'.format(name, i)
+    return name
+
+
+def build_task_graph(bld, tasks, statistics):
+    """
+    Build the dependency graph of the tasks.
+
+    Returns the names, durations and dependencies of the nodes of the graph.
+    The duration of a task is the time of its first output in the
+    statistics. Tasks depend on the tasks in their run_after set. Since waf
+    runs the build groups one after the other, a barrier node without
+    duration is added after each group; the tasks of a group depend on the
+    barrier of the previous group. The names of the barriers are None.
+    """
+    group_indices = {}
+    for index, group in enumerate(bld.groups):
+        for task_gen in group:
+            group_indices[id(task_gen)] = index
+
+    positions = dict((id(task), i) for i, task in enumerate(tasks))
+    names = []
+    durations = []
+    dependencies = []
+    groups = {}
+    for i, task in enumerate(tasks):
+        name = task_name(task)
+        names.append(name)
+        durations.append(
+            statistics.get(name, {}).get('time', {}).get('value', 0.0))
+        dependencies.append([
+            positions[id(t)] for t in getattr(task, 'run_after', ())
+            if id(t) in positions])
+        group = group_indices.get(id(task.generator), 0)
+        groups.setdefault(group, []).append(i)
+
+    barrier = None
+    for group in sorted(groups):
+        members = groups[group]
+        if barrier is not None:
+            for i in members:
+                dependencies[i].append(barrier)
+        barrier = len(names)
+        names.append(None)
+        durations.append(0.0)
+        dependencies.append(list(members))
+
+    return names, durations, dependencies
+
+
+def _successors(dependencies):
+    """Return the successors and the number of dependencies of each node."""
+    successors = [[] for _ in dependencies]
+    indegree = [0] * len(dependencies)
+    for node, node_dependencies in enumerate(dependencies):
+        for dependency in set(node_dependencies):
+            successors[dependency].append(node)
+            indegree[node] += 1
+    return successors, indegree
+
+
+def analyse_critical_path(durations, dependencies, jobs=1):
+    """
+    Find the critical path of a task graph.
+
+    Returns a dict with the length and the nodes of the longest weighted
+    path, the earliest start, slack and remaining critical path of each
+    node, the total work, and both the lower bound and the makespan of a
+    critical path first schedule for the given number of jobs.
+    """
+    count = len(durations)
+    successors, indegree = _successors(dependencies)
+
+    order = [node for node in range(count) if not indegree[node]]
+    remaining_dependencies = list(indegree)
+    for node in order:
+        for successor in successors[node]:
+            remaining_dependencies[successor] -= 1
+            if not remaining_dependencies[successor]:
+                order.append(successor)
+    if len(order) != count:
+        raise ValueError('The task graph contains a cycle.')
+
+    start = [0.0] * count
+    previous = [None] * count
+    for node in order:
+        finish = start[node] + durations[node]
+        for successor in successors[node]:
+            if finish > start[successor]:
+                start[successor] = finish
+                previous[successor] = node
+
+    finishes = [start[node] + durations[node] for node in range(count)]
+    length = max(finishes) if count else 0.0
+
+    latest_finish = [length] * count
+    remaining = list(durations)
+    for node in reversed(order):
+        for successor in successors[node]:
+            latest_finish[node] = min(
+                latest_finish[node],
+                latest_finish[successor] - durations[successor])
+            remaining[node] = max(
+                remaining[node], durations[node] + remaining[successor])
+    slack = [latest_finish[node] - finishes[node] for node in range(count)]
+
+    path = []
+    node = finishes.index(length) if count else None
+    while node is not None:
+        path.append(node)
+        node = previous[node]
+    path.reverse()
+
+    work = sum(durations)
+    return {
+        'length': length,
+        'path': path,
+        'start': start,
+        'slack': slack,
+        'remaining': remaining,
+        'work': work,
+        'lower_bound': max(length, work / jobs),
+        'makespan': simulate_schedule(durations, dependencies, jobs, remaining)
+    }
+
+
+def simulate_schedule(durations, dependencies, jobs, priorities=None):
+    """
+    Return the makespan of running the task graph with a number of jobs.
+
+    Whenever a job is free, the ready task with the highest priority is
+    started. Without priorities the longest task is started first.
+    """
+    if priorities is None:
+        priorities = durations
+    successors, indegree = _successors(dependencies)
+    ready = [(-priorities[node], node)
+             for node in range(len(durations)) if not indegree[node]]
+    heapq.heapify(ready)
+    running = []
+    now = 0.0
+    while ready or running:
+        while ready and len(running) < jobs:
+            _, node = heapq.heappop(ready)
+            heapq.heappush(running, (now + durations[node], node))
+        now, node = heapq.heappop(running)
+        for successor in successors[node]:
+            indegree[successor] -= 1
+            if not indegree[successor]:
+                heapq.heappush(ready, (-priorities[successor], successor))
+    return now
+
+
+def report_critical_path(bld, tasks, statistics, jobs):
+    """Print and return the critical path of the build."""
+    names, durations, dependencies = build_task_graph(bld, tasks, statistics)
+    analysis = analyse_critical_path(durations, dependencies, jobs)
+
+    path = [[names[node], durations[node]]
+            for node in analysis['path'] if names[node] is not None]
+    Logs.pprint('BOLD', '[ CRIT   ] length {:0.3f} s, total work {:0.3f} s'
+                .format(analysis['length'], analysis['work']))
+    Logs.pprint('BOLD', '[        ] makespan with {} jobs {:0.3f} s '
+                '(lower bound {:0.3f} s)'.format(
+                    jobs, analysis['makespan'], analysis['lower_bound']))
+    for name, duration in path:
+        Logs.pprint('CYAN', '[        ] {:10.3f} s  {}'.format(
+            duration, name))
+
+    return {
+        'length': analysis['length'],
+        'work': analysis['work'],
+        'jobs': jobs,
+        'lower_bound': analysis['lower_bound'],
+        'makespan': analysis['makespan'],
+        'path': path,
+        'slack': dict(
+            (name, analysis['slack'][node])
+            for node, name in enumerate(names) if name is not None)
+    }
+
+
+def schedule_tasks(bld, iterator):
+    """
+    Order the tasks of the build by their historical durations.
+
+    This generator wraps the build iterator of waf. When the prioritise
+    tool option is given, the tasks of each build group are sorted so the
+    tasks with the highest priority are started first. With
+    prioritise=longest, the default, the priority is the duration of the
+    task, with prioritise=critical it is the length of the remaining
+    critical path from the task. Tasks which are postponed or added during
+    the build are kept in priority order too.
+    """
+    global schedule_mode
+    for tasks in iterator:
+        if build_start is not None:
+            # measure the tasks the task generators did not wrap.
+            for task in tasks:
+                wrap_task(task)
+
+        if tasks and schedule_mode is None and \
+                bld.has_tool_option('prioritise'):
+            schedule_mode = bld.get_tool_option('prioritise')
+            if schedule_mode is True:
+                schedule_mode = 'longest'
+            if schedule_mode not in ('longest', 'critical'):
+                bld.fatal('Unknown prioritise mode {!r}, use longest or '
+                          'critical.'.format(schedule_mode))
+            prioritise_producer(bld.producer)
+
+        if tasks and schedule_mode is not None:
+            names, durations, dependencies = \
+                historical_task_graph(bld, tasks)
+            if schedule_mode == 'critical':
+                priorities = analyse_critical_path(
+                    durations, dependencies)['remaining']
+            else:
+                priorities = durations
+            for i, task in enumerate(tasks):
+                task_priorities[id(task)] = priorities[i]
+            tasks.sort(key=task_priority, reverse=True)
+
+        yield tasks
+
+
+def task_priority(task):
+    """Return the priority of a task, unknown tasks have no priority."""
+    return task_priorities.get(id(task), 0.0)
+
+
+def prioritise_producer(producer):
+    """
+    Keep the outstanding tasks of the producer sorted by priority.
+
+    waf starts the outstanding tasks in order. Whenever tasks are added to
+    them, e.g. postponed tasks or the tasks of the next group, the
+    outstanding tasks are sorted again.
+    """
+    refill_task_list = producer.refill_task_list
+    sorted_count = [0]
+
+    def prioritised_refill_task_list():
+        refill_task_list()
+        if len(producer.outstanding) > sorted_count[0]:
+            producer.outstanding.sort(key=task_priority, reverse=True)
+        sorted_count[0] = len(producer.outstanding)
+    producer.refill_task_list = prioritised_refill_task_list
+
+
+def historical_task_graph(bld, tasks):
+    """
+    Build the task graph using the durations of the previous build.
+
+    Tasks without a known duration are assumed to take the median duration
+    of the tasks with a known duration.
+    """
+    names, durations, dependencies = build_task_graph(
+        bld, tasks, old_build_statistics)
+    known = sorted(
+        duration for name, duration in zip(names, durations)
+        if 'time' in old_build_statistics.get(name, {}))
+    median = known[len(known) // 2] if known else 0.0
+    for node, name in enumerate(names):
+        if name is not None and \
+                'time' not in old_build_statistics.get(name, {}):
+            durations[node] = median
+    return names, durations, dependencies
+
+
+def report_schedule(bld, records):
+    """
+    Print and return the predicted and the actual makespan of the build.
+
+    The prediction is the makespan of scheduling the tasks which ran, using
+    their historical durations and priorities, with the jobs of the build.
+    Without the duration of any of them, nothing is predicted.
+    """
+    ran = set(record[1] for record in records)
+    tasks = [task for task in wrapped_tasks
+             if getattr(task, 'statistics_serial', None) in ran]
+    names, durations, dependencies = historical_task_graph(bld, tasks)
+    actual = summarize_workers(records).get('span', 0.0)
+    if not any('time' in old_build_statistics.get(name, {})
+               for name in names if name is not None):
+        Logs.pprint('BOLD', '[ SCHED  ] prioritise {}: no history to '
+                    'predict the makespan, actual makespan {:0.3f} s'.format(
+                        schedule_mode, actual))
+        return {'mode': schedule_mode, 'predicted': None, 'actual': actual}
+
+    priorities = [task_priority(task) for task in tasks]
+    priorities += [0.0] * (len(names) - len(tasks))
+    predicted = simulate_schedule(
+        durations, dependencies, bld.jobs, priorities)
+
+    Logs.pprint('BOLD', '[ SCHED  ] prioritise {}: predicted makespan '
+                '{:0.3f} s, actual makespan {:0.3f} s'.format(
+                    schedule_mode, predicted, actual))
+    return {'mode': schedule_mode, 'predicted': predicted, 'actual': actual}
+
+
+class Progress(object):
+
+    """
+    Live estimate of the remaining time of the build.
+
+    Every task is expected to take its time in the previous build, or the
+    median time of the previous build if it is new. The remaining time is
+    the expected time of the tasks which have not finished, less the time
+    the running tasks have run so far, divided by the number of jobs. Tasks
+    are dropped as soon as waf finds them up to date. The estimate is
+    refreshed when tasks finish or are skipped, at most every interval
+    seconds, and is shown after waf's progress line of each task. Without
+    the times of a previous build nothing is estimated.
+    """
+
+    def __init__(self, jobs, interval=2.0):
+        """Create estimate."""
+        self.jobs = max(jobs, 1)
+        self.interval = interval
+        times = sorted(
+            stats['time']['value']
+            for key, stats in old_build_statistics.items()
+            if key != build_key and 'time' in stats)
+        self.default = times[len(times) // 2] if times else 0.0
+        self.history = bool(times)
+        self.pending = []
+        self.running = {}
+        self.finished = set()
+        self.lock = threading.Lock()
+        self.last = None
+        self.text = ''
+        self.samples = []
+
+    def add(self, task):
+        """Add a task, and show the estimate in its progress line."""
+        stats = old_build_statistics.get(task_name(task), {})
+        expected = stats.get('time', {}).get('value', self.default)
+        self.pending.append((task, expected))
+
+        runnable_status = getattr(task, 'runnable_status', None)
+        if runnable_status is not None:
+            def wrap_runnable_status():
+                status = runnable_status()
+                if status == Task.SKIP_ME:
+                    self.stop(task)
+                return status
+            task.runnable_status = wrap_runnable_status
+
+        display = getattr(task, 'display', None)
+        if display is None:
+            return
+
+        def wrap_display():
+            text = display()
+            self.refresh(clock())
+            if text and text.endswith('\n'):
+                return text[:-1] + self.text + '\n'
+            return text
+        task.display = wrap_display
+
+    def start(self, task, now):
+        """Mark a task as running."""
+        self.running[id(task)] = now
+
+    def stop(self, task):
+        """Mark a task as finished, or skipped, and refresh the estimate."""
+        self.finished.add(id(task))
+        self.running.pop(id(task), None)
+        self.refresh(clock())
+
+    def refresh(self, now):
+        """Refresh the estimate, unless it has been refreshed recently."""
+        if not self.history or \
+                self.last is not None and now - self.last < self.interval:
+            return
+        # another thread is refreshing it.
+        if not self.lock.acquire(False):
+            return
+        try:
+            self.last = now
+            pending = []
+            work = 0.0
+            for task, expected in self.pending:
+                if id(task) in self.finished or task.hasrun != Task.NOT_RUN:
+                    continue
+                pending.append((task, expected))
+                start = self.running.get(id(task))
+                if start is None:
+                    work += expected
+                else:
+                    work += max(expected - (now - start), 0.0)
+            self.pending = pending
+            remaining = work / self.jobs
+            self.samples.append([now - build_start, remaining])
+            self.text = ' (eta {})'.format(format_duration(remaining))
+        finally:
+            self.lock.release()
+
+    def report(self, end):
+        """
+        Return how accurate the estimates were.
+
+        end is the time the build finished, relative to its start. The error
+        of an estimate is the difference between the predicted and the
+        actual end of the build.
+        """
+        errors = [start + remaining - end for start, remaining in self.samples]
+        return {
+            'actual': end,
+            'predicted': self.samples[0][0] + self.samples[0][1]
+            if self.samples else None,
+            'mean_error': sum(abs(e) for e in errors) / len(errors)
+            if errors else None,
+            'samples': self.samples}
+
+
+def format_duration(seconds):
+    """Format a duration as e.g. 1h02m03s."""
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '{}h{:02d}m{:02d}s'.format(hours, minutes, seconds)
+    if minutes:
+        return '{}m{:02d}s'.format(minutes, seconds)
+    return '{}s'.format(seconds)
+
+
+def print_progress_report(report):
+    """Print how accurate the estimates of the remaining time were."""
+    if report['predicted'] is None:
+        return
+    Logs.pprint('BOLD', '[ ETA    ] predicted {predicted:0.3f} s at the '
+                'start, took {actual:0.3f} s, mean error {mean_error:0.3f} s '
+                'over {count} estimates'.format(
+                    count=len(report['samples']), **report))
+
+
+class Phases(object):
+
+    """
+    Timings of what waf does besides running the tasks.
+
+    The wscripts are timed by the pre_recurse and post_recurse hooks of the
+    context, with and without the wscripts they recurse into. The posting
+    of each task generator is timed without the task generators it posts
+    in turn, and the signatures of its tasks, including the scan for their
+    implicit dependencies, are added up. The start of the recursion and of
+    the build are marked, so the time spent restoring the build before the
+    wscripts run is known too.
+    """
+
+    def __init__(self):
+        """Create timings, starting now."""
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.marks = {'start': clock()}
+        self.recursions = []
+        self.posts = []
+        self.wscripts = {}
+        self.generators = {}
+        self.totals = {'post': 0.0, 'signature': 0.0}
+
+    def hook(self, ctx):
+        """Time the wscripts a context recurses into, and its build."""
+        pre_recurse = ctx.pre_recurse
+        post_recurse = ctx.post_recurse
+
+        def timed_pre_recurse(node):
+            if 'recurse' not in self.marks:
+                self.marks['recurse'] = clock()
+            self.recursions.append([node, clock(), 0.0])
+            pre_recurse(node)
+
+        def timed_post_recurse(node):
+            post_recurse(node)
+            # the wscript which loaded the tool started before the hook.
+            if not self.recursions or self.recursions[-1][0] is not node:
+                return
+            _, start, children = self.recursions.pop()
+            elapsed = clock() - start
+            if self.recursions:
+                self.recursions[-1][2] += elapsed
+            wscript = self.wscripts.setdefault(
+                node.path_from(ctx.srcnode), {'time': 0.0, 'self': 0.0})
+            wscript['time'] += elapsed
+            wscript['self'] += elapsed - children
+
+        ctx.pre_recurse = timed_pre_recurse
+        ctx.post_recurse = timed_post_recurse
+
+        pre_build = getattr(ctx, 'pre_build', None)
+        if pre_build is not None:
+            def timed_pre_build():
+                self.marks['build'] = clock()
+                pre_build()
+            ctx.pre_build = timed_pre_build
+
+    def add(self, generator, phase, elapsed):
+        """Add the time of a phase of a task generator."""
+        with self.lock:
+            self.totals[phase] += elapsed
+            timings = self.generators.setdefault(
+                generator, {'post': 0.0, 'signature': 0.0})
+            timings[phase] += elapsed
+
+    def time_post(self, generator, post):
+        """Post a task generator and add the time it took."""
+        if getattr(generator, 'posted', None):
+            return post(generator)
+        start = clock()
+        self.posts.append(0.0)
+        try:
+            return post(generator)
+        finally:
+            elapsed = clock() - start
+            children = self.posts.pop()
+            if self.posts:
+                self.posts[-1] += elapsed
+            self.add(
+                generator_name(generator), 'post', elapsed - children)
+
+    def time_signature(self, task, signature):
+        """Compute the signature of a task and add the time it took."""
+        # the signature is cached, and computed again if a rescan is needed.
+        if getattr(task, 'cache_sig', None) is not None or \
+                getattr(self.local, 'signing', False):
+            return signature(task)
+        self.local.signing = True
+        start = clock()
+        try:
+            return signature(task)
+        finally:
+            self.local.signing = False
+            self.add(generator_name(task.generator), 'signature',
+                     clock() - start)
+
+    def report(self):
+        """
+        Return the timings of the phases in seconds.
+
+        load is the time from the tool being set up to the first wscript,
+        recurse the time from the first wscript to the start of the build,
+        and build the time from then on, which includes the posting of the
+        task generators and the signatures.
+        """
+        now = clock()
+        marks = self.marks
+        recurse = marks.get('recurse', marks['start'])
+        build = marks.get('build', recurse)
+        return {
+            'load': recurse - marks['start'],
+            'recurse': build - recurse,
+            'build': now - build,
+            'post': self.totals['post'],
+            'signature': self.totals['signature'],
+            'wscripts': self.wscripts,
+            'task_generators': self.generators}
+
+
+def install_phases(ctx):
+    """
+    Start timing the phases of waf for a context.
+
+    task_gen.post and Task.signature are wrapped once, and time the phases
+    of the task generators while the timings are collected.
+    """
+    global phases
+    phases = Phases()
+    phases.hook(ctx)
+
+    post = TaskGen.task_gen.post
+    if not getattr(post, 'phases', False):
+        def timed_post(self):
+            if phases is None:
+                return post(self)
+            return phases.time_post(self, post)
+        timed_post.phases = True
+        TaskGen.task_gen.post = timed_post
+
+    signature = Task.Task.signature
+    if not getattr(signature, 'phases', False):
+        def timed_signature(self):
+            if phases is None:
+                return signature(self)
+            return phases.time_signature(self, signature)
+        timed_signature.phases = True
+        Task.Task.signature = timed_signature
+
+
+def read_configure_phases(folder):
+    """
+    Return the timings of the last configure, or None.
+
+    The timings are removed once read, so they are stored with the build
+    following the configure only.
+    """
+    path = os.path.join(folder, configure_phases_filename)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        timings = json.load(f)
+    os.remove(path)
+    return timings
+
+
+def print_phases(report, top=5):
+    """Print the timings of the phases and the slowest wscripts and tgens."""
+    Logs.pprint('BOLD', '[ PHASES ] load {load:0.3f} s, recurse '
+                '{recurse:0.3f} s, build {build:0.3f} s, post {post:0.3f} s, '
+                'signature {signature:0.3f} s'.format(**report))
+    wscripts = heapq.nlargest(
+        top, report['wscripts'].items(), key=lambda w: w[1]['self'])
+    for path, timings in wscripts:
+        Logs.pprint('CYAN', '[ PHASE  ] wscript {} {:0.3f} s'.format(
+            path, timings['self']))
+    generators = heapq.nlargest(
+        top, report['task_generators'].items(),
+        key=lambda g: g[1]['post'] + g[1]['signature'])
+    for name, timings in generators:
+        Logs.pprint('CYAN', '[ PHASE  ] {} post {:0.3f} s, signature '
+                    '{:0.3f} s'.format(
+                        name, timings['post'], timings['signature']))
+
+
+# the fields of each sample of the system resources, see Sampler.
+sample_fields = [
+    'time', 'cpu', 'iowait', 'load', 'memory', 'swap', 'swap_in',
+    'swap_out', 'disk_read', 'disk_write', 'disk_busy', 'cpu_pressure',
+    'memory_pressure', 'io_pressure']
+
+
+def read_proc_counters(disks):
+    """
+    Read the counters of the system resources from /proc.
+
+    Counters which are not available, e.g. the pressure stall information
+    of older kernels, are left out.
+    """
+    counters = {}
+    try:
+        with open('/proc/stat') as f:
+            values = [int(v) for v in f.readline().split()[1:]]
+        counters['cpu_total'] = sum(values[:8])
+        counters['cpu_idle'] = values[3]
+        counters['cpu_iowait'] = values[4]
+    except (IOError, OSError, IndexError, ValueError):
+        pass
+
+    try:
+        with open('/proc/loadavg') as f:
+            counters['load'] = float(f.read().split()[0])
+    except (IOError, OSError, IndexError, ValueError):
+        pass
+
+    for path, names in [
+            ('/proc/meminfo', ('MemTotal', 'MemAvailable', 'SwapTotal',
+                               'SwapFree')),
+            ('/proc/vmstat', ('pswpin', 'pswpout'))]:
+        try:
+            with open(path) as f:
+                for line in f:
+                    fields = line.replace(':', ' ').split()
+                    if fields and fields[0] in names:
+                        counters[fields[0]] = int(fields[1])
+        except (IOError, OSError, IndexError, ValueError):
+            pass
+
+    try:
+        with open('/proc/diskstats') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 12 and fields[2] in disks:
+                    counters['disk:' + fields[2]] = (
+                        int(fields[5]), int(fields[9]), int(fields[12]))
+    except (IOError, OSError, ValueError):
+        pass
+
+    for resource in ('cpu', 'memory', 'io'):
+        try:
+            with open('/proc/pressure/' + resource) as f:
+                # some avg10=0.00 avg60=0.00 avg300=0.00 total=0
+                counters['pressure:' + resource] = \
+                    float(f.readline().split()[1].split('=')[1])
+        except (IOError, OSError, IndexError, ValueError):
+            pass
+    return counters
+
+
+def system_sample(timestamp, elapsed, previous, current, page_size):
+    """
+    Compute a sample of the system resources from two reads of /proc.
+
+    timestamp is the time of the sample relative to the start of sampling,
+    and elapsed the time since the previous read. cpu, iowait and memory
+    are fractions, swap is in kb, the swap and disk rates are in kb/s,
+    disk_busy is the fraction of the time the busiest disk was busy and the
+    pressures are the percentage of the last 10 s some tasks were stalled
+    on the resource. Returns a list ordered as sample_fields, with None for
+    what is not available.
+    """
+    sample = dict.fromkeys(sample_fields)
+    sample['time'] = timestamp
+    if 'cpu_total' in previous and 'cpu_total' in current:
+        total = float(current['cpu_total'] - previous['cpu_total'])
+        if total:
+            idle = current['cpu_idle'] - previous['cpu_idle']
+            iowait = current['cpu_iowait'] - previous['cpu_iowait']
+            sample['cpu'] = 1.0 - (idle + iowait) / total
+            sample['iowait'] = iowait / total
+    sample['load'] = current.get('load')
+    if current.get('MemTotal') and 'MemAvailable' in current:
+        sample['memory'] = \
+            1.0 - current['MemAvailable'] / float(current['MemTotal'])
+    if 'SwapTotal' in current and 'SwapFree' in current:
+        sample['swap'] = current['SwapTotal'] - current['SwapFree']
+    for name, field in [('pswpin', 'swap_in'), ('pswpout', 'swap_out')]:
+        if name in previous and name in current:
+            sample[field] = (current[name] - previous[name]) * \
+                page_size / 1024.0 / elapsed
+
+    disks = [key for key in current
+             if key.startswith('disk:') and key in previous]
+    if disks:
+        # diskstats counts sectors of 512 bytes and the busy time in ms.
+        deltas = [[c - p for c, p in zip(current[key], previous[key])]
+                  for key in disks]
+        sample['disk_read'] = sum(d[0] for d in deltas) / 2.0 / elapsed
+        sample['disk_write'] = sum(d[1] for d in deltas) / 2.0 / elapsed
+        sample['disk_busy'] = \
+            min(max(d[2] for d in deltas) / 1000.0 / elapsed, 1.0)
+
+    for resource in ('cpu', 'memory', 'io'):
+        sample[resource + '_pressure'] = current.get('pressure:' + resource)
+    return [sample[field] for field in sample_fields]
+
+
+class Sampler(threading.Thread):
+
+    """
+    Background thread sampling the system resources during the build.
+
+    Every interval seconds the counters in /proc are read and a sample is
+    computed from the difference to the previous read, see system_sample.
+    The time of a sample is relative to the start of the sampler.
+    The samples are kept in a ring buffer of the given size, so a long build
+    keeps only its latest samples, while the summary covers the whole
+    build.
+    """
+
+    def __init__(self, interval=1.0, size=3600):
+        """Create sampler."""
+        threading.Thread.__init__(self, name='build-statistics-sampler')
+        self.daemon = True
+        self.interval = interval
+        self.samples = collections.deque(maxlen=size)
+        self.stopped = threading.Event()
+        self.disks = set(
+            disk for disk in os.listdir('/sys/block')
+            if not disk.startswith(('loop', 'ram', 'zram'))) \
+            if os.path.isdir('/sys/block') else set()
+        self.page_size = os.sysconf('SC_PAGE_SIZE') \
+            if hasattr(os, 'sysconf') else 4096
+        self.count = 0
+        self.totals = {}
+        self.maxima = {}
+
+    def run(self):
+        """Sample until stopped."""
+        previous = read_proc_counters(self.disks)
+        start = last = clock()
+        while not self.stopped.wait(self.interval):
+            current = read_proc_counters(self.disks)
+            now = clock()
+            sample = system_sample(
+                now - start, now - last, previous, current, self.page_size)
+            self.add(sample)
+            previous, last = current, now
+
+    def add(self, sample):
+        """Add a sample to the buffer and the summary."""
+        self.samples.append(sample)
+        self.count += 1
+        for field, value in zip(sample_fields[1:], sample[1:]):
+            if value is None:
+                continue
+            self.totals[field] = self.totals.get(field, 0.0) + value
+            self.maxima[field] = max(self.maxima.get(field, value), value)
+
+    def stop(self):
+        """Stop sampling and wait for the thread to finish."""
+        self.stopped.set()
+        self.join()
+
+    def report(self):
+        """Return the summary of the samples and the samples in the buffer."""
+        return {
+            'interval': self.interval,
+            'samples': self.count,
+            'mean': dict((field, total / self.count)
+                         for field, total in self.totals.items()),
+            'max': self.maxima,
+            'series': {
+                'fields': sample_fields,
+                'values': [[None if v is None else round(v, 4) for v in s]
+                           for s in self.samples]}}
+
+
+def start_sampler(bld):
+    """Start sampling the system resources, if /proc is available."""
+    global sampler
+    if not os.path.exists('/proc/stat'):
+        Logs.warn('Sampling the system resources requires /proc.')
+        sampler = False
+        return
+    interval = bld.get_tool_option('sample')
+    interval = 1.0 if interval is True else float(interval)
+    sampler = Sampler(interval)
+    sampler.start()
+
+
+def stop_sampler():
+    """Stop sampling the system resources and return the report."""
+    sampler.stop()
+    return sampler.report()
+
+
+def print_system(report):
+    """Print the summary of the system resources during the build."""
+    mean = report['mean']
+    maxima = report['max']
+    message = '[ SYSTEM ] {} samples'.format(report['samples'])
+    for field, label, scale, unit in [
+            ('cpu', 'cpu', 100, '%'), ('iowait', 'iowait', 100, '%'),
+            ('load', 'load', 1, ''), ('memory', 'memory', 100, '%'),
+            ('swap_out', 'swap out', 1, 'kb/s'),
+            ('disk_busy', 'disk busy', 100, '%')]:
+        if field in mean:
+            message += ', {} {:0.1f}{} (max {:0.1f}{})'.format(
+                label, mean[field] * scale, unit, maxima[field] * scale,
+                unit)
+    Logs.pprint('BOLD', message)
+
+
+def export_trace(path, records, tasks):
+    """
+    Write the build as a timeline in the trace event format.
+
+    The file can be opened with Perfetto or chrome://tracing. Each task is
+    a span on the worker thread which ran it, with its outputs, size and cpu
+    time as arguments. The events are written one by one, so the whole
+    document is never kept in memory.
+    """
+    classes = dict(
+        (getattr(task, 'statistics_serial', None), task.__class__.__name__)
+        for task in tasks)
+    origin = min(record[0] for record in records) if records else 0.0
+    threads = {}
+
+    with open(path, 'w') as trace:
+        trace.write('{"displayTimeUnit": "ms", "traceEvents": [\n')
+        separator = ''
+        for start, serial, worker, stop, keys, stats, sizes in records:
+            if worker not in threads:
+                threads[worker] = len(threads) + 1
+                trace.write(separator + json.dumps({
+                    'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                    'tid': threads[worker], 'args': {'name': worker}}))
+                separator = ',\n'
+
+            args = {'outputs': keys}
+            if sizes and None not in sizes:
+                args['size_kb'] = sum(sizes)
+            if 'cpu_user' in stats:
+                args['cpu_s'] = \
+                    stats['cpu_user']['value'] + stats['cpu_system']['value']
+                args['peak_rss_kb'] = stats['peak_rss']['value']
+
+            trace.write(separator + json.dumps({
+                'name': keys[0] if keys else classes.get(serial, 'task'),
+                'cat': classes.get(serial, 'task'),
+                'ph': 'X',
+                'pid': 1,
+                'tid': threads[worker],
+                'ts': (start - origin) * 1e6,
+                'dur': (stop - start) * 1e6,
+                'args': args}))
+            separator = ',\n'
+        trace.write('\n]}\n')
+
 
-old_build_statistics = {}
-new_build_statistics = {}
+# separators between the events of a trace.
+trace_separators = re.compile(r'[\s,]*')
 
 
-@TaskGen.feature('*')
-@TaskGen.before_method('process_source')
-def get_data(self):
+def iterate_trace_events(path, chunk_size=1 << 16):
     """
-    Read past build statistics.
+    Iterate over the events of a trace event json file.
 
-    Before processing any sources read the past build statistics.
+    The file is read in chunks and the events of the traceEvents array are
+    decoded one at a time, so a large trace is never loaded at once. A
+    truncated file ends the iteration.
     """
-    if not old_build_statistics:
-        f = os.path.join(self.bld.bldnode.srcpath(), filename)
-        if os.path.exists(f):
-            with open(f) as data_file:
-                old_build_statistics.update(json.load(data_file))
+    decoder = json.JSONDecoder()
+    with io.open(path, encoding='utf-8', errors='replace') as f:
+        buffer = ''
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            buffer += chunk
+            start = buffer.find('"traceEvents"')
+            if start < 0:
+                # keep the end, in case the key is split between chunks.
+                buffer = buffer[-len('"traceEvents"'):]
+                continue
+            start = buffer.find('[', start)
+            if start >= 0:
+                break
+        position = start + 1
+
+        while True:
+            position = trace_separators.match(buffer, position).end()
+            if position == len(buffer):
+                buffer = f.read(chunk_size)
+                position = 0
+                if not buffer:
+                    return
+                continue
+            if buffer[position] == ']':
+                return
+            try:
+                event, position = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # the event continues in the next chunk.
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            yield event
 
 
-@TaskGen.feature('*')
-@TaskGen.after_method('process_source')
-def collect_data_from_tasks(self):
+def read_time_trace(path):
     """
-    Wrap tasks to collect information from them.
+    Summarize the -ftime-trace output of a translation unit.
 
-    This function wraps each task with the collect_data_from_run function so
-    that the needed data is collected.
+    Returns the time in s spent parsing each included file, instantiating
+    each template, and in the front end and back end of the compiler. The
+    time of an included file includes the files it includes.
     """
-    tasks = []
-    if hasattr(self, 'compiled_tasks'):
-        tasks = self.compiled_tasks
+    summary = {'headers': {}, 'templates': {}, 'frontend': 0.0,
+               'backend': 0.0}
+    for event in iterate_trace_events(path):
+        if event.get('ph') != 'X' or 'dur' not in event:
+            continue
+        name = event.get('name')
+        duration = event['dur'] / 1e6
+        if name == 'Source':
+            totals = summary['headers']
+        elif name in ('InstantiateClass', 'InstantiateFunction'):
+            totals = summary['templates']
+        elif name == 'Frontend':
+            summary['frontend'] += duration
+            continue
+        elif name == 'Backend':
+            summary['backend'] += duration
+            continue
+        else:
+            continue
+        detail = event.get('args', {}).get('detail')
+        if detail:
+            totals[detail] = totals.get(detail, 0.0) + duration
+    return summary
 
-    if hasattr(self, 'link_task'):
-        tasks.append(self.link_task)
 
-    for task in tasks:
-        task.run = collect_data_from_run(task.run, task)
-        for output in task.outputs:
-            new_build_statistics[output.bldpath()] = {}
+def time_trace_path(path):
+    """Return the path clang writes the -ftime-trace output of an object to."""
+    return os.path.splitext(path)[0] + '.json'
 
-    if 'post_funs' not in dir(self.bld) or get_sizes not in self.bld.post_funs:
-        self.bld.add_post_fun(get_sizes)
 
-    if 'post_funs' not in dir(self.bld) or save_data not in self.bld.post_funs:
-        self.bld.add_post_fun(save_data)
+def collect_time_traces(folder, statistics, top=20):
+    """
+    Combine the -ftime-trace output of every translation unit in the build.
 
+    The summary of each translation unit is cached in a file next to the
+    statistics, so only the traces of the objects rebuilt are read. Returns
+    the number of translation units, the total front end and back end time
+    and the top included files and templates by total time, with the number
+    of translation units they appear in.
+    """
+    path = os.path.join(folder, time_trace_filename)
+    cache = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            cache = json.load(f)
 
-def get_sizes(self):
-    """Collect sizes of all output generated by tasks."""
-    tasks = []
-    for group in self.groups:
-        for task_gen in group:
-            tasks += task_gen.tasks
+    units = {}
+    for key, stats in statistics.items():
+        if key not in output_paths:
+            continue
+        if key in cache and 'time' not in stats:
+            units[key] = cache[key]
+            continue
+        trace = time_trace_path(output_paths[key])
+        if os.path.exists(trace):
+            units[key] = read_time_trace(trace)
 
-    for task in tasks:
-        for output in task.outputs:
-            key = output.bldpath()
-            value = os.path.getsize(output.srcpath()) / 1024.0
-            new_build_statistics[key]['size'] = {'value': value, 'unit': 'kb'}
+    with open(path, 'w') as f:
+        json.dump(units, f)
 
+    index = {'units': len(units), 'frontend': 0.0, 'backend': 0.0}
+    for kind in ('headers', 'templates'):
+        totals = {}
+        for unit in units.values():
+            for name, duration in unit[kind].items():
+                total = totals.get(name)
+                if total is None:
+                    total = totals[name] = [0.0, 0]
+                total[0] += duration
+                total[1] += 1
+        index[kind] = [[name, total[0], total[1]] for name, total in
+                       heapq.nlargest(top, totals.items(),
+                                      key=lambda item: item[1][0])]
+    for unit in units.values():
+        index['frontend'] += unit['frontend']
+        index['backend'] += unit['backend']
+    return index
 
-def collect_data_from_run(f, task):
-    """Collect compile time from task."""
-    def wrap_run():
-        start = time.time()
-        return_value = f()
-        stop = time.time()
+
+def print_time_trace(index, top=10):
+    """Print the most expensive included files and templates."""
+    if not index['units']:
+        return
+    Logs.pprint('BOLD', '[ TRACE  ] {units} translation units, front end '
+                '{frontend:0.3f} s, back end {backend:0.3f} s'.format(**index))
+    for kind, label in [('headers', 'HEADER'), ('templates', 'TMPL')]:
+        for name, duration, units in index[kind][:top]:
+            Logs.pprint('CYAN', '[ {:<6} ] {} {:0.3f} s in {} units'.format(
+                label, name, duration, units))
+
+
+def task_cost(stats):
+    """
+    Return what running a task again costs, in seconds.
+
+    The cpu time of the processes started by the task is used if it was
+    accounted, otherwise its wall time.
+    """
+    if 'cpu_user' in stats:
+        return stats['cpu_user']['value'] + \
+            stats.get('cpu_system', {}).get('value', 0.0)
+    return stats.get('time', {}).get('value', 0.0)
+
+
+def update_dependency_index(bld, tasks, statistics):
+    """
+    Update the index of the files each task depends on.
+
+    The inputs of a task are its sources, the nodes it depends on, e.g. the
+    libraries a binary is linked with, and the headers found by the
+    dependency scan of waf, kept in bld.node_deps. Only the tasks which ran
+    can have new inputs, the inputs of the other tasks are taken from the
+    previous index, which is not written again if no task ran. The index
+    is written with the tasks using each file, the tasks using the outputs
+    of each task, and the cost of each task, see DependencyIndex. Files are
+    named by their path relative to the top folder of the project, so the
+    names do not depend on where waf is run from.
+    """
+    path = os.path.join(bld.bldnode.srcpath(), dependencies_filename)
+    previous = read_dependency_index(path)
+    tasks = [task for task in tasks if task.outputs]
+    names = [task_name(task) for task in tasks]
+    ran = set(name for name in names
+              if 'time' in new_build_statistics.get(name, {}))
+    if previous is not None and previous.names == names and not ran:
+        return
+    old_inputs = previous.inputs() if previous is not None else {}
+    paths = {}
+
+    def relpath(node):
+        try:
+            return paths[node]
+        except KeyError:
+            value = paths[node] = node.path_from(bld.srcnode)
+            return value
+
+    inputs = []
+    costs = array.array('d')
+    producers = {}
+    for task, name in zip(tasks, names):
+        if name in old_inputs and name not in ran:
+            inputs.append(old_inputs[name])
+        else:
+            nodes = itertools.chain(
+                task.inputs, getattr(task, 'dep_nodes', ()),
+                bld.node_deps.get(task.uid(), ()))
+            inputs.append(sorted(set(relpath(node) for node in nodes)))
         for output in task.outputs:
-            key = output.bldpath()
-            value = (stop - start)
-            new_build_statistics[key]['time'] = {'value': value, 'unit': 's'}
+            producers[relpath(output)] = len(costs)
+        costs.append(task_cost(statistics.get(name, {})))
 
-        return return_value
-    return wrap_run
+    files = sorted(set(itertools.chain.from_iterable(inputs)))
+    file_ids = dict(zip(files, range(len(files))))
+    users = [[] for _ in files]
+    consumers = [[] for _ in names]
+    for task, task_inputs in enumerate(inputs):
+        for name in task_inputs:
+            users[file_ids[name]].append(task)
+            producer = producers.get(name)
+            if producer is not None and producer != task:
+                consumers[producer].append(task)
 
+    file_tasks, file_offsets = _flatten(users)
+    task_consumers, consumer_offsets = _flatten(consumers)
+    task_inputs, input_offsets = _flatten(
+        [file_ids[name] for name in task_inputs] for task_inputs in inputs)
+    produced = array.array('b', [name in producers for name in files])
+    write_sections(path, dependencies_magic, {}, [
+        ('files', '\n'.join(files).encode('utf-8')),
+        ('produced', _array_bytes(produced)),
+        ('file_tasks', _array_bytes(file_tasks)),
+        ('file_offsets', _array_bytes(file_offsets)),
+        ('tasks', '\n'.join(names).encode('utf-8')),
+        ('costs', _array_bytes(costs)),
+        ('task_consumers', _array_bytes(task_consumers)),
+        ('consumer_offsets', _array_bytes(consumer_offsets)),
+        ('task_inputs', _array_bytes(task_inputs)),
+        ('input_offsets', _array_bytes(input_offsets))])
+
+
+def _flatten(lists):
+    """Return lists of numbers as one array and the offsets of each list."""
+    values = array.array('I')
+    offsets = array.array('I', [0])
+    for items in lists:
+        values.extend(items)
+        offsets.append(len(values))
+    return values, offsets
+
+
+def read_dependency_index(path):
+    """Return the dependency index, or None if there is none."""
+    if not os.path.exists(path):
+        return None
+    try:
+        return DependencyIndex(path)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class DependencyIndex(MappedSections):
 
-def save_data(self):
     """
-    Save the collected data to a json file.
+    Index of the files the outputs of a build depend on.
 
-    This function writes all the collected data to a file, and, if any changes
-    happened, writes a summary.
+    A change to some files rebuilds the tasks using them, and the tasks
+    using the outputs of those, and so on. Only the parts of the index on
+    that path are used, so the rebuild of any change is predicted in
+    milliseconds. The tasks downstream of each task are memoised, so
+    ranking every file visits each task once.
     """
-    build_statistics = {}
 
-    for k in new_build_statistics:
-        if k not in old_build_statistics:
-            build_statistics[k] = new_build_statistics[k]
-            continue
+    description = 'dependency index'
 
-        build_statistics[k] = old_build_statistics[k].copy()
-        build_statistics[k].update(new_build_statistics[k])
+    def __init__(self, path):
+        """Map the index and read the files and tasks."""
+        MappedSections.__init__(self, path, dependencies_magic)
+        self.files = self.lines('files')
+        self.names = self.lines('tasks')
+        self.costs = self.array('costs', 'd')
+        self.file_tasks = self.array('file_tasks', 'I')
+        self.file_offsets = self.array('file_offsets', 'I')
+        self.task_consumers = self.array('task_consumers', 'I')
+        self.consumer_offsets = self.array('consumer_offsets', 'I')
+        self.downstream_tasks = {}
 
-    compare_stats = old_build_statistics
-    compare_with = 'previous build'
+    def inputs(self):
+        """Return the inputs of every task."""
+        task_inputs = self.array('task_inputs', 'I')
+        offsets = self.array('input_offsets', 'I')
+        files = self.files
+        return dict(
+            (name, [files[i] for i in
+                    task_inputs[offsets[task]:offsets[task + 1]]])
+            for task, name in enumerate(self.names))
 
-    if self.has_tool_option('compare_with'):
-        compare_with = self.get_tool_option('compare_with')
-        if os.path.exists(compare_with):
-            with open(compare_with) as data_file:
-                compare_stats = json.load(data_file)
+    def users(self, path):
+        """Return the tasks using a file, or None if it is not indexed."""
+        i = bisect.bisect_left(self.files, path)
+        if i == len(self.files) or self.files[i] != path:
+            return None
+        return self.file_tasks[self.file_offsets[i]:self.file_offsets[i + 1]]
+
+    def downstream(self, task):
+        """Return the tasks which run when a task runs, itself included."""
+        tasks = self.downstream_tasks.get(task)
+        if tasks is None:
+            tasks = set([task])
+            start = self.consumer_offsets[task]
+            for consumer in self.task_consumers[
+                    start:self.consumer_offsets[task + 1]]:
+                tasks.update(self.downstream(consumer))
+            tasks = self.downstream_tasks[task] = frozenset(tasks)
+        return tasks
+
+    def rebuilt(self, paths):
+        """Return the tasks rebuilt when files change, and the unknown."""
+        tasks = set()
+        unknown = []
+        for path in paths:
+            users = self.users(path)
+            if users is None:
+                unknown.append(path)
+                continue
+            for task in users:
+                tasks.update(self.downstream(task))
+        return tasks, unknown
+
+    def impact(self, paths, top=10):
+        """
+        Return what changing files rebuilds.
+
+        Returns the number of outputs rebuilt and their total cost, the most
+        expensive top outputs, all if top is 0, and the files no output
+        depends on.
+        """
+        tasks, unknown = self.rebuilt(paths)
+        costs = self.costs
+        if top:
+            tasks_shown = heapq.nlargest(top, tasks, key=costs.__getitem__)
         else:
-            compare_stats = {}
-            Logs.warn('{} does not exists.'.format(compare_with))
+            tasks_shown = sorted(tasks, key=costs.__getitem__, reverse=True)
+        return {
+            'outputs': len(tasks),
+            'cost': sum(costs[task] for task in tasks),
+            'top': [[self.names[task], costs[task]] for task in tasks_shown],
+            'unknown': unknown}
+
+    def rank(self, top=10):
+        """
+        Return the source files whose change costs the most to rebuild.
+
+        Returns the top files, with the cost of a change and the number of
+        outputs it rebuilds.
+        """
+        produced = self.array('produced', 'b')
+        costs = self.costs
+        ranking = []
+        for i, path in enumerate(self.files):
+            if produced[i]:
+                continue
+            tasks, _ = self.rebuilt([path])
+            ranking.append(
+                [path, sum(costs[task] for task in tasks), len(tasks)])
+        return heapq.nlargest(top or len(ranking), ranking,
+                              key=lambda item: item[1])
 
-    stats_limit = 0
-    if self.has_tool_option('stats_limit'):
-        stats_limit = int(self.get_tool_option('stats_limit'))
 
-    if compare_stats or stats_limit < 0:
-        summaries = generate_summaries(compare_stats, build_statistics)
-        print_summaries(summaries, stats_limit)
+def print_impact(impact, files):
+    """Print the outputs rebuilt by a change and its cost."""
+    Logs.pprint('BOLD', '[ IMPACT ] {} files rebuild {} outputs, {:0.3f} s'
+                .format(files, impact['outputs'], impact['cost']))
+    for name, cost in impact['top']:
+        Logs.pprint('CYAN', '[ OUTPUT ]  {} {:0.3f} s'.format(name, cost))
+    for path in impact['unknown']:
+        Logs.pprint('PINK', '[ UNUSED ]  {}'.format(path))
 
-    f = os.path.join(self.bldnode.srcpath(), filename)
-    with open(f, 'w') as outfile:
-        json.dump(build_statistics, outfile)
+
+def print_ranking(ranking):
+    """Print the files whose change costs the most to rebuild."""
+    for path, cost, outputs in ranking:
+        Logs.pprint('CYAN', '[ RANK   ] {} {:0.3f} s, {} outputs'.format(
+            path, cost, outputs))
 
 
 def generate_summaries(a, b):
     """Generate data summarising the changes between the a and b dict."""
-    summaries = []
+    return list(iterate_summaries(a, b))
 
-    # removed
-    for key in set(a) - set(b):
-        summaries.append(generate_removed_summary(key, a))
 
-    # added
-    for key in set(b) - set(a):
-        summaries.append(generate_added_summary(key, b))
+def iterate_summaries(a, b):
+    """
+    Iterate over summaries of the changes between the a and b dict.
 
-    # changed
-    for key in set(a) & set(b):
-        summaries.append(generate_changed_summary(key, a, b))
+    The summaries are generated one at a time, so a large set of changes is
+    never held in memory at once. Summaries without results are left out,
+    e.g. of a task without outputs which only has a status as it did not
+    run.
+    """
+    a_outputs = set(a) - set([build_key])
+    b_outputs = set(b) - set([build_key])
 
-    return summaries
+    summaries = itertools.chain(
+        (generate_removed_summary(key, a) for key in a_outputs - b_outputs),
+        (generate_added_summary(key, b) for key in b_outputs - a_outputs),
+        (generate_changed_summary(key, a, b)
+         for key in a_outputs & b_outputs))
+    for summary in summaries:
+        if summary['results']:
+            yield summary
+
+
+def is_number(value):
+    """Return whether a stat is a number, as opposed to e.g. a status."""
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
 
 
 def generate_changed_summary(key, a, b):
@@ -164,17 +3690,21 @@ def generate_changed_summary(key, a, b):
     for stat in set(a) & set(b):
         a_stat = a[stat]
         b_stat = b[stat]
+        if not is_number(a_stat['value']) or not is_number(b_stat['value']):
+            continue
         assert a_stat['unit'] == b_stat['unit']
 
         difference = b_stat['value'] - a_stat['value']
-        percent = difference / a_stat['value'] * 100
         result['results'][stat] = {
             'unit':  b_stat['unit'],
             'value': b_stat['value'],
             'value_old': a_stat['value'],
-            'difference': difference,
-            'percent': percent
+            'difference': difference
         }
+        # e.g. the system cpu time of a task may well be zero.
+        if a_stat['value']:
+            result['results'][stat]['percent'] = \
+                difference / a_stat['value'] * 100
 
     return result
 
@@ -186,6 +3716,8 @@ def generate_removed_summary(key, a):
     result['results'] = {}
     for stat in a:
         a_stat = a[stat]
+        if not is_number(a_stat['value']):
+            continue
         result['results'][stat] = {
             'unit': a_stat['unit'],
             'value': 0,
@@ -203,6 +3735,8 @@ def generate_added_summary(key, b):
     result['results'] = {}
     for stat in b:
         b_stat = b[stat]
+        if not is_number(b_stat['value']):
+            continue
         result['results'][stat] = {
             'unit':  b_stat['unit'],
             'value': b_stat['value'],
@@ -223,6 +3757,9 @@ def print_results(results):
         if 'percent' in result:
             message += ' ({percent:0.3f} %)'
 
+        if 'score' in result:
+            message += '\n[        ]       score {score:0.1f}'
+
         color = 'CYAN'
         if result['difference'] > 0:
             color = 'PINK'
@@ -249,7 +3786,7 @@ def print_summaries(summaries, limit=0):
         total_state[summary['state']] += 1
         if total_summary is None:
             total_summary = {k: {'value': 0, 'value_old': 0} for k in results}
-        for stat in total_summary.keys():
+        for stat in list(total_summary.keys()):
             # if, for some reason, the total summary's results contains an
             # attribute not available for this set of results, we consider that
             # attribute void and remove it from the total summary.
@@ -272,6 +3809,904 @@ def print_summaries(summaries, limit=0):
             total_result = total_summary[result]
             total_result['difference'] = \
                 total_result['value'] - total_result['value_old']
-            total_result['percent'] = \
-                total_result['difference'] / total_result['value_old'] * 100
+            if total_result['value_old']:
+                total_result['percent'] = (
+                    total_result['difference'] /
+                    total_result['value_old'] * 100)
         print_results(total_summary)
+
+
+def write_diff(path, summaries):
+    """Write every summary to a file, one json line each, and pass it on."""
+    with open(path, 'w') as f:
+        for summary in summaries:
+            f.write(json.dumps(summary) + '\n')
+            yield summary
+
+
+def output_kind(key):
+    """Return the kind of an output, if it was not seen in this build."""
+    if os.path.splitext(key)[1] in ('.o', '.obj'):
+        return 'object'
+    return 'binary'
+
+
+def _add_totals(totals, results):
+    """Add the values of results to the totals of each stat."""
+    for stat, result in results.items():
+        total = totals.get(stat)
+        if total is None:
+            total = totals[stat] = {
+                'unit': result['unit'], 'value': 0, 'value_old': 0}
+        total['value'] += result['value']
+        total['value_old'] += result['value_old']
+
+
+def _finish_totals(totals):
+    """Compute the difference and percent of totals."""
+    for total in totals.values():
+        total['difference'] = total['value'] - total['value_old']
+        if total['value_old']:
+            total['percent'] = total['difference'] / total['value_old'] * 100
+    return totals
+
+
+def report_summaries(summaries, top=10, stat='time', limit=0):
+    """
+    Report the top changes and the totals rolled up by group.
+
+    The summaries are consumed one at a time. Only the top changed outputs
+    with the largest increase and decrease of the stat are kept, and the
+    totals are rolled up by the kind of output, by task generator and by
+    directory, so the memory used does not depend on the number of changes.
+    Summaries where every difference is at or below the limit are left out,
+    as in print_summaries.
+    """
+    states = {'removed': 0, 'added': 0, 'changed': 0}
+    kinds = {}
+    generators = {}
+    directories = {}
+    regressions = []
+    improvements = []
+    serial = itertools.count()
+    for summary in summaries:
+        results = summary['results']
+        if all([abs(r['difference']) <= limit for r in results.values()]):
+            continue
+        states[summary['state']] += 1
+
+        key = summary['file']
+        generator, kind = output_owners.get(key, ('', None))
+        if kind is None:
+            kind = output_kind(key)
+        _add_totals(kinds.setdefault(kind, {}), results)
+        _add_totals(
+            generators.setdefault(generator or '(unknown)', {}), results)
+        _add_totals(
+            directories.setdefault(os.path.dirname(key), {}), results)
+
+        if summary['state'] != 'changed' or stat not in results:
+            continue
+        difference = results[stat]['difference']
+        if difference > 0:
+            heap = regressions
+        elif difference < 0:
+            heap = improvements
+        else:
+            continue
+        entry = (abs(difference), next(serial), summary)
+        if len(heap) < top:
+            heapq.heappush(heap, entry)
+        elif entry[0] > heap[0][0]:
+            heapq.heapreplace(heap, entry)
+
+    # roll the directories up into their parents. A parent is shorter than
+    # its children, so it is complete before it is rolled up itself.
+    for directory in list(directories):
+        parent = os.path.dirname(directory)
+        while directory and parent != directory:
+            directories.setdefault(parent, {})
+            directory, parent = parent, os.path.dirname(parent)
+    for directory in sorted(directories, key=len, reverse=True):
+        parent = os.path.dirname(directory)
+        if directory and parent != directory:
+            _add_totals(directories[parent], directories[directory])
+    total = {}
+    for totals in kinds.values():
+        _add_totals(total, totals)
+
+    for groups in (kinds, generators, directories):
+        for totals in groups.values():
+            _finish_totals(totals)
+    return {
+        'stat': stat,
+        'states': states,
+        'total': _finish_totals(total),
+        'kinds': kinds,
+        'generators': generators,
+        'directories': directories,
+        'regressions': [e[2] for e in sorted(regressions, reverse=True)],
+        'improvements': [e[2] for e in sorted(improvements, reverse=True)]}
+
+
+def print_report(report, top=10):
+    """
+    Print a report of report_summaries as a short hierarchical summary.
+
+    The totals are followed by the top groups of each kind and the top
+    changed outputs. The top directories are printed in path order,
+    indented by their depth.
+    """
+    if not any(report['states'].values()):
+        return
+    stat = report['stat']
+    Logs.pprint('BOLD', '[ TOTAL  ] changed: {changed}, added: {added}, '
+                'removed: {removed}'.format(**report['states']))
+    print_results(report['total'])
+
+    for name, label in [('kinds', 'KIND'), ('generators', 'GEN'),
+                        ('directories', 'DIR')]:
+        groups = [(group, totals[stat])
+                  for group, totals in report[name].items()
+                  if stat in totals and totals[stat]['difference']]
+        groups = heapq.nlargest(
+            top, groups, key=lambda g: abs(g[1]['difference']))
+        if name == 'directories':
+            groups.sort(key=lambda g: g[0])
+        for group, result in groups:
+            if name == 'directories':
+                depth = group.count(os.sep) + 1 if group else 0
+                group = '  ' * depth + (group or '.')
+            message = ('[ {label:<6} ] {group}  {stat} {value_old:0.3f} -> '
+                       '{value:0.3f} {unit} ({difference:+0.3f} {unit})')
+            if 'percent' in result:
+                message += ' ({percent:+0.3f} %)'
+            color = 'PINK' if result['difference'] > 0 else 'CYAN'
+            Logs.pprint(color, message.format(
+                label=label, group=group, stat=stat, **result))
+
+    for name in ('regressions', 'improvements'):
+        if report[name]:
+            Logs.pprint('BOLD', '[ TOP    ] {} {} by {}'.format(
+                len(report[name]), name, stat))
+        for summary in report[name]:
+            Logs.pprint(
+                'BOLD', '[ FILE   ] {file} ({state})'.format(**summary))
+            print_results(summary['results'])
+
+
+def report_tree(statistics, compare, stats=('time', 'size'),
+                min_fraction=html_min_fraction):
+    """
+    Aggregate stats of the outputs into a tree of directories and targets.
+
+    Every node holds the totals of its outputs in statistics and in compare.
+    The outputs of a known task generator are grouped in a [target] node in
+    their directory. Nodes below min_fraction of the total of a stat in both
+    builds are merged into one node per parent, so the size of the tree is
+    bounded whatever the number of outputs. The tree is returned as columns:
+    the name and parent of each node, parents first, and the new and old
+    values of each stat.
+    """
+    names = ['.']
+    parents = [-1]
+    columns = dict((stat + suffix, [0.0]) for stat in stats
+                   for suffix in ('', '_old'))
+    units = {}
+    nodes = {}
+    chains = {}
+
+    def node(parent, name):
+        index = nodes.get((parent, name))
+        if index is None:
+            index = nodes[(parent, name)] = len(names)
+            names.append(name)
+            parents.append(parent)
+            for column in columns.values():
+                column.append(0.0)
+        return index
+
+    for outputs, suffix in [(statistics, ''), (compare, '_old')]:
+        for key, values in iterate_outputs(outputs):
+            values = [(stat, value, unit) for stat, value, unit in values
+                      if stat in stats and is_number(value)]
+            if not values:
+                continue
+            directory, _, name = key.rpartition(os.sep)
+            generator = output_owners.get(key, ('', None))[0]
+            chain = chains.get((directory, generator))
+            if chain is None:
+                chain = [0]
+                for part in directory.split(os.sep) if directory else []:
+                    chain.append(node(chain[-1], part))
+                if generator:
+                    chain.append(node(chain[-1], '[{}]'.format(generator)))
+                chains[(directory, generator)] = chain
+            leaf = node(chain[-1], name)
+            for stat, value, unit in values:
+                units[stat] = unit
+                columns[stat + suffix][leaf] += value
+
+    # the nodes are created after their parents, so the totals are added up
+    # in reverse order.
+    for column in columns.values():
+        for index in range(len(names) - 1, 0, -1):
+            column[parents[index]] += column[index]
+
+    # a node is only kept if its parent is, and the nodes which are merged
+    # are counted on their kept parent.
+    minimum = dict((stat, min_fraction * max(
+        columns[stat][0], columns[stat + '_old'][0])) for stat in stats)
+    tree = dict((column, []) for column in columns)
+    tree.update({'names': [], 'parents': [], 'units': units})
+    kept = {}
+    merged = {}
+    for index, name in enumerate(names):
+        parent = kept.get(parents[index], -1)
+        if index and (parent < 0 or all(
+                max(columns[stat][index], columns[stat + '_old'][index]) <
+                minimum[stat] for stat in stats)):
+            if parent >= 0:
+                merged.setdefault(parent, []).append(index)
+            continue
+        kept[index] = len(tree['names'])
+        tree['names'].append(name)
+        tree['parents'].append(parent)
+        for column, values in columns.items():
+            tree[column].append(round(values[index], 3))
+
+    for parent, indices in sorted(merged.items()):
+        tree['names'].append('({} more)'.format(len(indices)))
+        tree['parents'].append(parent)
+        for column, values in columns.items():
+            tree[column].append(
+                round(sum(values[index] for index in indices), 3))
+    return tree
+
+
+def write_html_report(path, tree, compared_with=None):
+    """
+    Write a self-contained html report of a tree of report_tree.
+
+    The report shows the time as an icicle and the size as a treemap, both
+    coloured by the change since the compared build, if any.
+    """
+    data = dict(tree, compared=compared_with)
+    # a </script> in a name must not end the script of the report.
+    data = json.dumps(data, separators=(',', ':')).replace('</', '<\\/')
+    with io.open(path, 'w', encoding='utf-8') as f:
+        f.write(html_template.replace('__DATA__', data))
+
+
+html_template = u'''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Build statistics</title>
+<style>
+body { font: 12px sans-serif; margin: 10px; }
+#view { position: relative; height: 600px; overflow: hidden; }
+#view div { position: absolute; box-sizing: border-box; overflow: hidden;
+            border: 1px solid #fff; padding: 1px 3px; white-space: nowrap;
+            text-overflow: ellipsis; cursor: pointer; }
+button.active { font-weight: bold; }
+</style>
+</head>
+<body>
+<p>
+<button id="time">Time</button>
+<button id="size">Size</button>
+<span id="path"></span>
+</p>
+<div id="view"></div>
+<script>
+var data = __DATA__;
+var names = data.names, parents = data.parents, children = [];
+var view = document.getElementById('view'), stat = 'time', root = 0;
+for (var i = 0; i < names.length; i++) children.push([]);
+for (var i = 1; i < names.length; i++) children[parents[i]].push(i);
+
+function value(i) { return data[stat][i]; }
+
+function path(i) {
+  var parts = [];
+  for (; i > 0; i = parents[i]) parts.unshift(names[i]);
+  return parts.join('/') || '.';
+}
+
+function colour(i) {
+  var v = value(i), o = data[stat + '_old'][i];
+  if (!data.compared) return 'hsl(210, 30%, 80%)';
+  if (!o) return v ? 'hsl(120, 45%, 75%)' : '#ddd';
+  var r = Math.max(-1, Math.min(1, (v - o) / o));
+  return r >= 0 ? 'hsl(0, ' + Math.round(r * 90) + '%, ' +
+                  Math.round(85 - r * 25) + '%)'
+                : 'hsl(220, ' + Math.round(-r * 90) + '%, ' +
+                  Math.round(85 + r * 25) + '%)';
+}
+
+function box(i, x, y, w, h) {
+  var div = document.createElement('div'), o = data[stat + '_old'][i];
+  var unit = ' ' + data.units[stat];
+  div.style.left = x + 'px';
+  div.style.top = y + 'px';
+  div.style.width = w + 'px';
+  div.style.height = h + 'px';
+  div.style.background = colour(i);
+  div.textContent = names[i];
+  div.title = path(i) + '\\n' + stat + ' ' + value(i) + unit;
+  if (data.compared && o) {
+    div.title += '\\n' + data.compared + ' ' + o + unit + ' (' +
+      ((value(i) - o) / o * 100).toFixed(1) + ' %)';
+  }
+  div.onclick = function() {
+    show(i === root ? Math.max(parents[i], 0) : i);
+  };
+  view.appendChild(div);
+}
+
+function sorted(i) {
+  return children[i].filter(function(c) { return value(c) > 0; })
+    .sort(function(a, b) { return value(b) - value(a); });
+}
+
+function icicle(i, x, w, depth) {
+  box(i, x, depth * 18, w, 18);
+  var total = value(i);
+  sorted(i).forEach(function(c) {
+    var width = w * value(c) / total;
+    if (width >= 2) icicle(c, x, width, depth + 1);
+    x += width;
+  });
+}
+
+function worst(row, side, scale) {
+  var sum = 0, max = 0, min = Infinity;
+  row.forEach(function(c) {
+    var area = value(c) * scale;
+    sum += area; max = Math.max(max, area); min = Math.min(min, area);
+  });
+  return Math.max(side * side * max / (sum * sum),
+                  sum * sum / (side * side * min));
+}
+
+function layout(row, rect, scale) {
+  var area = 0;
+  row.forEach(function(c) { area += value(c) * scale; });
+  var horizontal = rect.w >= rect.h;
+  var thickness = area / (horizontal ? rect.h : rect.w);
+  var offset = 0;
+  row.forEach(function(c) {
+    var length = value(c) * scale / thickness;
+    if (horizontal) treemap(c, rect.x, rect.y + offset, thickness, length);
+    else treemap(c, rect.x + offset, rect.y, length, thickness);
+    offset += length;
+  });
+  if (horizontal) { rect.x += thickness; rect.w -= thickness; }
+  else { rect.y += thickness; rect.h -= thickness; }
+}
+
+function treemap(i, x, y, w, h) {
+  var kids = sorted(i);
+  if (!kids.length || w < 40 || h < 40) { box(i, x, y, w, h); return; }
+  box(i, x, y, w, 16);
+  var rect = {x: x, y: y + 16, w: w, h: h - 16}, row = [], total = 0;
+  kids.forEach(function(c) { total += value(c); });
+  var scale = rect.w * rect.h / total;
+  kids.forEach(function(c) {
+    var side = Math.min(rect.w, rect.h);
+    if (row.length && worst(row.concat([c]), side, scale) >
+        worst(row, side, scale)) {
+      layout(row, rect, scale);
+      row = [];
+    }
+    row.push(c);
+  });
+  if (row.length) layout(row, rect, scale);
+}
+
+function show(i) {
+  root = i;
+  view.innerHTML = '';
+  document.getElementById('path').textContent = path(i);
+  ['time', 'size'].forEach(function(name) {
+    document.getElementById(name).className = name === stat ? 'active' : '';
+  });
+  if (!value(i)) return;
+  if (stat === 'time') icicle(i, 0, view.clientWidth, 0);
+  else treemap(i, 0, 0, view.clientWidth, view.clientHeight);
+}
+
+['time', 'size'].forEach(function(name) {
+  document.getElementById(name).onclick = function() {
+    stat = name;
+    show(root);
+  };
+});
+show(0);
+</script>
+</body>
+</html>
+'''
+
+
+def expand_paths(patterns):
+    """Return the files matching comma separated paths or glob patterns."""
+    paths = []
+    for pattern in patterns.split(','):
+        pattern = pattern.strip()
+        if pattern:
+            paths.extend(sorted(glob.glob(pattern)) or [pattern])
+    return paths
+
+
+def statistics_timestamp(path, statistics):
+    """Return the time a build was saved, or the time of its file."""
+    build = statistics.get(build_key) or {}
+    return build.get('timestamp') or os.path.getmtime(path)
+
+
+def iterate_outputs(statistics, shard=0, shards=1):
+    """
+    Iterate over the outputs as the key and a list of stat, value and unit.
+
+    With several shards only the outputs which hash to the given shard are
+    returned. The columns of compact statistics are read directly, without
+    building the stats of each output as a dict.
+    """
+    if isinstance(statistics, CompactStatistics):
+        keys = statistics.keys_list()
+        columns = [(stat, statistics.column(stat), unit)
+                   for stat, unit in statistics.units.items()]
+        for i, key in enumerate(keys):
+            if shards > 1 and hash(key) % shards != shard:
+                continue
+            yield key, [(stat, column[i], unit)
+                        for stat, column, unit in columns
+                        if column[i] == column[i] and column[i] != '']
+        return
+
+    for key, stats in statistics.items():
+        if key == build_key or (shards > 1 and hash(key) % shards != shard):
+            continue
+        yield key, [(stat, value['value'], value['unit'])
+                    for stat, value in stats.items()]
+
+
+def merge_statistics(paths, policy='latest', distributions=False, threads=8,
+                     shards=0):
+    """
+    Merge many statistics files into one.
+
+    The conflicting records of an output are resolved by the policy: the
+    value of the latest build, the minimum or the median. Stats which are
+    not numbers always take the latest value. With distributions the
+    minimum, maximum, mean and merge_percentiles of each stat across the
+    inputs are added as stats, e.g. time_p90, and the number of inputs with
+    the output as builds.
+
+    The files are read threads at a time and folded into the result, so
+    only that many are in memory at once. The median and the distributions
+    need every value, so when the values of the inputs exceed
+    merge_value_budget, the outputs are split by hash into shards which are
+    merged one pass over the inputs at a time.
+    """
+    if policy not in merge_policies:
+        raise ValueError('Unknown merge policy {!r}.'.format(policy))
+    keep_values = policy == 'median' or distributions
+    paths = list(paths)
+    threads = max(1, min(threads, len(paths)))
+
+    if not shards:
+        shards = 1
+        if keep_values and paths:
+            values = sum(len(stats) for _, stats in
+                         iterate_outputs(load_statistics(paths[0])))
+            shards = max(1, -(-values * len(paths) // merge_value_budget))
+
+    # the records are millions of small containers which never form cycles,
+    # tracking them only makes the garbage collector rescan them.
+    collect = gc.isenabled()
+    gc.disable()
+    merged = {}
+    inputs = []
+    pool = ThreadPool(threads)
+    try:
+        for shard in range(shards):
+            records = {}
+            for start in range(0, len(paths), threads):
+                batch = paths[start:start + threads]
+                for path, statistics in zip(
+                        batch, pool.map(load_statistics, batch)):
+                    timestamp = statistics_timestamp(path, statistics)
+                    if not shard:
+                        inputs.append({'path': path, 'timestamp': timestamp})
+                    _fold_statistics(
+                        records, iterate_outputs(statistics, shard, shards),
+                        timestamp, policy, keep_values)
+            _finish_merge(merged, records, policy, distributions)
+    finally:
+        pool.close()
+        pool.join()
+        if collect:
+            gc.enable()
+
+    merged[build_key] = {
+        'timestamp': max([i['timestamp'] for i in inputs] or [time.time()]),
+        'merge': {
+            'policy': policy,
+            'distributions': distributions,
+            'shards': shards,
+            'inputs': inputs}}
+    return merged
+
+
+def _fold_statistics(records, outputs, timestamp, policy, keep_values):
+    """
+    Fold the outputs of one input into the records of merge_statistics.
+
+    The record of an output is the number of inputs with it and an entry
+    per stat of the time, value and unit of the resolved value, and all the
+    values if they are kept.
+    """
+    minimum = policy == 'min'
+    for key, stats in outputs:
+        record = records.get(key)
+        if record is None:
+            records[key] = [1, dict(
+                (stat, _merge_entry(timestamp, value, unit, keep_values))
+                for stat, value, unit in stats)]
+            continue
+        record[0] += 1
+        entries = record[1]
+        for stat, value, unit in stats:
+            entry = entries.get(stat)
+            if entry is None:
+                entries[stat] = _merge_entry(
+                    timestamp, value, unit, keep_values)
+                continue
+            if minimum and is_number(value):
+                if value < entry[1]:
+                    entry[1] = value
+            elif timestamp >= entry[0]:
+                entry[0] = timestamp
+                entry[1] = value
+                entry[2] = unit
+            if entry[3] is not None:
+                entry[3].append(value)
+
+
+def _merge_entry(timestamp, value, unit, keep_values):
+    """Return the entry of a stat of an output first seen when merging."""
+    values = None
+    if keep_values and is_number(value):
+        values = array.array('d', [value])
+    return [timestamp, value, unit, values]
+
+
+def _finish_merge(merged, records, policy, distributions):
+    """Resolve the records of merge_statistics into merged statistics."""
+    for key, (builds, entries) in records.items():
+        stats = merged[key] = {}
+        for stat, (_, value, unit, values) in entries.items():
+            if values is not None:
+                values = sorted(values)
+                if policy == 'median':
+                    value = _median_of_sorted(values)
+                if distributions:
+                    count = len(values)
+                    for name, result in [
+                            ('min', values[0]), ('max', values[-1]),
+                            ('mean', sum(values) / count)] + [
+                            ('p{}'.format(p),
+                             values[max(0, -(-p * count // 100) - 1)])
+                            for p in merge_percentiles]:
+                        stats['{}_{}'.format(stat, name)] = {
+                            'value': result, 'unit': unit}
+            stats[stat] = {'value': value, 'unit': unit}
+        if distributions:
+            stats['builds'] = {'value': builds, 'unit': ''}
+
+
+def write_statistics(path, statistics):
+    """Write statistics to a file, in the compact format if it is .bin."""
+    if os.path.splitext(path)[1] == os.path.splitext(compact_filename)[1]:
+        write_compact(path, statistics)
+    else:
+        with open(path, 'w') as f:
+            json.dump(statistics, f)
+
+
+class MergeStatisticsContext(Context.Context):
+
+    """Merge statistics files, e.g. of the shards of a distributed build."""
+
+    cmd = 'merge_statistics'
+
+    def execute(self):
+        """Merge the input files and write the merged statistics."""
+        options = Options.options
+        paths = expand_paths(options.statistics_inputs)
+        if not paths:
+            self.fatal('No statistics to merge, use --statistics-inputs.')
+        missing = [path for path in paths if not os.path.exists(path)]
+        if missing:
+            self.fatal('{} does not exists.'.format(', '.join(missing)))
+
+        statistics = merge_statistics(
+            paths, options.merge_policy, options.merge_distributions,
+            options.merge_jobs, options.merge_shards)
+        write_statistics(options.statistics_output, statistics)
+        Logs.pprint('BOLD', '[ MERGE  ] {} outputs of {} builds ({}) -> '
+                    '{}'.format(len(statistics) - 1, len(paths),
+                                options.merge_policy,
+                                options.statistics_output))
+
+
+def open_statistics(path):
+    """
+    Open statistics for querying.
+
+    Compact statistics are used as they are. For json statistics a copy in
+    the compact format is written next to them as an index the first time,
+    and used for as long as it is newer than the json, so only the columns
+    of a query are read instead of parsing the whole file every time.
+    """
+    statistics = load_statistics(path) \
+        if not path.endswith('.json') else None
+    if isinstance(statistics, CompactStatistics):
+        return statistics
+
+    index = path + index_suffix
+    if os.path.exists(index) and \
+            os.path.getmtime(index) >= os.path.getmtime(path):
+        return CompactStatistics(index)
+    statistics = statistics or load_statistics(path)
+    try:
+        write_compact(index, statistics)
+    except (IOError, OSError):
+        return statistics
+    return CompactStatistics(index)
+
+
+def resolve_statistics(name, folder):
+    """
+    Return the statistics of a file, or of a build in the history.
+
+    A build in the history is given by its id, or relative to the latest
+    build by a negative number, e.g. -2 for the build before the latest.
+    Returns None if there is no such file or build.
+    """
+    if not re.match(r'^-?\d+$', name):
+        return open_statistics(name) if os.path.exists(name) else None
+    build = int(name)
+    index = read_history_index(folder)
+    if build < 0:
+        if -build > len(index):
+            return None
+        build = index[build][0]
+    return read_history_snapshot(folder, build, index)
+
+
+def select_keys(statistics, pattern=None):
+    """
+    Return the outputs whose path matches a glob pattern.
+
+    The outputs of compact statistics are sorted, so only those starting
+    with the literal prefix of the pattern are matched against it.
+    """
+    if isinstance(statistics, CompactStatistics):
+        keys = statistics.keys_list()
+        if pattern:
+            prefix = re.split(r'[*?[]', pattern, 1)[0]
+            keys = list(itertools.takewhile(
+                lambda key: key.startswith(prefix),
+                itertools.islice(
+                    keys, bisect.bisect_left(keys, prefix), None)))
+    else:
+        keys = [key for key in statistics if key != build_key]
+    if not pattern:
+        return keys
+    match = re.compile(fnmatch.translate(pattern)).match
+    return [key for key in keys if match(key)]
+
+
+def stat_values(statistics, keys, stat):
+    """Return the values of a stat of the outputs which are numbers."""
+    values = {}
+    if isinstance(statistics, CompactStatistics):
+        if 'column:' + stat not in statistics.sections:
+            return values
+        column = statistics.column(stat)
+        if keys is statistics.keys_list():
+            pairs = zip(keys, column)
+        else:
+            index = statistics.index
+            pairs = ((key, column[index(key)]) for key in keys)
+        # NaN marks the outputs without the stat.
+        return dict((key, value) for key, value in pairs if value == value)
+    for key in keys:
+        value = statistics[key].get(stat)
+        if value is not None and is_number(value['value']):
+            values[key] = value['value']
+    return values
+
+
+def query_statistics(statistics, compare=None, pattern=None, stat='time',
+                     threshold=None, sort=None, top=0):
+    """
+    Query the outputs of statistics, or their changes since compare.
+
+    The outputs are selected by a glob pattern of their path and by a
+    threshold on the stat, or on the absolute difference of the stat when
+    compared. They are sorted by the stat, by another stat, by the
+    'difference' or 'percent' of the stat, in descending order, or by
+    'file'. The filtering and sorting use only the values of the stats
+    involved, and the summaries, as of generate_summaries, are generated for
+    the top outputs only. Without compare, every output is summarised as
+    added.
+    """
+    if compare is None:
+        compare = {}
+    new_keys = select_keys(statistics, pattern)
+    old_keys = select_keys(compare, pattern)
+    new_keys_set = set(new_keys)
+    old_keys_set = set(old_keys)
+    keys = list(new_keys_set | old_keys_set) if compare else list(new_keys)
+    new = stat_values(statistics, new_keys, stat)
+    old = stat_values(compare, old_keys, stat)
+    measures = new
+    if compare or sort in ('difference', 'percent'):
+        measures = differences = dict(
+            (key, new.get(key, 0) - old.get(key, 0)) for key in keys)
+
+    if threshold is not None:
+        keys = [key for key in keys
+                if abs(measures.get(key, 0)) >= threshold]
+
+    sort = sort or stat
+    if sort == 'file':
+        keys = sorted(keys)[:top or None]
+    else:
+        if sort == 'difference':
+            values = dict((key, abs(differences[key])) for key in keys)
+        elif sort == 'percent':
+            values = dict((key, abs(differences[key] / old[key] * 100))
+                          for key in keys if old.get(key))
+        elif sort == stat:
+            values = new
+        else:
+            values = stat_values(statistics, new_keys, sort)
+        if top:
+            keys = heapq.nlargest(
+                top, keys, key=lambda key: values.get(key, 0))
+        else:
+            keys.sort(key=lambda key: values.get(key, 0), reverse=True)
+
+    summaries = []
+    for key in keys:
+        if key not in old_keys_set:
+            summary = generate_added_summary(key, statistics)
+        elif key not in new_keys_set:
+            summary = generate_removed_summary(key, compare)
+        else:
+            summary = generate_changed_summary(key, compare, statistics)
+        # as in iterate_summaries, e.g. a task which only has a status.
+        if summary['results']:
+            summaries.append(summary)
+    return summaries
+
+
+def print_query(summaries, compared=False):
+    """
+    Print the results of a query.
+
+    Changes are printed as the summary printed after a build, with totals,
+    while the outputs of a single build are printed with their values.
+    """
+    if compared:
+        print_summaries(summaries, -1)
+        return
+    for summary in summaries:
+        Logs.pprint('BOLD', '[ FILE   ] {file}'.format(**summary))
+        for stat, result in sorted(summary['results'].items()):
+            Logs.pprint('CYAN', '[ RESULT ]  {stat} {value:0.3f} {unit}'
+                        .format(stat=stat, **result))
+
+
+def write_query(summaries, output_format, stream):
+    """
+    Write the results of a query as json or csv.
+
+    The json is the list of summaries, the csv has a row for each stat of
+    each output.
+    """
+    if output_format == 'json':
+        json.dump(summaries, stream)
+        stream.write('\n')
+        return
+    fields = ['value', 'value_old', 'difference', 'percent']
+    writer = csv.writer(stream, lineterminator='\n')
+    writer.writerow(['file', 'state', 'stat', 'unit'] + fields)
+    for summary in summaries:
+        for stat, result in sorted(summary['results'].items()):
+            writer.writerow(
+                [summary['file'], summary['state'], stat, result['unit']] +
+                [result.get(field, '') for field in fields])
+
+
+class StatisticsContext(Context.Context):
+
+    """Query the build statistics, or the changes between two builds."""
+
+    cmd = 'stats'
+
+    def execute(self):
+        """Run the query given by the options and print the result."""
+        options = Options.options
+        folder = Context.out_dir or 'build'
+        name = options.stats_file or find_statistics(folder, 'both')
+        if not name:
+            self.fatal('No statistics found in {}.'.format(folder))
+        statistics = resolve_statistics(name, folder)
+        if statistics is None:
+            self.fatal('{} does not exists.'.format(name))
+
+        compare = None
+        if options.stats_compare:
+            compare = resolve_statistics(options.stats_compare, folder)
+            if compare is None:
+                self.fatal('{} does not exists.'.format(options.stats_compare))
+
+        summaries = query_statistics(
+            statistics, compare, options.stats_glob, options.stats_stat,
+            options.stats_threshold, options.stats_sort, options.stats_top)
+        if options.stats_format == 'text':
+            print_query(summaries, compare is not None)
+        else:
+            write_query(summaries, options.stats_format, sys.stdout)
+
+
+class ImpactContext(Context.Context):
+
+    """Predict which outputs a change rebuilds, and what it costs."""
+
+    cmd = 'impact'
+
+    def execute(self):
+        """Predict the rebuild of the files given by the options."""
+        options = Options.options
+        folder = Context.out_dir or 'build'
+        index = read_dependency_index(
+            os.path.join(folder, dependencies_filename))
+        if index is None:
+            self.fatal('No dependency index found in {}, build with '
+                       '--options=impact first.'.format(folder))
+
+        files = options.impact_files
+        files = sys.stdin.read().split() if files == '-' else \
+            [name for name in files.split(',') if name]
+        if not files:
+            ranking = index.rank(options.impact_top)
+            if options.impact_format == 'json':
+                json.dump(ranking, sys.stdout)
+                sys.stdout.write('\n')
+            else:
+                print_ranking(ranking)
+            return
+
+        # the files are given relative to where waf is run from.
+        top = Context.top_dir or os.getcwd()
+        paths = [os.path.relpath(
+            os.path.join(Context.launch_dir or top, name), top)
+            for name in files]
+        impact = index.impact(paths, options.impact_top)
+        if options.impact_format == 'json':
+            json.dump(impact, sys.stdout)
+            sys.stdout.write('\n')
+        else:
+            print_impact(impact, len(paths))
+        budget = options.impact_budget
+        if budget is not None and impact['cost'] > budget:
+            self.fatal('The change costs {:0.3f} s to rebuild, more than the '
+                       'budget of {:0.3f} s.'.format(impact['cost'], budget))